@@ -4,6 +4,34 @@
 bool aButtonState;
 bool bButtonState;
 
+// Solenoids are released by timers checked on every loop() pass, so nothing ever waits for a pulse to end:
+// both can be held at the same time, and serial and buttons are handled while they are.
+bool aEngaged = false;
+unsigned long aStarted;
+unsigned long aLength;
+bool bEngaged = false;
+unsigned long bStarted;
+unsigned long bLength;
+
+// Fire scheduled by host for exact micros() time (protocol v2)
+bool aScheduled = false;
+unsigned long aFireAt;
+unsigned long aFireLength;
+byte aFireId;
+bool bScheduled = false;
+unsigned long bFireAt;
+unsigned long bFireLength;
+byte bFireId;
+
+// Serial parser state. See communication/protocol.py for the protocol description.
+#define STATE_IDLE 0
+#define STATE_LEGACY 1
+#define STATE_FRAME 2
+byte serialState = STATE_IDLE;
+char legacyCommand;
+byte frame[PROTOCOL_MAX_PAYLOAD + 3];  // kind, length, payload, checksum
+byte framePosition;
+
 void setup() {
   pinMode(A_INPUT, INPUT_PULLUP);
   pinMode(B_INPUT, INPUT_PULLUP);
@@ -15,25 +43,23 @@ void setup() {
 }
 
 void loop() {
-  if (Serial.available() > 1) {
-    // Protocol: 1st byte: a or b, for one of the outputs.
-    //           2nd byte: how long to hold the button (in 10 ms increments, e.g. 3 = 30ms)
-    char c = Serial.read();
-    unsigned int delay = Serial.read() * 10;
-    switch (c) {
-      case 'a': // Fall through on purpose
-      case 'A':
-        engage(A_OUTPUT, delay);
-        break;
-      case 'b': // Fall through on purpose
-      case 'B':
-        engage(B_OUTPUT, delay);
-        break;
-      default:
-        // Do nothing, just ignore
-        break;
-    }
-      Serial.write(c);
+  unsigned long now = millis();
+
+  while (Serial.available() > 0) {
+    readByte(Serial.read(), now);
+  }
+
+  // Scheduled fires. Signed difference, so it works across micros() wrap around
+  unsigned long t = micros();
+  if (aScheduled && (long)(t - aFireAt) >= 0) {
+    engageA(now, aFireLength);
+    aScheduled = false;
+    sendFired(aFireId, t);
+  }
+  if (bScheduled && (long)(t - bFireAt) >= 0) {
+    engageB(now, bFireLength);
+    bScheduled = false;
+    sendFired(bFireId, t);
   }
 
   bool button;
@@ -42,7 +68,7 @@ void loop() {
   if (button != aButtonState) {
     // Since we have pullup, LOW means button is pressed
     if (button == LOW) {
-      engage(A_OUTPUT, LONG_ENGAGE_MS);
+      engageA(now, LONG_ENGAGE_MS);
     }
     aButtonState = button;
   }
@@ -50,14 +76,159 @@ void loop() {
   if (button != bButtonState) {
     // Since we have pullup, LOW means button is pressed
     if (button == LOW) {
-      engage(B_OUTPUT, LONG_ENGAGE_MS);
+      engageB(now, LONG_ENGAGE_MS);
     }
     bButtonState = button;
   }
+
+  // Unsigned subtraction keeps working when millis() wraps around
+  if (aEngaged && now - aStarted >= aLength) {
+    digitalWriteFast(A_OUTPUT, LOW);
+    aEngaged = false;
+  }
+  if (bEngaged && now - bStarted >= bLength) {
+    digitalWriteFast(B_OUTPUT, LOW);
+    bEngaged = false;
+  }
+}
+
+void readByte(byte c, unsigned long now) {
+  switch (serialState) {
+    case STATE_IDLE:
+      if (c == PROTOCOL_START) {
+        framePosition = 0;
+        serialState = STATE_FRAME;
+      } else {
+        legacyCommand = c;
+        serialState = STATE_LEGACY;
+      }
+      break;
+    case STATE_LEGACY:
+      // Legacy protocol: 1st byte: a or b, for one of the outputs.
+      //                  2nd byte: how long to hold the button (in 10 ms increments, e.g. 3 = 30ms)
+      handleLegacy(legacyCommand, c * 10UL, now);
+      serialState = STATE_IDLE;
+      break;
+    case STATE_FRAME:
+      frame[framePosition++] = c;
+      if (framePosition == 2 && frame[1] > PROTOCOL_MAX_PAYLOAD) {
+        // Garbage, start over
+        serialState = STATE_IDLE;
+      } else if (framePosition >= 3 && framePosition == frame[1] + 3) {
+        if (checksum(frame[0], frame + 2, frame[1]) == frame[framePosition - 1]) {
+          handleFrame(frame[0], frame + 2, frame[1], now);
+        }
+        serialState = STATE_IDLE;
+      }
+      break;
+  }
+}
+
+void handleLegacy(char c, unsigned long length, unsigned long now) {
+  switch (c) {
+    case 'a': // Fall through on purpose
+    case 'A':
+      engageA(now, length);
+      break;
+    case 'b': // Fall through on purpose
+    case 'B':
+      engageB(now, length);
+      break;
+    default:
+      // Do nothing, just ignore
+      break;
+  }
+  // Echo as soon as command is accepted, so host can measure round trip
+  Serial.write(c);
+}
+
+void handleFrame(byte kind, byte *payload, byte length, unsigned long now) {
+  byte reply[5];
+  switch (kind) {
+    case MSG_HELLO:
+      reply[0] = PROTOCOL_VERSION;
+      sendFrame(MSG_HELLO_REPLY, reply, 1);
+      break;
+    case MSG_SYNC:
+      if (length < 1) return;
+      reply[0] = payload[0];
+      writeLong(reply + 1, micros());
+      sendFrame(MSG_SYNC_REPLY, reply, 5);
+      break;
+    case MSG_FIRE: {
+      if (length < 8) return;
+      unsigned long at = readLong(payload + 1);
+      unsigned long hold = payload[5] | ((unsigned int)payload[6] << 8);
+      byte id = payload[7];
+      reply[0] = id;
+      reply[1] = (long)(micros() - at) > 0 ? ACK_LATE : ACK_OK;
+      if (payload[0] == 'A') {
+        aScheduled = true;
+        aFireAt = at;
+        aFireLength = hold;
+        aFireId = id;
+      } else if (payload[0] == 'B') {
+        bScheduled = true;
+        bFireAt = at;
+        bFireLength = hold;
+        bFireId = id;
+      } else {
+        reply[1] = ACK_INVALID;
+      }
+      sendFrame(MSG_FIRE_ACK, reply, 2);
+      break;
+    }
+    default:
+      break;
+  }
+}
+
+void sendFired(byte id, unsigned long t) {
+  byte reply[5];
+  reply[0] = id;
+  writeLong(reply + 1, t);
+  sendFrame(MSG_FIRED, reply, 5);
+}
+
+void sendFrame(byte kind, byte *payload, byte length) {
+  Serial.write(PROTOCOL_START);
+  Serial.write(kind);
+  Serial.write(length);
+  Serial.write(payload, length);
+  Serial.write(checksum(kind, payload, length));
+}
+
+byte checksum(byte kind, byte *payload, byte length) {
+  byte value = kind ^ length;
+  for (byte i = 0; i < length; i++) {
+    value ^= payload[i];
+  }
+  return value;
+}
+
+// Little endian helpers
+unsigned long readLong(byte *p) {
+  return (unsigned long)p[0] | ((unsigned long)p[1] << 8) | ((unsigned long)p[2] << 16) | ((unsigned long)p[3] << 24);
+}
+
+void writeLong(byte *p, unsigned long value) {
+  p[0] = value & 0xFF;
+  p[1] = (value >> 8) & 0xFF;
+  p[2] = (value >> 16) & 0xFF;
+  p[3] = (value >> 24) & 0xFF;
+}
+
+// New command while engaged restarts the timer, i.e. holds the flipper for `length` from now
+void engageA(unsigned long now, unsigned long length) {
+  digitalWriteFast(A_OUTPUT, HIGH);
+  aEngaged = true;
+  aStarted = now;
+  aLength = length;
 }
 
-void engage(int pin, unsigned int length) {
-  digitalWriteFast(pin, HIGH);
-  delay(length);
-  digitalWriteFast(pin, LOW);
+void engageB(unsigned long now, unsigned long length) {
+  digitalWriteFast(B_OUTPUT, HIGH);
+  bEngaged = true;
+  bStarted = now;
+  bLength = length;
 }
@@ -10,4 +10,21 @@
 #define LONG_ENGAGE_MS 300
 #define SHORT_ENGAGE_MS 100
 
+// Framed protocol, keep in sync with communication/protocol.py
+#define PROTOCOL_VERSION 2
+#define PROTOCOL_START 0xA5
+#define PROTOCOL_MAX_PAYLOAD 16
+
+#define MSG_HELLO 0x01
+#define MSG_SYNC 0x02
+#define MSG_FIRE 0x03
+#define MSG_HELLO_REPLY 0x81
+#define MSG_SYNC_REPLY 0x82
+#define MSG_FIRE_ACK 0x83
+#define MSG_FIRED 0x84
+
+#define ACK_OK 0
+#define ACK_LATE 1
+#define ACK_INVALID 2
+
 #endif
@@ -0,0 +1,45 @@
+from lib.metrics import clock
+
+
+class RecordingArduino(object):
+    """Stands in for `communication.actuator.Actuator`, remembering presses instead of sending them.
+
+    `frame()` tells the number of the frame decisions are made on, so every press can be matched with ground truth.
+    Scheduled presses are recorded the same as immediate ones, with the time asked for.
+    """
+
+    error = None
+    on_fired = None
+
+    def __init__(self, frame=None):
+        self.frame = frame
+        self.presses = []
+
+    def start(self):
+        return self
+
+    def protocol(self):
+        return "recording presses for the benchmark"
+
+    def press(self, flipper, milliseconds, at=None):
+        self.presses.append({'flipper': flipper, 'milliseconds': milliseconds, 'at': at,
+                             'frame': self.frame() if self.frame is not None else None, 'time': clock()})
+        return True
+
+    def pressA(self, milliseconds):
+        return self.press('A', milliseconds)
+
+    def pressB(self, milliseconds):
+        return self.press('B', milliseconds)
+
+    def schedule_press(self, flipper, at, milliseconds):
+        return self.press(flipper, milliseconds, at)
+
+    def is_stalled(self):
+        return False
+
+    def latency(self):
+        return None
+
+    def close(self):
+        pass
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+"""Replays synthetic pinball video through the detection and decision path, and reports
+per stage throughput, decision latency and fire accuracy against ground truth.
+
+    python -m benchmark.run --balls 30 --predictor tracker
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+from benchmark.recorder import RecordingArduino
+from benchmark.synthetic import Scenario
+from lib import detection
+from lib.metrics import clock
+from table import TableController
+
+# Order stages are reported in
+STAGES = ['capture_to_read', 'prepare', 'subtraction', 'detection', 'morphology', 'blobs', 'prediction', 'hit_test',
+          'capture_to_fire', 'frame_total']
+
+
+def replay(video, truth, predictor='bruteforce', ball_prediction_time=60, cooldown=300, latency=100,
+           training_frames=20, engine='gmg', grayscale=False, pyramid=0, hit_table=False):
+    """Plays the video through `table.TableController`, same as track-ball.py --replay with --debug-right and
+    --debug-left from ground truth, with `RecordingArduino` instead of real one.
+
+    Predictor sees frame timestamps from the video, so results don't depend on how fast this machine is.
+    With `hit_table`, flippers are hit tested with `lib.hit_table.HitTable`, built right after training.
+    Returns (table, recorder, frames, seconds).
+    """
+    arduino = RecordingArduino()
+    # Ground truth counts frames from 0, stream from 1
+    press_frames = dict((f, set(n + 1 for n in frames)) for (f, frames) in truth['training'].items())
+    table = TableController(None, video, None, None, engine=engine, training_frames=training_frames,
+                            grayscale=grayscale, pyramid=pyramid, predictor=predictor, latency=latency,
+                            cooldown=cooldown, ball_prediction_time=ball_prediction_time, replay=True,
+                            metrics_interval=0, fixed_prediction_time=True, exact_hit_test=not(hit_table),
+                            press_frames=press_frames, arduino=arduino)
+    arduino.frame = lambda: table.frame_number - 1
+    table.start()
+    started = clock()
+    table.run()
+    seconds = clock() - started
+    table.close()
+    if hit_table:
+        print("Hit table: {mismatches} of {segments} random segments answered differently than by exact test, "
+              "{exact} had to be checked exactly".format(**table.hit_table.verify()))
+    return (table, arduino, table.frames_processed, seconds)
+
+
+def score(truth, presses):
+    """Matches presses with balls. A press is right if it's for the flipper ball is heading to,
+    between ball appearing and it reaching flipper area.
+    """
+    balls = truth['balls']
+    frame_ms = 1000.0 / truth['fps']
+    caught = {}
+    false_fires = 0
+    for p in presses:
+        match = None
+        for (i, b) in enumerate(balls):
+            last = b['enter_frame'] if b['enter_frame'] is not None else b['end_frame']
+            if b['target'] == p['flipper'] and b['start_frame'] <= p['frame'] <= last + 1 and i not in caught:
+                match = i
+                break
+        if match is None:
+            false_fires += 1
+        else:
+            caught[match] = p
+    targeted = [i for (i, b) in enumerate(balls) if b['target'] is not None]
+    ignored = [i for (i, b) in enumerate(balls) if b['target'] is None and
+               not any(b['start_frame'] <= p['frame'] <= b['end_frame'] for p in presses)]
+    # How long before reaching flipper area we fired, the bigger the safer
+    leads = sorted((balls[i]['enter_frame'] - p['frame']) * frame_ms for (i, p) in caught.items()
+                   if balls[i]['enter_frame'] is not None)
+    return {
+        'balls': len(balls),
+        'caught': len(caught),
+        'missed': len(targeted) - len(caught),
+        'false_fires': false_fires,
+        'correctly_ignored': len(ignored),
+        'accuracy': (len(caught) + len(ignored)) / float(len(balls)) if balls else 0,
+        'lead_ms_min': leads[0] if leads else None,
+        'lead_ms_median': leads[len(leads) // 2] if leads else None,
+    }
+
+
+def report(metrics, frames, seconds, accuracy, detection=None):
+    "`detection` is the histogram of whole background subtraction cost, see `lib.detection.Engine.cost`"
+    histograms = dict(metrics.histograms)
+    if detection is not None:
+        histograms['detection'] = detection
+    stages = {}
+    for stage in STAGES:
+        h = histograms.get(stage)
+        if h is None or h.count == 0:
+            continue
+        summary = h.summary()
+        summary['fps'] = round(1000.0 / summary['mean'], 1) if summary['mean'] else None
+        stages[stage] = summary
+    return {
+        'frames': frames,
+        'seconds': round(seconds, 3),
+        'fps': round(frames / seconds, 1) if seconds else None,
+        'stages': stages,
+        'accuracy': accuracy,
+    }
+
+
+def print_report(result):
+    print("{} frames in {}s, {} FPS overall".format(result['frames'], result['seconds'], result['fps']))
+    print("{:<16} {:>8} {:>8} {:>8} {:>8} {:>9}".format('stage', 'p50 ms', 'p99 ms', 'max ms', 'mean ms', 'fps'))
+    for stage in STAGES:
+        s = result['stages'].get(stage)
+        if s:
+            print("{:<16} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>9}".format(
+                stage, s['p50'], s['p99'], s['max'], s['mean'], s['fps'] if stage != 'capture_to_fire' else '-'))
+    a = result['accuracy']
+    print("Balls: {balls}, caught: {caught}, missed: {missed}, correctly ignored: {correctly_ignored}, "
+          "false fires: {false_fires}, accuracy: {accuracy:.2f}".format(**a))
+    if a['lead_ms_median'] is not None:
+        print("Fired {:.0f}ms (median), {:.0f}ms (min) before ball reached flipper".format(
+            a['lead_ms_median'], a['lead_ms_min']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--video', help='Previously generated synthetic video (ground truth is read from <video>.json)')
+    parser.add_argument('--out-dir', help='Where to put generated video', default='./tmp/benchmark')
+    parser.add_argument('--balls', help='Number of balls in generated video', default=30, type=int)
+    parser.add_argument('--seed', help='Random seed for generated video', default=1, type=int)
+    parser.add_argument('--predictor', choices=['bruteforce', 'tracker'], default='bruteforce')
+    parser.add_argument('--ball-prediction-time', default=60, type=int)
+    parser.add_argument('--cooldown', default=300, type=int)
+    parser.add_argument('--engine', default='gmg',
+                        help='''Detection engine(s), comma separated, from: {}. With several, each one runs on
+                            the same video and their cost and accuracy are compared'''.format(', '.join(sorted(detection.ENGINES))))
+    parser.add_argument('--grayscale', help='Detect on grayscale frames', const=True, action='store_const')
+    parser.add_argument('--pyramid', help='Halve resolution this many times before detection', default=0, type=int)
+    parser.add_argument('--hit-table', help='Hit test with precomputed lookup table instead of hull polygons',
+                        const=True, action='store_const')
+    parser.add_argument('--json', help='Also write report as JSON into this file')
+    args = parser.parse_args()
+
+    if args.video:
+        video = args.video
+        with open(video + '.json') as f:
+            truth = json.load(f)
+    else:
+        if not(os.path.isdir(args.out_dir)):
+            os.makedirs(args.out_dir)
+        video = os.path.join(args.out_dir, 'synthetic-{}-{}.avi'.format(args.balls, args.seed))
+        print("Generating {}".format(video))
+        truth = Scenario(balls=args.balls, seed=args.seed).write(video)
+
+    results = {}
+    for engine in args.engine.split(','):
+        print("Engine: {}".format(engine))
+        (table, arduino, frames, seconds) = replay(video, truth, predictor=args.predictor,
+                                                   ball_prediction_time=args.ball_prediction_time,
+                                                   cooldown=args.cooldown, engine=engine,
+                                                   grayscale=args.grayscale, pyramid=args.pyramid,
+                                                   hit_table=args.hit_table)
+        results[engine] = report(table.metrics, frames, seconds, score(truth, arduino.presses), table.engine.cost)
+        print_report(results[engine])
+    if len(results) > 1:
+        print("{:<10} {:>16} {:>9}".format('engine', 'detection p50 ms', 'accuracy'))
+        for (engine, result) in sorted(results.items(), key=lambda r: r[1]['stages']['detection']['p50']):
+            print("{:<10} {:>16.3f} {:>9.2f}".format(engine, result['stages']['detection']['p50'],
+                                                    result['accuracy']['accuracy']))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results if len(results) > 1 else results[args.engine], f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+import cv2
+import json
+import numpy
+from flipper import segments_touch_polygon
+
+# Flipper geometry on 640x480 frame: pivot, tip at rest, tip when pressed.
+# A is the right one, B the left one, same as in track-ball.py
+FLIPPERS = {
+    'A': ((420, 430), (345, 455), (350, 395)),
+    'B': ((220, 430), (295, 455), (290, 395)),
+}
+FLIPPER_THICKNESS = 14
+BALL_RADIUS = 6
+
+
+def swept_area(flipper):
+    "Polygon flipper covers while moving from rest to pressed position, i.e. where it can hit the ball"
+    (pivot, rest, pressed) = FLIPPERS[flipper]
+    return numpy.array([pivot, rest, pressed], dtype=numpy.float64)
+
+
+class Scenario(object):
+    """Synthetic pinball video with known ground truth.
+
+    Layout of the video:
+    - `warmup` frames of static playfield, for background subtraction to learn it
+    - flipper A, then flipper B pressed `presses` times each, every `press_interval` frames
+      (frame numbers are in `training['A']`/`training['B']`, like --debug-right/--debug-left)
+    - `balls` balls, one after another, on straight lines. Some of them end up in one of the
+      flipper areas (`target` is 'A' or 'B' with `enter_frame`), others leave to the sides (`target` is None)
+    """
+
+    def __init__(self, balls=20, seed=1, fps=60.0, size=(640, 480), warmup=30, presses=12, press_interval=40,
+                 press_frames=3, ball_frames=(25, 45), gap=15):
+        self.fps = fps
+        self.size = size
+        self.random = numpy.random.RandomState(seed)
+        self.press_frames = press_frames
+        self.training = {'A': [], 'B': []}
+        frame = warmup
+        for flipper in ('A', 'B'):
+            for _ in range(presses):
+                self.training[flipper].append(frame)
+                frame += press_interval
+        self.game_start = frame + warmup
+        self.balls = []
+        frame = self.game_start
+        for n in range(balls):
+            duration = self.random.randint(ball_frames[0], ball_frames[1])
+            target = ('A', 'B', None)[n % 3]
+            self.balls.append(self.__make_ball(frame, duration, target))
+            frame += duration + gap
+        self.frames = frame + gap
+        self.background = self.__make_background()
+
+    def __make_background(self):
+        (width, height) = self.size
+        # Static, but textured playfield, so subtraction has something to learn
+        noise = self.random.randint(20, 60, (height // 8, width // 8, 3)).astype(numpy.uint8)
+        background = cv2.resize(noise, (width, height), interpolation=cv2.INTER_LINEAR)
+        cv2.rectangle(background, (5, 5), (width - 6, height - 6), (90, 90, 90), 3)
+        return background
+
+    def __make_ball(self, start_frame, duration, target):
+        (width, height) = self.size
+        start = numpy.array([self.random.uniform(80, width - 80), 20.0])
+        if target is None:
+            end = numpy.array([self.random.choice([15.0, width - 15.0]), self.random.uniform(150, 330)])
+        else:
+            # Aim a bit towards the pivot, so the ball surely ends up inside flipper area
+            area = swept_area(target)
+            end = area.mean(axis=0) * 0.7 + area[0] * 0.3
+        positions = [tuple(start + (end - start) * (i / float(duration))) for i in range(duration + 1)]
+        ball = {
+            'start_frame': start_frame,
+            'end_frame': start_frame + duration,
+            'positions': positions,
+            'target': target,
+            'enter_frame': None,
+        }
+        if target is not None:
+            area = swept_area(target)
+            for (i, p) in enumerate(positions):
+                p = numpy.array([p], dtype=numpy.float64)
+                if segments_touch_polygon(p, p, area, BALL_RADIUS)[0]:
+                    ball['enter_frame'] = start_frame + i
+                    break
+        return ball
+
+    def is_pressed(self, flipper, frame_number):
+        for pressed in self.training[flipper]:
+            if pressed <= frame_number < pressed + self.press_frames:
+                return True
+        return False
+
+    def render(self, frame_number):
+        frame = self.background.copy()
+        for flipper in ('A', 'B'):
+            (pivot, rest, pressed) = FLIPPERS[flipper]
+            tip = pressed if self.is_pressed(flipper, frame_number) else rest
+            cv2.line(frame, pivot, tip, (200, 200, 200), FLIPPER_THICKNESS)
+        for ball in self.balls:
+            if ball['start_frame'] <= frame_number <= ball['end_frame']:
+                (x, y) = ball['positions'][frame_number - ball['start_frame']]
+                cv2.circle(frame, (int(x), int(y)), BALL_RADIUS, (255, 255, 255), -1)
+        return frame
+
+    def write(self, path):
+        "Writes video into `path`, and ground truth next to it (same name with .json). Returns ground truth"
+        writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), self.fps, self.size)
+        for n in range(self.frames):
+            writer.write(self.render(n))
+        writer.release()
+        truth = self.ground_truth()
+        with open(path + '.json', 'w') as f:
+            json.dump(truth, f, indent=2)
+        return truth
+
+    def ground_truth(self):
+        return {
+            'fps': self.fps,
+            'size': list(self.size),
+            'frames': self.frames,
+            'training': self.training,
+            'game_start': self.game_start,
+            'areas': dict((f, swept_area(f).tolist()) for f in FLIPPERS),
+            'balls': [dict((k, v) for (k, v) in b.items() if k != 'positions') for b in self.balls],
+        }
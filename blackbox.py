@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""Flight recorder tool: freezes and copies out the window track-ball.py keeps with --flight-recorder,
+exports it for viewing, and replays it through track-ball.py to see if the same decisions come out.
+
+    python blackbox.py dump tmp/flight.rec tmp/miss.rec
+    python blackbox.py export tmp/miss.rec tmp/miss
+    python blackbox.py replay tmp/miss.rec -- --calibration tmp/calibration.bin
+
+Running track-ball.py dumps the window by itself on SIGUSR1 (kill -USR1 <pid>) too.
+Replay passes any arguments it does not know on to track-ball.py, like replay.py does.
+"""
+
+from __future__ import print_function
+import argparse
+import cv2
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from lib.recorder import FlightRecorder, FIRED
+
+
+def dump(source, target=None, keep_frozen=False):
+    "Copies the window out of a (possibly running) recorder. Returns path of the copy"
+    if target is None:
+        target = os.path.join(os.path.dirname(source) or '.',
+                              'flight-{}.rec'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+    recorder = FlightRecorder.open(source)
+    frames = recorder.dump(target)
+    if keep_frozen:
+        recorder.freeze()
+    recorder.close()
+    print("{} frames copied to {}".format(frames, target))
+    return target
+
+
+def fired_names(bits):
+    return [name for (name, bit) in sorted(FIRED.items()) if bits & bit]
+
+
+def export(source, directory):
+    """Writes recording as lossless videos of frames and masks, and frames.jsonl with everything else.
+
+    Returns (frames video path, [frame info dicts]).
+    """
+    recorder = FlightRecorder.open(source)
+    order = recorder.order()
+    if not(os.path.isdir(directory)):
+        os.makedirs(directory)
+    times = recorder.slots['time_ms'][order]
+    # Video needs a constant rate, go by the typical interval between recorded frames
+    intervals = sorted(b - a for (a, b) in zip(times, times[1:]) if b > a)
+    fps = 1000.0 / intervals[len(intervals) // 2] if intervals else 60.0
+    size = (recorder.width, recorder.height)
+    videos = [os.path.join(directory, name) for name in ('frames.avi', 'masks.avi')]
+    writers = [cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'FFV1'), fps, size) for path in videos]
+    frames = []
+    with open(os.path.join(directory, 'frames.jsonl'), 'w') as info:
+        for slot in order:
+            record = recorder.slots[slot]
+            writers[0].write(record['frame'])
+            writers[1].write(cv2.cvtColor(record['mask'], cv2.COLOR_GRAY2BGR))
+            frame = {'number': int(record['number']), 'time_ms': round(float(record['time_ms']), 3),
+                     'fired': fired_names(int(record['fired'])), 'mask_roi': record['mask_roi'].tolist(),
+                     'lines': record['lines'][:record['line_count']].tolist()}
+            info.write(json.dumps(frame) + "\n")
+            frames.append(frame)
+    for writer in writers:
+        writer.release()
+    recorder.close()
+    print("{} frames ({:.1f} FPS) exported to {}".format(len(frames), fps, directory))
+    return (videos[0], frames)
+
+
+def replay(source, extra):
+    """Runs recorded frames through track-ball.py --replay and compares its presses with recorded ones.
+
+    Returns (recorded presses, replayed presses, matching) counts.
+    """
+    directory = tempfile.mkdtemp(prefix='blackbox-')
+    try:
+        (video, frames) = export(source, directory)
+        decisions = os.path.join(directory, 'decisions.jsonl')
+        command = [sys.executable, 'track-ball.py', '--src', video, '--replay', '--decision-log', decisions,
+                   '--metrics-interval', '0']
+        # Same detection region as the recorded game, unless asked otherwise
+        (x, y, w, h) = frames[-1]['mask_roi'] if frames else (0, 0, 0, 0)
+        if w and h and '--roi' not in extra:
+            command.extend(['--roi', '{},{},{},{}'.format(x, y, w, h)])
+        with open(os.path.join(directory, 'out.log'), 'w') as output:
+            code = subprocess.call(command + extra, stdout=output, stderr=subprocess.STDOUT,
+                                   cwd=os.path.dirname(os.path.abspath(__file__)))
+        if code != 0:
+            with open(os.path.join(directory, 'out.log')) as output:
+                print(output.read()[-2000:])
+            raise RuntimeError("track-ball.py exited with {}".format(code))
+        replayed = {}
+        if os.path.isfile(decisions):
+            with open(decisions) as f:
+                for line in f:
+                    decision = json.loads(line)
+                    # Video frames count from 1
+                    replayed.setdefault(decision['frame'] - 1, []).append(decision['flipper'])
+    finally:
+        shutil.rmtree(directory)
+    counts = [0, 0, 0]
+    for (index, frame) in enumerate(frames):
+        (recorded, again) = (frame['fired'], replayed.get(index, []))
+        if recorded or again:
+            print("frame {} ({:.0f}ms): recorded {}, replayed {}".format(
+                frame['number'], frame['time_ms'], ','.join(recorded) or '-', ','.join(again) or '-'))
+        counts[0] += len(recorded)
+        counts[1] += len(again)
+        counts[2] += len(set(recorded) & set(again))
+    print("Recorded {} presses, replayed {}, {} on the same frame".format(*counts))
+    return tuple(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    command = commands.add_parser('dump', help='Freeze a recorder and copy its window out, oldest frame first')
+    command.add_argument('recorder', help='Ring file of running (or stopped) track-ball.py --flight-recorder')
+    command.add_argument('target', nargs='?', help='Where to write the copy (flight-<time>.rec next to it by default)')
+    command.add_argument('--keep-frozen', const=True, action='store_const',
+                         help='Leave recorder frozen after the copy, so the window stays as it is')
+    command = commands.add_parser('export', help='Frames and masks as lossless videos, the rest as JSON lines')
+    command.add_argument('recording')
+    command.add_argument('directory')
+    command = commands.add_parser('replay', help='Play recording through track-ball.py and compare presses')
+    command.add_argument('recording')
+    (args, extra) = parser.parse_known_args()
+    if extra and extra[0] == '--':
+        extra = extra[1:]
+    if args.command != 'replay' and extra:
+        parser.error("unrecognized arguments: {}".format(' '.join(extra)))
+
+    if args.command == 'dump':
+        dump(args.recorder, args.target, args.keep_frozen)
+    elif args.command == 'export':
+        export(args.recording, args.directory)
+    elif args.command == 'replay':
+        replay(os.path.abspath(args.recording), extra)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""Calibrates flippers from a recorded video, without playing it through track-ball.py.
+
+Presses are found by themselves: flipper moving is a burst of motion much larger than the ball can make, in the part
+of the frame where that flipper is (bottom right third for A, bottom left for B by default, see --region-a/--region-b).
+Video is scanned in chunks on all cores, then every press is turned into a mask of where flipper moved against the
+background of the quiet frames, and flippers are trained from those. Calibration file (hulls, background and
+hit table, same as track-ball.py --save-calibration) is written at the end:
+
+    python calibrate.py tmp/training.avi --save-calibration tmp/calibration.bin
+    python track-ball.py --src 0 --calibration tmp/calibration.bin
+"""
+
+from __future__ import print_function
+import argparse
+import math
+import multiprocessing
+import cv2
+import numpy
+from flipper import Flipper
+from lib.background import BackgroundModel
+from lib.calibration import Calibration
+from lib.hit_table import HitTable
+from lib.metrics import clock
+from lib.roi import RegionOfInterest
+
+FLIPPERS = ('A', 'B')
+
+
+def default_regions(width, height):
+    "Where to look for flippers: bottom third of the frame, A in the right half, B in the left"
+    return {'A': RegionOfInterest(width // 2, height * 2 // 3, width - width // 2, height - height * 2 // 3),
+            'B': RegionOfInterest(0, height * 2 // 3, width // 2, height - height * 2 // 3)}
+
+
+def _bounds(regions):
+    "Region covering all of `regions`, only that much of every frame is looked at"
+    x0 = min(r.x for r in regions.values())
+    y0 = min(r.y for r in regions.values())
+    x1 = max(r.x + r.w for r in regions.values())
+    y1 = max(r.y + r.h for r in regions.values())
+    return RegionOfInterest(x0, y0, x1 - x0, y1 - y0)
+
+
+def _open(video, start):
+    capture = cv2.VideoCapture(video)
+    if start:
+        capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+    return capture
+
+
+def _scan(task):
+    """Pool worker: share of every region's pixels that changed since the previous frame, for frames [start, end).
+
+    Returns (start, (frames, flippers) float array). First frame of the video has no previous one, so it's 0.
+    """
+    (video, start, end, regions, threshold) = task
+    bounds = _bounds(regions)
+    # Region crops relative to bounds
+    crops = [RegionOfInterest(regions[f].x - bounds.x, regions[f].y - bounds.y, regions[f].w, regions[f].h)
+             for f in FLIPPERS]
+    capture = _open(video, max(start - 1, 0))
+    motion = []
+    previous = None
+    changed = None
+    for n in range(max(start - 1, 0), end):
+        (grabbed, frame) = capture.read()
+        if not(grabbed):
+            break
+        gray = cv2.cvtColor(bounds.crop(frame), cv2.COLOR_BGR2GRAY)
+        if previous is None:
+            previous = gray
+            if n < start:
+                continue
+            motion.append([0.0] * len(FLIPPERS))
+            continue
+        changed = cv2.threshold(cv2.absdiff(gray, previous, dst=changed), threshold, 255, cv2.THRESH_BINARY,
+                                dst=changed)[1]
+        motion.append([cv2.countNonZero(c.crop(changed)) / float(c.w * c.h) for c in crops])
+        (previous, gray) = (gray, previous)
+    capture.release()
+    return (start, numpy.array(motion, dtype=numpy.float32).reshape(-1, len(FLIPPERS)))
+
+
+def find_presses(motion, min_motion, max_gap):
+    """Bursts of motion of at least `min_motion` (share of region), as [(first frame, last frame)].
+
+    Flipper going up and coming back down are two bursts with a still moment in between, anything closer
+    than `max_gap` frames is taken as the same press.
+    """
+    moving = numpy.flatnonzero(motion >= min_motion)
+    presses = []
+    for n in moving:
+        if presses and n - presses[-1][1] <= max_gap:
+            presses[-1][1] = n
+        else:
+            presses.append([n, n])
+    return [tuple(p) for p in presses]
+
+
+def _quiet(motion, count, min_motion):
+    "Up to `count` frames spread over the video where nothing moved in any region"
+    still = numpy.flatnonzero((motion < min_motion / 10.0).all(axis=1))
+    if len(still) <= count:
+        return list(still)
+    return [still[int(i)] for i in numpy.linspace(0, len(still) - 1, count)]
+
+
+def _background(task):
+    "Pool worker: BackgroundModel accumulators (sum, sum of squares, count) of given frames"
+    (video, frames) = task
+    model = BackgroundModel()
+    capture = cv2.VideoCapture(video)
+    for n in frames:
+        capture.set(cv2.CAP_PROP_POS_FRAMES, n)
+        (grabbed, frame) = capture.read()
+        if grabbed:
+            model.add(frame)
+    capture.release()
+    return (model.sum, model.sum_sq, model.count)
+
+
+def _masks(task):
+    """Pool worker: where flipper moved during each press, as (flipper, packed bits mask) pairs.
+
+    That's every pixel of its region that differs from background in any frame of the press, grown a bit
+    like training masks in track-ball.py.
+    """
+    (video, presses, regions, background, threshold) = task
+    capture = cv2.VideoCapture(video)
+    masks = []
+    for (flipper, first, last) in presses:
+        region = regions[flipper]
+        reference = region.crop(background)
+        moved = numpy.zeros((region.h, region.w), dtype=numpy.uint8)
+        capture.set(cv2.CAP_PROP_POS_FRAMES, first)
+        for _ in range(first, last + 1):
+            (grabbed, frame) = capture.read()
+            if not(grabbed):
+                break
+            diff = cv2.absdiff(region.crop(frame), reference).max(axis=2)
+            numpy.maximum(moved, cv2.threshold(diff, threshold, 255, cv2.THRESH_BINARY)[1], out=moved)
+        mask = numpy.zeros(background.shape[:2], dtype=numpy.uint8)
+        region.crop(mask)[...] = cv2.dilate(moved, None, iterations=3)
+        masks.append((flipper, numpy.packbits(mask.reshape(-1) > 0)))
+    capture.release()
+    return masks
+
+
+def _split(items, parts):
+    return [items[n::parts] for n in range(parts) if items[n::parts]]
+
+
+def calibrate(video, regions=None, jobs=None, chunk=300, threshold=25, min_motion=0.015, max_gap=None,
+              min_presses=6, background_frames=30):
+    """Finds presses and trains both flippers from `video`.
+
+    Returns (Calibration, {flipper: [(first frame, last frame)]}), frames counted from 0. Raises ValueError
+    if a flipper did not get `min_presses` presses or could not be trained.
+    """
+    capture = cv2.VideoCapture(video)
+    if not(capture.isOpened()):
+        raise ValueError("Can't open {}".format(video))
+    (width, height) = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    frame_count = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = capture.get(cv2.CAP_PROP_FPS) or 30.0
+    capture.release()
+    regions = regions or default_regions(width, height)
+    if max_gap is None:
+        # Flipper stays up for about as long as --latency holds the button
+        max_gap = int(math.ceil(0.15 * fps))
+    jobs = jobs or multiprocessing.cpu_count()
+    pool = multiprocessing.Pool(jobs)
+    try:
+        scanned = pool.map(_scan, [(video, start, min(start + chunk, frame_count), regions, threshold)
+                                   for start in range(0, frame_count, chunk)])
+        motion = numpy.concatenate([m for (_, m) in sorted(scanned, key=lambda s: s[0])])
+        presses = dict((f, find_presses(motion[:, n], min_motion, max_gap)) for (n, f) in enumerate(FLIPPERS))
+        for f in FLIPPERS:
+            if len(presses[f]) < min_presses:
+                raise ValueError("Found {} presses of flipper {}, need at least {}".format(
+                    len(presses[f]), f, min_presses))
+
+        background = BackgroundModel()
+        for (total, total_sq, count) in pool.map(_background, [(video, frames) for frames in
+                                                               _split(_quiet(motion, background_frames, min_motion),
+                                                                      jobs)]):
+            if background.sum is None:
+                (background.sum, background.sum_sq) = (total, total_sq)
+            else:
+                (background.sum, background.sum_sq) = (background.sum + total, background.sum_sq + total_sq)
+            background.count += count
+        if not(background.count):
+            raise ValueError("No still frames to learn background from")
+        background.finish()
+
+        work = [(f, first, last) for f in FLIPPERS for (first, last) in presses[f]]
+        diff_threshold = max(threshold, 4 * background.noise)
+        found = pool.map(_masks, [(video, part, regions, background.image, diff_threshold)
+                                  for part in _split(work, jobs)])
+    finally:
+        pool.close()
+        pool.join()
+
+    flippers = {}
+    masks = dict((f, [m for part in found for (name, m) in part if name == f]) for f in FLIPPERS)
+    for (f, name) in (('A', 'right'), ('B', 'left')):
+        # Every press counts, not only the last 12, with the same share of them needed as in track-ball.py
+        flippers[f] = Flipper(name=name, num_masks=len(masks[f]),
+                              min_effective=max(1, int(round(len(masks[f]) * 8 / 12.0))))
+        for packed in masks[f]:
+            flippers[f].add_mask(numpy.unpackbits(packed)[:width * height].reshape(height, width))
+        if not(flippers[f].train_masks()):
+            raise ValueError("Flipper {} could not be trained from {} presses".format(f, len(masks[f])))
+
+    calibration = Calibration(width, height, predictor={
+        'min_area': int(width * height / 4000), 'max_area': int(width * height / 20),
+        'max_speed': max(width, height) / 500.0})
+    for f in FLIPPERS:
+        calibration.add_flipper(f, flippers[f].get_trained_mask_contours(), flippers[f].combined_mask)
+    background.save(calibration)
+    HitTable([(f, flippers[f]) for f in FLIPPERS], width, height).build().save(calibration)
+    return (calibration, presses)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('video', help='Recording with flippers pressed several times each (12 is best)')
+    parser.add_argument('--save-calibration', default='./tmp/calibration.bin', help='Where to write calibration')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='Worker processes (all cores by default)')
+    parser.add_argument('--region-a', help='Where flipper A (right) is: "x,y,w,h" in pixels, bottom right third by default')
+    parser.add_argument('--region-b', help='Where flipper B (left) is: "x,y,w,h" in pixels, bottom left third by default')
+    parser.add_argument('--min-motion', type=float, default=0.015,
+                        help='''Share of the region that has to change between two frames to count as flipper moving.
+                            Ball is a lot smaller than that''')
+    parser.add_argument('--min-presses', type=int, default=6, help='Fewest presses of each flipper to train from')
+    args = parser.parse_args()
+
+    capture = cv2.VideoCapture(args.video)
+    (width, height) = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    seconds = capture.get(cv2.CAP_PROP_FRAME_COUNT) / (capture.get(cv2.CAP_PROP_FPS) or 30.0)
+    capture.release()
+    regions = default_regions(width, height)
+    for (f, text) in (('A', args.region_a), ('B', args.region_b)):
+        if text:
+            regions[f] = RegionOfInterest.parse(text, width, height)
+
+    started = clock()
+    try:
+        (calibration, presses) = calibrate(args.video, regions, args.jobs, min_motion=args.min_motion,
+                                           min_presses=args.min_presses)
+    except ValueError as e:
+        parser.exit(1, "{}\n".format(e))
+    elapsed = clock() - started
+    for (f, option) in (('A', '--debug-right'), ('B', '--debug-left')):
+        # Stream counts frames from 1
+        print("Flipper {}: {} presses, {} {}".format(f, len(presses[f]), option,
+                                                     ','.join(str(first + 1) for (first, _) in presses[f])))
+    calibration.save(args.save_calibration)
+    print("Calibration saved to {} in {:.1f}s ({:.1f}x real time)".format(
+        args.save_calibration, elapsed, seconds / elapsed if elapsed else 0))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+import collections
+import threading
+from communication import protocol
+from lib.metrics import LatencyHistogram, clock
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+class Actuator(object):
+    """Non-blocking front for `Arduino`: fire commands are queued and sent from a writer thread.
+
+    Firmware echoes command byte back, so a reader thread matches echoes with sent commands and
+    keeps round trip statistics. Port that stops answering, or write that hangs, marks the actuator
+    as stalled instead of holding up the caller. With protocol v2 firmware (see `Arduino.handshake()`),
+    `schedule_press()` fires at exact host clock time, and clock sync is refreshed while idle. Round trip
+    of a scheduled press is taken from its FIRE_ACK, and when it really fired (FIRED) goes to `on_fired`.
+
+    Intended flow is:
+
+        arduino = Actuator(Arduino(port)).start()  # handshake and clock sync first, see connect()
+        while(frame):
+            ...
+            arduino.pressA(100)  # returns immediately
+        print(arduino.round_trip.summary())
+        arduino.close()
+    """
+
+    def __init__(self, arduino, queue_size=8, ack_timeout=0.5, metrics=None, sync_interval=1.0):
+        self.arduino = arduino
+        self.sync_interval = sync_interval
+        # Reader needs to wake up now and then, to notice we're closing
+        self.arduino.serial.timeout = 0.1
+        self.queue = queue.Queue(queue_size)
+        self.ack_timeout = ack_timeout
+        self.metrics = metrics
+        # (command byte, time sent) waiting for echo, oldest first
+        self.pending = collections.deque()
+        # Scheduled fire id -> time sent, waiting for FIRE_ACK, oldest first
+        self.awaiting = collections.OrderedDict()
+        # Called as on_fired(flipper, at, fired) with host clock times, from the reader thread
+        self.on_fired = None
+        self.arduino.listener = self.reply
+        self.lock = threading.Lock()
+        self.round_trip = LatencyHistogram()
+        self.last_round_trip = None  # seconds
+        self.commands_sent = 0
+        self.commands_dropped = 0  # queue was full
+        self.acks_missed = 0  # no echo within ack_timeout
+        self.acks_missed_in_row = 0  # since the last echo, port is stalled while it's not 0
+        self.last_echo = None  # time last echo came back
+        self.writing_since = None  # set while write() is in progress
+        self.error = None  # last exception from serial port
+        self.stopRequest = False
+        self.threads = []
+
+    def connect(self, timeout=0.3):
+        """Asks firmware for its protocol version, and syncs clocks with v2 firmware. Has to run before reader
+        thread takes the port. Returns the version, or None for legacy firmware (that's what it's taken for if
+        nothing answers within `timeout`, e.g. a board still resetting after the port was opened).
+        """
+        if self.arduino.handshake(timeout) is not None and self.arduino.version >= 2:
+            self.arduino.sync()
+        return self.arduino.version
+
+    def start(self):
+        "Connects (see connect()) and starts writer and reader threads"
+        self.connect()
+        for target in (self.write_loop, self.read_loop):
+            t = threading.Thread(target=target, args=())
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def pressA(self, milliseconds):
+        return self.press('A', milliseconds)
+
+    def pressB(self, milliseconds):
+        return self.press('B', milliseconds)
+
+    def press(self, flipper, milliseconds):
+        "Queues fire command. Returns False if it had to be dropped"
+        try:
+            self.queue.put_nowait((flipper, milliseconds, None))
+            return True
+        except queue.Full:
+            self.commands_dropped += 1
+            return False
+
+    def schedule_press(self, flipper, at, milliseconds):
+        "Queues fire at host clock time `at`. Falls back to immediate press with legacy firmware"
+        if not(self.arduino.clock.is_synced()):
+            return self.press(flipper, milliseconds)
+        try:
+            self.queue.put_nowait((flipper, milliseconds, at))
+            return True
+        except queue.Full:
+            self.commands_dropped += 1
+            return False
+
+    def write_loop(self):
+        send = {'A': self.arduino.pressA, 'B': self.arduino.pressB}
+        last_sync = clock()
+        while not(self.stopRequest):
+            try:
+                (flipper, milliseconds, at) = self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if (self.arduino.version or 0) >= 2 and clock() - last_sync > self.sync_interval:
+                    last_sync = clock()
+                    self.write(self.arduino.send_sync)
+                continue
+            if at is None:
+                # Registered before writing, echo can be back before write() returns
+                command = (ord(flipper), clock())
+                with self.lock:
+                    self.pending.append(command)
+                if self.write(send[flipper], milliseconds) is None:
+                    with self.lock:
+                        if command in self.pending:
+                            self.pending.remove(command)
+                else:
+                    self.commands_sent += 1
+            else:
+                fire_id = self.arduino.next_fire_id()
+                with self.lock:
+                    self.awaiting[fire_id] = clock()
+                if self.write(self.arduino.schedule_press, flipper, at, milliseconds, fire_id) is None:
+                    with self.lock:
+                        self.awaiting.pop(fire_id, None)
+                else:
+                    self.commands_sent += 1
+
+    def write(self, function, *args):
+        "Returns time written, or None if it failed"
+        self.writing_since = clock()
+        try:
+            function(*args)
+        except Exception as e:
+            self.error = e
+            return None
+        finally:
+            sent = clock()
+            self.writing_since = None
+        return sent
+
+    def read_loop(self):
+        while not(self.stopRequest):
+            try:
+                data = self.arduino.serial.read(1)
+            except Exception as e:
+                self.error = e
+                return
+            now = clock()
+            self.expire(now)
+            # Frames (protocol v2 replies) are handled by Arduino, only legacy echoes are left
+            for byte in self.arduino.feed(data):
+                self.match(byte, now)
+
+    def match(self, byte, now):
+        with self.lock:
+            # Echoes come back in order, anything before the matching command got lost
+            while self.pending:
+                (command, sent) = self.pending.popleft()
+                if command == byte:
+                    self.__acknowledged(sent, now)
+                    break
+                self.acks_missed += 1
+                self.acks_missed_in_row += 1
+
+    def reply(self, kind, fire_id, entry):
+        "Protocol v2 replies to scheduled presses, see `Arduino.listener`"
+        if kind == protocol.FIRE_ACK:
+            with self.lock:
+                sent = self.awaiting.pop(fire_id, None)
+                if sent is not None:
+                    self.__acknowledged(sent, entry['acked'])
+        elif kind == protocol.FIRED:
+            if self.metrics is not None:
+                # How far from the time asked for, clock sync error mostly
+                self.metrics.record('schedule_error', abs(entry['fired'] - entry['at']))
+            if self.on_fired is not None:
+                self.on_fired(entry['flipper'], entry['at'], entry['fired'])
+
+    def __acknowledged(self, sent, now):
+        self.last_round_trip = now - sent
+        self.last_echo = now
+        self.acks_missed_in_row = 0
+        self.round_trip.record(self.last_round_trip)
+        if self.metrics is not None:
+            self.metrics.record('serial_round_trip', self.last_round_trip)
+
+    def expire(self, now):
+        with self.lock:
+            while self.pending and now - self.pending[0][1] > self.ack_timeout:
+                self.pending.popleft()
+                self.acks_missed += 1
+                self.acks_missed_in_row += 1
+            while self.awaiting and now - next(iter(self.awaiting.values())) > self.ack_timeout:
+                self.awaiting.popitem(last=False)
+                self.acks_missed += 1
+                self.acks_missed_in_row += 1
+
+    def is_stalled(self):
+        """True if port errored out, write is hanging, or commands stopped being echoed.
+
+        Missing echoes count until the next one comes back, expire() only takes them off `pending`.
+        """
+        if self.error is not None:
+            return True
+        now = clock()
+        if self.writing_since is not None and now - self.writing_since > self.ack_timeout:
+            return True
+        with self.lock:
+            oldest = [sent for (_, sent) in list(self.pending)[:1]] + list(self.awaiting.values())[:1]
+            return self.acks_missed_in_row > 0 or any(now - sent > self.ack_timeout for sent in oldest)
+
+    def protocol(self):
+        "What firmware talks, for the console"
+        if (self.arduino.version or 0) < 2:
+            return "legacy protocol, flippers fire when command arrives"
+        if not(self.arduino.clock.is_synced()):
+            return "protocol v{}, clock sync failed, flippers fire when command arrives".format(self.arduino.version)
+        return "protocol v{}, clock synced ({:.1f}ms round trip), flippers fire on schedule".format(
+            self.arduino.version, self.arduino.clock.round_trip() * 1000)
+
+    def latency(self):
+        "Median round trip in milliseconds, or None if nothing was measured yet"
+        if self.round_trip.count == 0:
+            return None
+        return self.round_trip.percentile(50) / 1000.0
+
+    def close(self):
+        self.stopRequest = True
+        for t in self.threads:
+            t.join(1)
+        self.arduino.close()
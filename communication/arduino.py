@@ -1,5 +1,8 @@
 import serial
 import math
+import itertools
+from communication import protocol
+from lib.metrics import clock
 
 
 class Arduino(object):
@@ -7,12 +10,104 @@ class Arduino(object):
 
     def __init__(self, port, baud=115200):
         self.serial = serial.Serial(port, baud)
+        self.reset_protocol()
+
+    def reset_protocol(self):
+        "Forgets everything known about the other side, e.g. after board reset"
+        self.parser = protocol.Parser()
+        self.version = None  # protocol version, known after handshake()
+        self.clock = protocol.ClockSync()
+        self.sync_sent = {}  # seq -> host time SYNC was written
+        self.sync_seq = itertools.count()
+        self.fire_ids = itertools.count()
+        # id -> {'flipper', 'at', 'duration', 'sent', 'status', 'acked', 'fired'}, times in host clock
+        self.scheduled = {}
+        # Called as listener(kind, id, entry of `scheduled`) on FIRE_ACK and FIRED, from whoever reads the port
+        self.listener = None
 
     def pressA(self, milliseconds):
-        self.serial.write('A' + chr(int(math.ceil(milliseconds/10))))
+        self.serial.write(bytearray([ord('A'), int(math.ceil(milliseconds/10.0))]))
 
     def pressB(self, milliseconds):
-        self.serial.write('B' + chr(int(math.ceil(milliseconds/10))))
+        self.serial.write(bytearray([ord('B'), int(math.ceil(milliseconds/10.0))]))
+
+    def handshake(self, timeout=0.3):
+        "Asks firmware for its protocol version. Returns it, or None for legacy firmware that does not answer"
+        self.serial.write(protocol.encode(protocol.HELLO))
+        if not(self.wait(lambda: self.version is not None, timeout)):
+            # Legacy firmware echoes HELLO back. Its START byte would open a frame that swallows the next
+            # command echo, so everything that came back is dropped
+            self.serial.reset_input_buffer()
+            self.parser = protocol.Parser()
+        return self.version
+
+    def send_sync(self):
+        "Sends one clock sync request, reply is picked up by feed()"
+        seq = next(self.sync_seq) % 256
+        self.sync_sent[seq] = clock()
+        self.serial.write(protocol.encode(protocol.SYNC, seq))
+
+    def sync(self, samples=8, timeout=0.2):
+        "Blocking clock synchronization. Returns best round trip (seconds), or None if MCU did not answer"
+        for _ in range(samples):
+            count = len(self.clock.samples)
+            self.send_sync()
+            self.wait(lambda: len(self.clock.samples) > count, timeout)
+        return self.clock.round_trip()
+
+    def next_fire_id(self):
+        return next(self.fire_ids) % 256
+
+    def schedule_press(self, flipper, at, duration, fire_id=None):
+        """Asks MCU to fire `flipper` ('A' or 'B') at host clock time `at` (see `lib.metrics.clock`), for
+        `duration` milliseconds. Needs handshake() and sync() first. Returns id, to look up in `self.scheduled`.
+        """
+        if fire_id is None:
+            fire_id = self.next_fire_id()
+        self.scheduled[fire_id] = {'flipper': flipper, 'at': at, 'duration': duration, 'sent': clock(),
+                                   'status': None, 'acked': None, 'fired': None}
+        self.serial.write(protocol.encode(protocol.FIRE, ord(flipper), self.clock.to_mcu(at),
+                                          int(duration), fire_id))
+        return fire_id
+
+    def feed(self, data):
+        "Handles bytes read from the port. Returns legacy echo bytes that were not part of any frame"
+        echoes = []
+        for event in self.parser.feed(data):
+            if event[0] == 'echo':
+                echoes.append(event[1])
+            else:
+                self.handle(event[1], event[2])
+        return echoes
+
+    def handle(self, kind, values):
+        received = clock()
+        if kind == protocol.HELLO_REPLY:
+            self.version = values[0]
+        elif kind == protocol.SYNC_REPLY:
+            sent = self.sync_sent.pop(values[0], None)
+            if sent is not None:
+                self.clock.add(sent, received, values[1])
+        elif kind == protocol.FIRE_ACK and values[0] in self.scheduled:
+            self.scheduled[values[0]].update(status=values[1], acked=received)
+        elif kind == protocol.FIRED and values[0] in self.scheduled:
+            self.scheduled[values[0]]['fired'] = self.clock.to_host(values[1])
+        else:
+            return
+        if self.listener is not None and kind in (protocol.FIRE_ACK, protocol.FIRED):
+            self.listener(kind, values[0], self.scheduled[values[0]])
+
+    def wait(self, condition, timeout):
+        "Reads the port until `condition()` is true or `timeout` passes. Only while nobody else reads it"
+        deadline = clock() + timeout
+        original = self.serial.timeout
+        try:
+            while not(condition()) and clock() < deadline:
+                self.serial.timeout = max(0.001, deadline - clock())
+                self.feed(self.serial.read(1))
+        finally:
+            self.serial.timeout = original
+        return condition()
 
     def close(self):
         if (self.serial):
@@ -0,0 +1,189 @@
+import threading
+from time import sleep
+from communication import protocol
+from communication.arduino import Arduino
+from lib.metrics import clock
+
+# Firmware constants, see Arduino/config.h
+LONG_ENGAGE_MS = 300
+
+
+class FirmwareEmulator(object):
+    """Host side model of Arduino/Arduino.ino timing, driven by explicit timestamps (seconds).
+
+    Mirrors the firmware: bytes are acted on as they arrive over the wire (legacy commands once
+    both bytes are in, frames once complete), legacy commands are echoed right away, and every
+    solenoid is released by its own timer, so A and B can be held at the same time and a new
+    command restarts the hold. Scheduled fires (protocol v2) happen at MCU time, which runs
+    `mcu_offset` seconds ahead of host clock, `mcu_rate` times faster.
+    """
+
+    def __init__(self, baud=115200, loop_time=0.00005, mcu_offset=0.0, mcu_rate=1.0):
+        # 8N1: 10 bits on the wire per byte
+        self.byte_time = 10.0 / baud
+        self.loop_time = loop_time  # how long a loop() pass takes
+        self.mcu_offset = mcu_offset
+        self.mcu_rate = mcu_rate
+        self.incoming = []  # (time byte is fully received, byte)
+        self.outgoing = []  # (time byte is fully sent back, byte)
+        self.engaged = {'A': None, 'B': None}  # (started, until) in seconds
+        self.scheduled = {'A': None, 'B': None}  # (fire at, hold seconds, id)
+        self.events = []  # (time, flipper, True for engaged/False for released)
+        self.wire_free = 0.0
+        self.out_wire_free = 0.0
+        self.legacy = None  # first byte of legacy command, while waiting for the second
+        self.frame = None  # frame bytes after START, while receiving one
+
+    def mcu_micros(self, now):
+        return int((now + self.mcu_offset) * 1000000 * self.mcu_rate) % protocol.WRAP
+
+    def receive(self, data, now):
+        "Host wrote `data` at `now`"
+        start = max(now, self.wire_free)
+        for (i, byte) in enumerate(bytearray(data)):
+            self.incoming.append((start + (i + 1) * self.byte_time, byte))
+        self.wire_free = start + len(bytearray(data)) * self.byte_time
+
+    def button(self, flipper, now):
+        "Physical button pressed at `now`"
+        self.update(now)
+        self.engage(flipper, now + self.loop_time, LONG_ENGAGE_MS / 1000.0)
+
+    def update(self, now):
+        "Runs firmware up to `now`"
+        while self.incoming and self.incoming[0][0] + self.loop_time <= now:
+            (at, byte) = self.incoming.pop(0)
+            at += self.loop_time
+            self.advance(at)
+            self.read_byte(byte, at)
+        self.advance(now)
+
+    def advance(self, now):
+        "Runs scheduled fires and releases, in order, up to `now`"
+        while True:
+            fires = [(s[0], f) for (f, s) in self.scheduled.items() if s is not None and s[0] <= now]
+            releases = [(h[1], f) for (f, h) in self.engaged.items() if h is not None and h[1] <= now]
+            if not(fires or releases):
+                return
+            (fire, release) = (min(fires) if fires else None, min(releases) if releases else None)
+            if fire is not None and (release is None or fire[0] < release[0]):
+                (at, flipper) = fire
+                (_, hold, fire_id) = self.scheduled[flipper]
+                self.scheduled[flipper] = None
+                self.engage(flipper, at, hold)
+                self.send(protocol.encode(protocol.FIRED, fire_id, self.mcu_micros(at)), at)
+            else:
+                (at, flipper) = release
+                self.events.append((at, flipper, False))
+                self.engaged[flipper] = None
+
+    def read_byte(self, byte, at):
+        if self.frame is not None:
+            self.frame.append(byte)
+            if len(self.frame) == 2 and self.frame[1] > protocol.MAX_PAYLOAD:
+                self.frame = None
+            elif len(self.frame) >= 3 and len(self.frame) == self.frame[1] + 3:
+                (kind, payload) = (self.frame[0], self.frame[2:-1])
+                if protocol.checksum(kind, payload) == self.frame[-1]:
+                    self.handle_frame(kind, payload, at)
+                self.frame = None
+        elif self.legacy is not None:
+            command = chr(self.legacy)
+            self.legacy = None
+            if command in 'aAbB':
+                self.engage(command.upper(), at, byte * 10 / 1000.0)
+            self.send(bytearray([ord(command)]), at)
+        elif byte == protocol.START:
+            self.frame = bytearray()
+        else:
+            self.legacy = byte
+
+    def handle_frame(self, kind, payload, at):
+        if kind == protocol.HELLO:
+            self.send(protocol.encode(protocol.HELLO_REPLY, protocol.VERSION), at)
+        elif kind == protocol.SYNC and len(payload) >= 1:
+            self.send(protocol.encode(protocol.SYNC_REPLY, payload[0], self.mcu_micros(at)), at)
+        elif kind == protocol.FIRE and len(payload) >= 8:
+            (flipper, fire_at, hold, fire_id) = protocol.decode(protocol.FIRE, payload)
+            # Signed distance on the wrapping MCU clock, same as the firmware does
+            delta = (fire_at - self.mcu_micros(at)) % protocol.WRAP
+            if delta >= protocol.WRAP // 2:
+                delta -= protocol.WRAP
+            status = protocol.ACK_LATE if delta < 0 else protocol.ACK_OK
+            flipper = chr(flipper)
+            if flipper in self.scheduled:
+                when = at + max(delta, 0) / 1000000.0 / self.mcu_rate
+                self.scheduled[flipper] = (when, hold / 1000.0, fire_id)
+            else:
+                status = protocol.ACK_INVALID
+            self.send(protocol.encode(protocol.FIRE_ACK, fire_id, status), at)
+
+    def send(self, data, at):
+        start = max(at, self.out_wire_free)
+        for (i, byte) in enumerate(bytearray(data)):
+            self.outgoing.append((start + (i + 1) * self.byte_time, byte))
+        self.out_wire_free = start + len(bytearray(data)) * self.byte_time
+
+    def engage(self, flipper, at, length):
+        if self.engaged[flipper] is None:
+            self.events.append((at, flipper, True))
+        self.engaged[flipper] = (at, at + length)
+
+    def is_engaged(self, flipper, now):
+        self.update(now)
+        return self.engaged[flipper] is not None
+
+    def read(self, now):
+        "Bytes that made it back to the host by `now`"
+        self.update(now)
+        ready = bytearray(b for (at, b) in self.outgoing if at <= now)
+        self.outgoing = [(at, b) for (at, b) in self.outgoing if at > now]
+        return bytes(ready)
+
+
+class EmulatedSerial(object):
+    "Just enough of `serial.Serial` for `Arduino`/`Actuator`, backed by `FirmwareEmulator` on real clock"
+
+    def __init__(self, emulator=None, timeout=None):
+        self.emulator = emulator or FirmwareEmulator()
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.buffer = b''
+        self.closed = False
+
+    def write(self, data):
+        with self.lock:
+            self.emulator.receive(data, clock())
+        return len(data)
+
+    def read(self, size=1):
+        deadline = None if self.timeout is None else clock() + self.timeout
+        while not(self.closed):
+            with self.lock:
+                self.buffer += self.emulator.read(clock())
+                if len(self.buffer) >= size:
+                    (data, self.buffer) = (self.buffer[:size], self.buffer[size:])
+                    return data
+            if deadline is not None and clock() >= deadline:
+                with self.lock:
+                    (data, self.buffer) = (self.buffer, b'')
+                return data
+            # Bytes trickle in at ~87us each at 115200 baud
+            sleep(0.0001)
+        return b''
+
+    def reset_input_buffer(self):
+        with self.lock:
+            self.emulator.read(clock())
+            self.buffer = b''
+
+    def close(self):
+        self.closed = True
+
+
+class EmulatedArduino(Arduino):
+    "`Arduino` talking to an emulated board instead of a serial port"
+
+    def __init__(self, emulator=None):
+        self.serial = EmulatedSerial(emulator)
+        self.reset_protocol()
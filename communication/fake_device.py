@@ -0,0 +1,56 @@
+import os
+import pty
+import select
+import threading
+import tty
+from communication.emulator import FirmwareEmulator
+from lib.metrics import clock
+
+
+class FakeDevice(object):
+    """Emulated Arduino behind a pseudo terminal, so real `serial.Serial` code can talk to it.
+
+        device = FakeDevice().start()
+        arduino = Arduino(device.port)
+        arduino.handshake()
+        ...
+        device.stop()
+    """
+
+    def __init__(self, emulator=None, poll=0.0005):
+        self.emulator = emulator or FirmwareEmulator()
+        self.poll = poll
+        (self.master, self.slave) = pty.openpty()
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.stopRequest = False
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def run(self):
+        while not(self.stopRequest):
+            (readable, _, _) = select.select([self.master], [], [], self.poll)
+            if readable:
+                try:
+                    data = os.read(self.master, 256)
+                except OSError:
+                    return
+                self.emulator.receive(data, clock())
+            reply = self.emulator.read(clock())
+            if reply:
+                os.write(self.master, reply)
+
+    def stop(self):
+        self.stopRequest = True
+        if self.thread is not None:
+            self.thread.join(1)
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
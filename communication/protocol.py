@@ -0,0 +1,158 @@
+"""Binary protocol (version 2) between host and Arduino, next to the legacy two byte commands.
+
+Legacy command: 'A' or 'B', then hold time in 10ms units. Firmware echoes the first byte.
+
+Framed message: START, kind, payload length, payload, checksum (XOR of kind, length and payload).
+START can't be a legacy command byte, so both kinds of messages can share the line. All integers are
+little endian, MCU times are `micros()` values, so they wrap around every ~71 minutes.
+
+Host -> MCU:
+    HELLO                                   -> HELLO_REPLY (version)
+    SYNC (seq)                              -> SYNC_REPLY (seq, mcu micros)
+    FIRE (flipper, at micros, hold ms, id)  -> FIRE_ACK (id, status), then FIRED (id, mcu micros) when it fires
+"""
+
+import struct
+
+VERSION = 2
+START = 0xA5
+MAX_PAYLOAD = 16
+
+HELLO = 0x01
+SYNC = 0x02
+FIRE = 0x03
+HELLO_REPLY = 0x81
+SYNC_REPLY = 0x82
+FIRE_ACK = 0x83
+FIRED = 0x84
+
+# FIRE_ACK statuses
+ACK_OK = 0
+ACK_LATE = 1  # requested time already passed, fired right away
+ACK_INVALID = 2  # unknown flipper
+
+FORMATS = {
+    HELLO: '<',
+    SYNC: '<B',
+    FIRE: '<BIHB',
+    HELLO_REPLY: '<B',
+    SYNC_REPLY: '<BI',
+    FIRE_ACK: '<BB',
+    FIRED: '<BI',
+}
+
+WRAP = 1 << 32
+
+
+def checksum(kind, payload):
+    value = kind ^ len(payload)
+    for b in bytearray(payload):
+        value ^= b
+    return value
+
+
+def encode(kind, *values):
+    payload = struct.pack(FORMATS[kind], *values)
+    return bytes(bytearray([START, kind, len(payload)]) + bytearray(payload) +
+                 bytearray([checksum(kind, payload)]))
+
+
+def decode(kind, payload):
+    return struct.unpack(FORMATS[kind], bytes(payload))
+
+
+class Parser(object):
+    """Splits incoming byte stream into frames and loose (legacy echo) bytes.
+
+    `feed()` returns list of events: ('echo', byte) or ('frame', kind, values).
+    """
+
+    def __init__(self):
+        self.buffer = None  # None when outside of a frame
+        self.errors = 0
+
+    def feed(self, data):
+        events = []
+        for b in bytearray(data):
+            if self.buffer is None:
+                if b == START:
+                    self.buffer = bytearray()
+                else:
+                    events.append(('echo', b))
+                continue
+            self.buffer.append(b)
+            if len(self.buffer) == 2 and self.buffer[1] > MAX_PAYLOAD:
+                self.errors += 1
+                self.buffer = None
+            elif len(self.buffer) >= 3 and len(self.buffer) == self.buffer[1] + 3:
+                (kind, payload) = (self.buffer[0], self.buffer[2:-1])
+                if checksum(kind, payload) != self.buffer[-1] or kind not in FORMATS:
+                    self.errors += 1
+                else:
+                    try:
+                        events.append(('frame', kind, decode(kind, payload)))
+                    except struct.error:
+                        self.errors += 1
+                self.buffer = None
+        return events
+
+
+class ClockSync(object):
+    """Maps host clock (seconds, `lib.metrics.clock`) to MCU `micros()` and back.
+
+    Every SYNC round trip gives a sample: MCU time was read somewhere between sending and receiving,
+    so we take the middle, and trust samples with the shortest round trips most (Cristian's algorithm).
+    With samples spread over time, MCU clock rate is fitted as well, so drift is absorbed.
+    """
+
+    def __init__(self, max_samples=32):
+        self.max_samples = max_samples
+        self.samples = []  # (host middle, unwrapped mcu micros, round trip)
+        self.host_ref = None
+        self.mcu_ref = None
+        self.rate = 1.0  # MCU microseconds per host microsecond
+
+    def add(self, sent, received, mcu_micros):
+        middle = (sent + received) / 2.0
+        if self.samples:
+            # Unwrap relative to previous sample
+            (last_host, last_mcu, _) = self.samples[-1]
+            expected = last_mcu + (middle - last_host) * 1000000 * self.rate
+            mcu_micros += WRAP * round((expected - mcu_micros) / float(WRAP))
+        self.samples.append((middle, mcu_micros, received - sent))
+        if len(self.samples) > self.max_samples:
+            self.samples.pop(0)
+        self.__fit()
+
+    def __fit(self):
+        best = min(s[2] for s in self.samples)
+        good = [s for s in self.samples if s[2] <= best * 2 + 0.0002]
+        (host_ref, mcu_ref) = (good[-1][0], good[-1][1])
+        span = good[-1][0] - good[0][0]
+        if len(good) >= 2 and span > 0.5:
+            n = float(len(good))
+            mean_h = sum(s[0] for s in good) / n
+            mean_m = sum(s[1] for s in good) / n
+            var = sum((s[0] - mean_h) ** 2 for s in good)
+            cov = sum((s[0] - mean_h) * (s[1] - mean_m) for s in good)
+            self.rate = cov / var / 1000000
+            (host_ref, mcu_ref) = (mean_h, mean_m)
+        (self.host_ref, self.mcu_ref) = (host_ref, mcu_ref)
+
+    def is_synced(self):
+        return self.host_ref is not None
+
+    def round_trip(self):
+        "Shortest seen round trip (seconds)"
+        return min(s[2] for s in self.samples) if self.samples else None
+
+    def to_mcu(self, host):
+        "Host clock time to MCU micros() value"
+        return int(round(self.mcu_ref + (host - self.host_ref) * 1000000 * self.rate)) % WRAP
+
+    def to_host(self, mcu_micros):
+        "MCU micros() value (assumed to be within ~35 minutes from last sync) to host clock time"
+        delta = (mcu_micros - int(round(self.mcu_ref))) % WRAP
+        if delta >= WRAP // 2:
+            delta -= WRAP
+        return self.host_ref + delta / 1000000.0 / self.rate
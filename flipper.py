@@ -1,5 +1,6 @@
 import cv2
 import collections
+import threading
 import numpy
 
 class Flipper(object):
@@ -29,22 +30,46 @@ class Flipper(object):
     def __init__(self, name=None, num_masks=12, min_effective=8):
         self.name = name
         self.effective_areas = []
-        self.masks = []  # Storing masks here
+        self.masks = collections.deque()  # Storing masks here, as 0/1, newest last
+        self.counts = None  # uint16 per pixel sum of `self.masks`, updated as masks come and go
+        self.lock = threading.Lock()  # guards masks and counts while retraining in the background
+        self.retraining = None  # background retrain thread, see retrain_async()
         self.num_masks = num_masks  # Number of masks to train on
         self.min_effective = min_effective  # Minimum number of occurrences we need to see to treat this as effective area
         # make contours a circullar buffer, so it will not cause memory leaks
         self.contours = collections.deque(maxlen=50)
         self.mask_contours = []
+        self.combined_mask = None  # Pixels that moved in at least `min_effective` masks
         self.hull_mask = None  # This will hold final trained areas hull contours filled.
+        # Same hulls as plain float polygons plus (x0, y0, x1, y1) bounds, for geometric hit tests
+        self.hull_polygons = []
+        self.hull_bounds = []
+        # (polygon, bounds) pairs, swapped as a whole so retraining never leaves hit test half updated
+        self.hulls = []
 
     def add_contour(self, contour):
         self.contours.append(contour)
 
-    def add_mask(self, mask):
-        mask[mask > 0] = 1
-        self.masks.insert(0, mask)
-        if (len(self.masks) > self.num_masks):
-            self.masks.pop()
+    def add_mask(self, mask, offset=(0, 0), shape=None):
+        """Adds motion mask to the rolling accumulator. Caller's mask is not modified.
+
+        Mask can be a crop (e.g. region of interest) placed at `offset` of a full frame of `shape`.
+        Costs one add and one subtract of a frame, no matter how many masks are kept.
+        """
+        m = (mask > 0).astype(numpy.uint8)
+        if shape is not None and m.shape != tuple(shape[:2]):
+            full = numpy.zeros(shape[:2], dtype=numpy.uint8)
+            (x, y) = offset
+            full[y:y + m.shape[0], x:x + m.shape[1]] = m
+            m = full
+        with self.lock:
+            if self.counts is None or self.counts.shape != m.shape:
+                self.counts = numpy.zeros(m.shape, dtype=numpy.uint16)
+                self.masks.clear()
+            self.masks.append(m)
+            self.counts += m
+            if (len(self.masks) > self.num_masks):
+                self.counts -= self.masks.popleft()
 
     def train(self):
         areas = self.__analyze_contours()
@@ -58,37 +83,67 @@ class Flipper(object):
         print("Training mask with %d elements" % len(self.masks))
         if (len(self.masks) < self.num_masks):
             return False
-        # initialize mask with all zeroes
-        self.combined_mask = numpy.zeros_like(self.masks[0])
-        for m in self.masks:
-            # All masks are 0 and 1, while allowing all the way up to 255
-            self.combined_mask = self.combined_mask + m
-        self.combined_mask[self.combined_mask >= self.min_effective] = 255
-        self.combined_mask[self.combined_mask < 255] = 0
+        self.combined_mask = self.__threshold()
         return self.is_good_mask()
 
+    def retrain_async(self):
+        """Retrains hulls from current masks on a background thread, for use during the game.
+
+        New hulls replace old ones only if training succeeded. Does nothing (returns False) if not
+        enough masks yet, or previous retrain is still running.
+        """
+        if len(self.masks) < self.num_masks or (self.retraining is not None and self.retraining.is_alive()):
+            return False
+        self.retraining = threading.Thread(target=self.__retrain, args=())
+        self.retraining.daemon = True
+        self.retraining.start()
+        return True
+
+    def __retrain(self):
+        combined = self.__threshold()
+        hulls = self.__build_hulls(combined)
+        if hulls is not None:
+            self.combined_mask = combined
+            self.__set_hulls(*hulls)
+
+    def __threshold(self):
+        with self.lock:
+            return numpy.where(self.counts >= self.min_effective, 255, 0).astype(numpy.uint8)
+
     def is_good(self):
         return len(self.effective_areas) > 0
 
     def is_good_mask(self):
+        print("Min size: %d" % (self.combined_mask.size/500))
+        hulls = self.__build_hulls(self.combined_mask)
+        if hulls is None:
+            # If we didn't find any large enough contours, seems like our training is unsuccessful
+            self.__set_hulls([], numpy.zeros_like(self.combined_mask))
+            return False
+        self.__set_hulls(*hulls)
+        return True
+
+    def __build_hulls(self, combined_mask):
+        "Returns (hull contours, filled hull mask) from combined mask, or None if there are no large enough areas"
         # minimum area that should be considered OK
-        min_size = self.combined_mask.size/500
-        print("Min size: %d" % min_size)
-        (_, contours, _) = cv2.findContours(self.combined_mask.copy(),
+        min_size = combined_mask.size/500
+        (_, contours, _) = cv2.findContours(combined_mask.copy(),
                                             cv2.RETR_EXTERNAL,
                                             cv2.CHAIN_APPROX_SIMPLE)
-        self.mask_contours = []
-        self.hull_mask = numpy.zeros_like(self.combined_mask)
-        for c in contours:
-            if (cv2.contourArea(c) > min_size):
-                self.mask_contours.append(cv2.convexHull(c))
-        # If we didn't find any large enough contours, seems like our training is unsuccessful
-        if len(self.mask_contours) > 0:
-            # draw final convex hull contours, and fill them
-            cv2.drawContours(self.hull_mask, self.mask_contours, -1, 255, -1)
-            return True
-        else:
-            return False
+        mask_contours = [cv2.convexHull(c) for c in contours if cv2.contourArea(c) > min_size]
+        if len(mask_contours) == 0:
+            return None
+        # draw final convex hull contours, and fill them
+        hull_mask = numpy.zeros_like(combined_mask)
+        cv2.drawContours(hull_mask, mask_contours, -1, 255, -1)
+        return (mask_contours, hull_mask)
+
+    def __set_hulls(self, mask_contours, hull_mask):
+        polygons = [c.reshape(-1, 2).astype(numpy.float64) for c in mask_contours]
+        bounds = [numpy.concatenate((p.min(axis=0), p.max(axis=0))) for p in polygons]
+        (self.mask_contours, self.hull_polygons, self.hull_bounds) = (mask_contours, polygons, bounds)
+        self.hulls = list(zip(polygons, bounds))
+        self.hull_mask = hull_mask
 
     def get_hull_mask(self):
         print(self.hull_mask)
@@ -99,6 +154,14 @@ class Flipper(object):
         print(self.combined_mask)
         return
 
+    def load_hulls(self, mask_contours, shape):
+        "Restores trained hulls (e.g. from `lib.calibration`) for (height, width) frame. Returns True if there are any"
+        mask_contours = [numpy.asarray(c, dtype=numpy.int32).reshape(-1, 1, 2) for c in mask_contours]
+        hull_mask = numpy.zeros(shape, dtype=numpy.uint8)
+        cv2.drawContours(hull_mask, mask_contours, -1, 255, -1)
+        self.__set_hulls(mask_contours, hull_mask)
+        return len(mask_contours) > 0
+
     def get_trained_mask_contours(self):
         return self.mask_contours
 
@@ -115,16 +178,37 @@ class Flipper(object):
         return False
 
     def check_line(self, p1, p2, line_thick=1):
-        if self.hull_mask is None:
-            return False
+        return bool(self.check_lines([(p1[0], p1[1], p2[0], p2[1])], line_thick)[0])
 
-        line = numpy.zeros_like(self.hull_mask)
-        cv2.line(line, p1, p2, 255, line_thick)
-        if (numpy.count_nonzero(numpy.logical_and(line, self.hull_mask)) > 0):
-            return True
+    def check_lines(self, segments, thickness=1):
+        """Checks a batch of line segments against trained hulls.
 
-        # By default, it's false
-        return False
+        `segments` is anything that reshapes into (N, 4) rows of x0, y0, x1, y1. A segment hits
+        when it comes within `thickness`/2 pixels of any hull, same as drawing it with cv2.line
+        and overlapping with `self.hull_mask`, but without touching any full-frame arrays.
+        Returns boolean array of N elements.
+        """
+        segments = numpy.asarray(segments, dtype=numpy.float64).reshape(-1, 4)
+        hits = numpy.zeros(len(segments), dtype=bool)
+        hulls = self.hulls
+        if len(hulls) == 0 or len(segments) == 0:
+            return hits
+
+        radius = thickness / 2.0
+        p = segments[:, 0:2]
+        q = segments[:, 2:4]
+        seg_min = numpy.minimum(p, q) - radius
+        seg_max = numpy.maximum(p, q) + radius
+        for (polygon, bounds) in hulls:
+            # Cheap bounding box rejection first, only survivors get the exact test
+            candidates = (~hits &
+                          (seg_max[:, 0] >= bounds[0]) & (seg_min[:, 0] <= bounds[2]) &
+                          (seg_max[:, 1] >= bounds[1]) & (seg_min[:, 1] <= bounds[3]))
+            if not candidates.any():
+                continue
+            idx = numpy.flatnonzero(candidates)
+            hits[idx] = segments_touch_polygon(p[idx], q[idx], polygon, radius)
+        return hits
 
     def __analyze_contours(self):
         """Reads stored contours, analyze overlap, and produces effective
@@ -140,6 +224,51 @@ class Flipper(object):
         return overlaps
 
 
+def _cross(o, a, b):
+    "Z component of (a - o) x (b - o), broadcasting over leading dimensions"
+    return (a[..., 0] - o[..., 0]) * (b[..., 1] - o[..., 1]) - (a[..., 1] - o[..., 1]) * (b[..., 0] - o[..., 0])
+
+
+def _point_segment_distance(pt, a, b):
+    "Distance from points `pt` to segments `a`-`b`, broadcasting over leading dimensions"
+    ab = b - a
+    length_sq = (ab ** 2).sum(axis=-1)
+    t = ((pt - a) * ab).sum(axis=-1) / numpy.maximum(length_sq, 1e-12)
+    t = numpy.clip(t, 0.0, 1.0)
+    closest = a + ab * t[..., numpy.newaxis]
+    return numpy.sqrt(((pt - closest) ** 2).sum(axis=-1))
+
+
+def segments_touch_polygon(p, q, polygon, radius=0.0):
+    """Checks which of the segments `p`-`q` ((N, 2) arrays) come within `radius` of convex `polygon` ((E, 2) array).
+
+    Cost is O(N * E), independent of the frame size.
+    """
+    p = p[:, numpy.newaxis, :]
+    q = q[:, numpy.newaxis, :]
+    a = polygon[numpy.newaxis, :, :]
+    b = numpy.roll(polygon, -1, axis=0)[numpy.newaxis, :, :]
+
+    # Segment fully inside: start point is on the same side of every edge
+    side = _cross(a, b, p)
+    inside = numpy.all(side >= 0, axis=1) | numpy.all(side <= 0, axis=1)
+
+    # Proper crossing of any edge
+    d1 = side
+    d2 = _cross(a, b, q)
+    d3 = _cross(p, q, a)
+    d4 = _cross(p, q, b)
+    crossing = numpy.any((d1 * d2 < 0) & (d3 * d4 < 0), axis=1)
+
+    # Otherwise closest approach between two segments is at one of the endpoints
+    distance = numpy.minimum(
+        numpy.minimum(_point_segment_distance(p, a, b), _point_segment_distance(q, a, b)),
+        numpy.minimum(_point_segment_distance(a, p, q), _point_segment_distance(b, p, q)))
+    near = numpy.any(distance <= radius, axis=1)
+
+    return inside | crossing | near
+
+
 class Rectangle(object):
     def __init__(self, rect):
         self.rect = rect
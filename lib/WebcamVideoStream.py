@@ -1,29 +1,74 @@
 # import the necessary packages
-from threading import Thread
+from threading import Thread, Condition
 import cv2
-from datetime import datetime
+import numpy
+from datetime import datetime, timedelta
 import os
-from time import sleep
+import sys
+from time import time
+from .metrics import clock, LatencyHistogram
+from .buffers import BufferPool
+from .capture import get_profile
+from .fake_camera import FakeCamera, FAKE_PREFIX
+
+# Drop policies: what to do when a new frame is captured before consumer took the previous one
+DROP_LATEST = 'latest'  # overwrite it, consumer always gets the newest frame (live cameras)
+DROP_NONE = 'lossless'  # hold capture until it's read, every frame gets delivered (video files)
+
 
 class WebcamVideoStream:
-    def __init__(self, src=0):
+    # virtual_clock: for video files, timestamp frames with their position in the video (counted from `epoch`)
+    #   instead of the moment they were read, so processing does not depend on how fast the host is
+    # profile: `lib.capture.CaptureProfile` or its name, for cameras. Source 'fake:<video file>' plays the video
+    #   as a live camera would (`lib.fake_camera.FakeCamera`), to try profiles without one
+    def __init__(self, src=0, drop_policy=None, virtual_clock=False, profile=None):
         # initialize the video camera stream and read the first frame
         # from the stream
+        self.epoch = datetime(2000, 1, 1)
+        self.virtual_clock = False
+        self.profile = None
+        # What camera reported back after the profile was applied
+        self.settings = {}
         if (os.path.isfile(src)):
             # Video file
             self.stream = cv2.VideoCapture(src)
-            self.wait_for_read = True
+            self.drop_policy = drop_policy or DROP_NONE
+            self.virtual_clock = virtual_clock
         else:
             # Webcam
-            self.wait_for_read = False
-            self.stream = cv2.VideoCapture(int(src))
-            self.stream.set(3, 640)  # width
-            self.stream.set(4, 480)  # height
-            self.stream.set(5, 60.0)  # fps
-        (self.grabbed, self.frame) = self.stream.read()
-        self.timestamp = datetime.now()
+            self.drop_policy = drop_policy or DROP_LATEST
+            if str(src).startswith(FAKE_PREFIX):
+                self.stream = FakeCamera(src[len(FAKE_PREFIX):])
+            else:
+                self.stream = cv2.VideoCapture(int(src))
+            self.profile = get_profile(profile)
+            self.settings = self.profile.apply(self.stream)
+        # Frames grabbed and thrown away because newer ones were already waiting in driver queue (profile drain)
+        self.frames_drained = 0
+        # How old frames are when consumer gets them, from capture (or driver timestamp, if profile uses them)
+        self.age = LatencyHistogram()
+        (self.grabbed, self.frame, captured) = self.__capture(None)
+        # Frames are captured into pooled buffers: one being read into, the newest one waiting, and the one
+        # consumer works on. It stays valid until consumer's next read, so nothing is allocated per frame
+        self.pool = None
+        if self.grabbed:
+            self.pool = BufferPool(self.frame.shape, self.frame.dtype, 3)
+            self.frame = self.__pooled(self.frame)
+        # Buffer handed out by the last read()/read_next()
+        self.held = None
+        self.timestamp = self.__get_timestamp(1)
+        # Same moment on monotonic clock, for latency measurements
+        self.captured = captured
         self.frame_number = 1
         self.frame_read = False
+        # Last frame number handed out by read()/read_next()
+        self.frame_delivered = 0
+        # Frames overwritten before anyone read them, and read() calls that returned already seen frame
+        self.frames_dropped = 0
+        self.frames_stale = 0
+        # Guards all of the above, and signals both new frames and consumed frames
+        self.condition = Condition()
+        self.wait_for_read = self.drop_policy == DROP_NONE
 
         # initialize the variable used to indicate if the thread should
         # be stopped
@@ -36,7 +81,10 @@ class WebcamVideoStream:
         try:
             self.stopped = False
             self.stopRequest = False
-            Thread(target=self.update, args=()).start()
+            # Daemon, so an exception in the consumer does not leave the process hanging on it
+            thread = Thread(target=self.update, args=())
+            thread.daemon = True
+            thread.start()
         except (KeyboardInterrupt, SystemExit):
             self.stop()
             sys.exit()
@@ -45,38 +93,139 @@ class WebcamVideoStream:
     def update(self):
         # keep looping infinitely until the thread is stopped
         while True:
-            # if the thread indicator variable is set, stop the thread
-            if self.stopRequest:
-                print("Stream got stop request")
-                self.stream.release()
-                self.stopped = True
-                return
-            # If we need to wait for read, and it was not read yet, keep looping, with a 1ms sleep
-            if self.wait_for_read and not(self.frame_read):
-                sleep(0.001)
-                continue
+            with self.condition:
+                # If we need to wait for read, block until consumer takes the frame (or we're asked to stop)
+                while self.wait_for_read and not(self.frame_read) and not(self.stopRequest):
+                    self.condition.wait()
+                # if the thread indicator variable is set, stop the thread
+                if self.stopRequest:
+                    print("Stream got stop request")
+                    self.stream.release()
+                    self.stopped = True
+                    self.condition.notify_all()
+                    return
             # otherwise, read the next frame from the stream
-            (self.grabbed, self.frame) = self.stream.read()
-            self.timestamp = datetime.now()
-            self.frame_number = self.frame_number + 1
-            self.frame_read = False
-            if not(self.grabbed):
-                self.stopRequest = True
+            buffer = self.pool.acquire('capture') if self.pool is not None else None
+            (grabbed, frame, captured) = self.__capture(buffer)
+            timestamp = self.__get_timestamp(self.frame_number + 1)
+            with self.condition:
+                self.grabbed = grabbed
+                if frame is not buffer or not(grabbed):
+                    # Nothing read, or capture changed frame size and allocated its own
+                    self.__recycle(buffer)
+                if not(self.grabbed):
+                    # End of stream, keep last good frame around and let the loop above shut us down
+                    self.stopRequest = True
+                    continue
+                if not(self.frame_read):
+                    self.frames_dropped += 1
+                if self.frame is not self.held:
+                    # Nobody got the frame we're replacing, it can be captured into again
+                    self.__recycle(self.frame)
+                (self.frame, self.timestamp, self.captured) = (frame, timestamp, captured)
+                self.frame_number = self.frame_number + 1
+                self.frame_read = False
+                self.condition.notify_all()
+
+    def __capture(self, buffer):
+        "Reads next frame into `buffer`, the way profile says. Returns (grabbed, frame, monotonic capture time)"
+        if self.profile is not None and self.profile.drain:
+            (grabbed, frame) = self.stream.retrieve(buffer) if self.__grab_newest() else (False, None)
+        else:
+            (grabbed, frame) = self.stream.read(buffer)
+        captured = clock()
+        if grabbed and self.profile is not None and self.profile.driver_timestamps:
+            # V4L2 stamps buffers on the same monotonic clock when frame was done, which counts time it spent
+            # queued in the driver too. Other backends give something else, that's ignored
+            stamp = self.stream.get(cv2.CAP_PROP_POS_MSEC) / 1000.0
+            if 0 <= captured - stamp < 1.0:
+                captured = stamp
+        return (grabbed, frame, captured)
+
+    def __grab_newest(self):
+        """Grabs frames until one had to be waited for. Frames that came back right away were already sitting
+        in the driver queue, older than the one that follows them, so they're skipped without decoding.
+        """
+        fps = self.settings.get('fps') or self.profile.fps
+        # Waiting for a new frame takes up to a whole interval, handing out a queued one next to nothing
+        quick = 0.25 / fps
+        for n in range(max(self.settings.get('buffer_size') or self.profile.buffer_size or 4, 1) + 1):
+            if n:
+                self.frames_drained += 1
+            start = clock()
+            if not(self.stream.grab()):
+                return False
+            if clock() - start >= quick:
+                break
+        return True
+
+    def __pooled(self, frame):
+        buffer = self.pool.acquire('capture')
+        numpy.copyto(buffer, frame)
+        return buffer
+
+    def __recycle(self, frame):
+        if frame is not None and self.pool is not None and self.pool.owns(frame):
+            self.pool.release(frame)
+
+    def __get_timestamp(self, number):
+        if not(self.virtual_clock):
+            return datetime.now()
+        msec = self.stream.get(cv2.CAP_PROP_POS_MSEC)
+        if msec <= 0 and number > 1:
+            # Container does not know, so go by frame rate
+            msec = (number - 1) * 1000.0 / (self.stream.get(cv2.CAP_PROP_FPS) or 30.0)
+        return self.epoch + timedelta(milliseconds=msec)
 
     def read(self):
+        "Newest frame, even if it was handed out already. Frame is valid until the next read()/read_next()"
+        with self.condition:
+            if self.frame_delivered == self.frame_number:
+                self.frames_stale += 1
+            return self.__deliver()
+
+    def read_next(self, timeout=None):
+        """Blocks until there is a frame we did not hand out yet, or stream is stopped.
+
+        Returns the same dict as `read()`, or None if nothing arrived within `timeout` seconds.
+        Frame buffer is reused once the next frame is read, copy it to keep it longer.
+        """
+        deadline = None if timeout is None else time() + timeout
+        with self.condition:
+            while self.frame_delivered == self.frame_number and not(self.stopped):
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            return self.__deliver()
+
+    def __deliver(self):
+        fresh = self.frame_delivered != self.frame_number
+        if fresh:
+            self.age.record(clock() - self.captured)
         # Mark that we read the frame, so we can grab the next one from the file. Not used for actual camera
         self.frame_read = True
+        self.frame_delivered = self.frame_number
+        # Previous frame consumer had is done with now
+        if self.held is not self.frame:
+            self.__recycle(self.held)
+            self.held = self.frame
+        self.condition.notify_all()
         # return the frame most recently read
+        # Last frame before the stream ended still gets handed out, 'stopped' comes with the next read
         return {
-            'stopped': self.stopped,
+            'stopped': self.stopped and not(fresh),
             'frame': self.frame,
             'number': self.frame_number,
-            'timestamp': self.timestamp
+            'timestamp': self.timestamp,
+            'captured': self.captured
             }
 
     def stop(self):
         # indicate that the thread should be stopped
-        self.stopRequest = True
+        with self.condition:
+            self.stopRequest = True
+            self.condition.notify_all()
 
     def getParam(self, param):
         return self.stream.get(param)
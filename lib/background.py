@@ -0,0 +1,88 @@
+import cv2
+import numpy
+
+
+class BackgroundModel(object):
+    """Reference image of the empty table: per pixel mean and typical noise, learned from still frames.
+
+    Saved with calibration, it lets a restart skip background training. Live frames are compared
+    against it, and if the table still looks the same, subtractor is primed with synthetic frames
+    (reference image plus noise of the same level) instead of waiting for real ones.
+
+        background = BackgroundModel()
+        for frame in first_frames:
+            background.add(frame)
+        background.finish().save(calibration)
+        ...
+        background = BackgroundModel.load(calibration)
+        if background is not None and background.matches(live_frames):
+            background.prime(subtractor, training_frames, transform)
+    """
+
+    def __init__(self, image=None, noise=0.0):
+        self.image = image  # uint8 frame
+        self.noise = noise  # median per pixel standard deviation
+        self.sum = None
+        self.sum_sq = None
+        self.count = 0
+        self.blurred = None
+
+    def add(self, frame):
+        if self.sum is None:
+            self.sum = numpy.zeros(frame.shape, dtype=numpy.float64)
+            self.sum_sq = numpy.zeros(frame.shape, dtype=numpy.float64)
+        cv2.accumulate(frame, self.sum)
+        cv2.accumulateSquare(frame, self.sum_sq)
+        self.count += 1
+
+    def finish(self):
+        "Turns frames seen so far into reference image and noise level. Returns None if there were none"
+        if not(self.count):
+            return None
+        mean = self.sum / self.count
+        deviation = numpy.sqrt(numpy.maximum(self.sum_sq / self.count - mean ** 2, 0))
+        self.image = numpy.clip(numpy.round(mean), 0, 255).astype(numpy.uint8)
+        self.noise = float(numpy.median(deviation))
+        (self.sum, self.sum_sq, self.blurred) = (None, None, None)
+        return self
+
+    def is_ready(self):
+        return self.image is not None
+
+    def changed_fraction(self, frame, threshold=25):
+        "Share of pixels that differ from the reference more than noise can explain"
+        if self.blurred is None:
+            self.blurred = cv2.GaussianBlur(self.image, (11, 11), 0)
+        diff = cv2.absdiff(cv2.GaussianBlur(frame, (11, 11), 0), self.blurred)
+        if diff.ndim == 3:
+            diff = diff.max(axis=2)
+        return float(numpy.count_nonzero(diff > max(threshold, 4 * self.noise))) / diff.size
+
+    def matches(self, frames, max_changed=0.02):
+        """True if most of `frames` look like the reference. Ball, flippers or a hand can cover some
+        of the table, moved camera or different lighting changes edges and surfaces all over it.
+        """
+        if not self.is_ready() or len(frames) == 0:
+            return False
+        good = [self.changed_fraction(f) <= max_changed for f in frames]
+        return sum(good) * 2 > len(good)
+
+    def prime(self, subtractor, count, transform=None):
+        "Feeds `count` synthetic background frames to `subtractor`, passing each through `transform` first"
+        random = numpy.random.RandomState(0)
+        for _ in range(count):
+            frame = self.image + random.normal(0, self.noise, self.image.shape)
+            frame = numpy.clip(frame, 0, 255).astype(numpy.uint8)
+            subtractor.apply(transform(frame) if transform is not None else frame)
+
+    def save(self, calibration):
+        "Adds reference image and noise level to `lib.calibration.Calibration`"
+        calibration.set_array('background', self.image, 'png')
+        calibration.meta['background_noise'] = self.noise
+
+    @classmethod
+    def load(cls, calibration):
+        "Model stored in calibration, or None if there is none"
+        if not calibration.has_array('background'):
+            return None
+        return cls(numpy.array(calibration.get_array('background')), calibration.meta.get('background_noise', 0.0))
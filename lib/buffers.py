@@ -0,0 +1,88 @@
+import threading
+import numpy
+
+
+class BufferPool(object):
+    """Reusable arrays of one shape and type, so capture does not allocate a new frame every time.
+
+    Every buffer handed out is tracked until it's released: `outstanding()` tells who still holds one (leaks),
+    and releasing a buffer twice, or something that did not come from this pool (e.g. a view of a pooled
+    buffer), raises ValueError rather than letting two owners write to the same memory. When all buffers
+    are busy a new one is allocated and counted in `grown`, so a pool that's too small shows up too.
+
+        pool = BufferPool((480, 640, 3), count=3)
+        frame = pool.acquire('capture')
+        (grabbed, frame) = capture.read(frame)
+        ...
+        pool.release(frame)
+        print(pool.summary())
+    """
+
+    def __init__(self, shape, dtype=numpy.uint8, count=2):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self.lock = threading.Lock()
+        self.free = [numpy.empty(self.shape, self.dtype) for _ in range(count)]
+        self.size = count
+        # id(buffer) -> (buffer, owner), buffer reference keeps the id from being reused while it's out
+        self.in_use = {}
+        self.peak = 0
+        self.grown = 0
+
+    def acquire(self, owner=None):
+        "Free buffer, contents undefined. `owner` is only for `outstanding()`"
+        with self.lock:
+            if self.free:
+                buffer = self.free.pop()
+            else:
+                buffer = numpy.empty(self.shape, self.dtype)
+                self.size += 1
+                self.grown += 1
+            self.in_use[id(buffer)] = (buffer, owner)
+            self.peak = max(self.peak, len(self.in_use))
+            return buffer
+
+    def owns(self, buffer):
+        "True if `buffer` itself (not a view of it) is handed out by this pool"
+        with self.lock:
+            held = self.in_use.get(id(buffer))
+            return held is not None and held[0] is buffer
+
+    def release(self, buffer):
+        with self.lock:
+            held = self.in_use.get(id(buffer))
+            if held is None or held[0] is not buffer:
+                raise ValueError("Buffer is released twice, or it's not from this pool")
+            del self.in_use[id(buffer)]
+            self.free.append(buffer)
+
+    def outstanding(self):
+        "Owners of buffers that are not released yet"
+        with self.lock:
+            return [owner for (_, owner) in self.in_use.values()]
+
+    def summary(self):
+        return "{} buffers, {} in use (peak {}), {} grown".format(self.size, len(self.in_use), self.peak, self.grown)
+
+
+class Workspace(object):
+    """Named output buffers of one processing stage, passed to OpenCV as `dst=`.
+
+    Whatever is written to a buffer stays there only until the stage writes that name again, so callers
+    that need a result for longer have to copy it. Buffers are (re)allocated only when frame size changes,
+    `allocations` counts that, and stops growing once the stream settles.
+
+        workspace = Workspace()
+        eroded = cv2.erode(mask, None, dst=workspace.get('eroded', mask.shape), iterations=3)
+    """
+
+    def __init__(self):
+        self.buffers = {}
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=numpy.uint8):
+        buffer = self.buffers.get(name)
+        if buffer is None or buffer.shape != tuple(shape) or buffer.dtype != dtype:
+            buffer = self.buffers[name] = numpy.empty(shape, dtype)
+            self.allocations += 1
+        return buffer
@@ -0,0 +1,151 @@
+import json
+import os
+import struct
+import cv2
+import numpy
+
+MAGIC = b'PINBOTC\x00'
+VERSION = 1
+# magic, format version, length of JSON header that follows
+PREAMBLE = struct.Struct('<8sHI')
+# Arrays start at multiples of this, so memory mapped ones are properly aligned
+ALIGN = 16
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+class Calibration(object):
+    """Everything learned before the game, in one binary file.
+
+    File is a small JSON header (frame size, predictor settings, array directory) followed by
+    raw arrays. Arrays are memory mapped on load and only decoded when asked for, so loading
+    flipper hulls costs an open() and a couple of small reads. Large masks can be kept as raw
+    bytes, packed bits (1 bit per pixel) or PNG.
+
+        calibration = Calibration(640, 480, predictor={'max_speed': 1.28})
+        calibration.add_flipper('A', flipper_a.get_trained_mask_contours(), flipper_a.combined_mask)
+        calibration.save('./tmp/calibration.bin')
+        ...
+        calibration = Calibration.load('./tmp/calibration.bin')
+        if calibration.fits(640, 480):
+            calibration.apply(flipper_a, 'A')
+    """
+
+    def __init__(self, width, height, predictor=None):
+        self.width = int(width)
+        self.height = int(height)
+        self.predictor = dict(predictor or {})
+        self.meta = {}  # any other small JSON serializable values
+        self.hull_sizes = {}  # flipper name -> number of points in every hull polygon
+        self.arrays = {}  # key -> (array, encoding) for new arrays, directory entry for loaded ones
+        self.data = None  # memory mapped file contents after load()
+
+    def fits(self, width, height):
+        return (self.width, self.height) == (int(width), int(height))
+
+    def flippers(self):
+        return sorted(self.hull_sizes.keys())
+
+    def add_flipper(self, name, hulls, mask=None, mask_format='bits'):
+        "Stores flipper hull polygons (as from `Flipper.get_trained_mask_contours()`) and, optionally, its combined mask"
+        polygons = [numpy.asarray(h, dtype=numpy.int32).reshape(-1, 2) for h in hulls]
+        self.hull_sizes[name] = [len(p) for p in polygons]
+        points = numpy.concatenate(polygons) if polygons else numpy.zeros((0, 2), dtype=numpy.int32)
+        self.set_array('hulls/' + name, points)
+        if mask is not None and mask_format:
+            self.set_array('mask/' + name, mask, mask_format)
+
+    def get_hulls(self, name):
+        "Flipper hull polygons, as (E, 1, 2) int32 contours"
+        points = self.get_array('hulls/' + name)
+        ends = numpy.cumsum(self.hull_sizes[name])
+        return [p.reshape(-1, 1, 2) for p in numpy.split(points, ends[:-1])] if len(ends) else []
+
+    def get_mask(self, name):
+        key = 'mask/' + name
+        return self.get_array(key) if self.has_array(key) else None
+
+    def apply(self, flipper, name):
+        "Restores trained hulls into `flipper`. Returns True if flipper ends up trained"
+        if name not in self.hull_sizes:
+            return False
+        return flipper.load_hulls(self.get_hulls(name), (self.height, self.width))
+
+    def set_array(self, key, array, encoding='raw'):
+        "Stores `array` under `key`. Encoding is 'raw', 'bits' (for 0/non-zero masks) or 'png' (for 8/16 bit images)"
+        if encoding not in ('raw', 'bits', 'png'):
+            raise ValueError("Unknown array encoding: {}".format(encoding))
+        self.arrays[key] = (numpy.ascontiguousarray(array), encoding)
+
+    def has_array(self, key):
+        return key in self.arrays
+
+    def get_array(self, key):
+        entry = self.arrays[key]
+        if isinstance(entry, tuple):
+            return entry[0]
+        raw = self.data[entry['offset']:entry['offset'] + entry['length']]
+        shape = tuple(entry['shape'])
+        if entry['encoding'] == 'bits':
+            count = int(numpy.prod(shape))
+            return (numpy.unpackbits(raw, count=count) * 255).astype(entry['dtype']).reshape(shape)
+        if entry['encoding'] == 'png':
+            return cv2.imdecode(numpy.asarray(raw), cv2.IMREAD_UNCHANGED).reshape(shape)
+        # Read only view into the memory map, no copy
+        return raw.view(entry['dtype']).reshape(shape)
+
+    def save(self, path):
+        directory = {}
+        blobs = []
+        offset = 0
+        for key in sorted(self.arrays.keys()):
+            array = self.get_array(key)
+            encoding = self.arrays[key][1] if isinstance(self.arrays[key], tuple) else self.arrays[key]['encoding']
+            if encoding == 'bits':
+                blob = numpy.packbits(array.reshape(-1) > 0).tobytes()
+            elif encoding == 'png':
+                blob = cv2.imencode('.png', array)[1].tobytes()
+            else:
+                blob = array.tobytes()
+            directory[key] = {'offset': offset, 'length': len(blob), 'encoding': encoding,
+                              'dtype': array.dtype.str, 'shape': list(array.shape)}
+            blobs.append((offset, blob))
+            offset = _align(offset + len(blob))
+        header = json.dumps({'width': self.width, 'height': self.height, 'predictor': self.predictor,
+                             'meta': self.meta, 'hulls': self.hull_sizes, 'arrays': directory},
+                            sort_keys=True).encode('utf-8')
+        start = _align(PREAMBLE.size + len(header))
+        # Write next to the target and rename, so a crash never leaves half written calibration
+        temporary = path + '.tmp'
+        with open(temporary, 'wb') as f:
+            f.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+            f.write(header)
+            for (blob_offset, blob) in blobs:
+                f.seek(start + blob_offset)
+                f.write(blob)
+        os.rename(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            preamble = f.read(PREAMBLE.size)
+            if len(preamble) < PREAMBLE.size:
+                raise ValueError("{} is not a calibration file".format(path))
+            (magic, version, length) = PREAMBLE.unpack(preamble)
+            if magic != MAGIC:
+                raise ValueError("{} is not a calibration file".format(path))
+            if version > VERSION:
+                raise ValueError("{} is calibration version {}, only up to {} is supported".format(path, version, VERSION))
+            header = json.loads(f.read(length).decode('utf-8'))
+        calibration = cls(header['width'], header['height'], header['predictor'])
+        calibration.meta = header.get('meta', {})
+        calibration.hull_sizes = header['hulls']
+        calibration.arrays = header['arrays']
+        start = _align(PREAMBLE.size + length)
+        if os.path.getsize(path) > start:
+            calibration.data = numpy.memmap(path, dtype=numpy.uint8, mode='r', offset=start)
+        else:
+            calibration.data = numpy.zeros(0, dtype=numpy.uint8)
+        return calibration
@@ -0,0 +1,88 @@
+import copy
+import cv2
+
+# Values of CAP_PROP_AUTO_EXPOSURE as V4L2 backend takes them
+MANUAL_EXPOSURE = 1
+AUTO_EXPOSURE = 3
+
+
+class CaptureProfile(object):
+    """Camera settings, applied to `cv2.VideoCapture` before the first frame.
+
+    `fourcc` is pixel format: 'MJPG' gets full frame rate over USB 2 at the cost of decoding, 'YUYV' needs no decoding
+    but is limited by bandwidth. `buffer_size` is how many frames driver may queue (None leaves driver default, often 4),
+    every queued frame is that much older when we get it. `exposure` (driver units) turns auto exposure off, short
+    exposure means less motion blur of the ball. With `drain`, frames that were already waiting in the driver queue are
+    grabbed and thrown away, so the one we decode is the newest. With `driver_timestamps`, frame age is counted from
+    when driver got the frame (V4L2 buffer timestamp) rather than from when we read it.
+
+    Drivers quietly ignore what they can't do, `apply()` returns what camera reports back.
+    """
+
+    def __init__(self, name, width=640, height=480, fps=60, fourcc=None, buffer_size=None, exposure=None,
+                 drain=False, driver_timestamps=False):
+        self.name = name
+        self.width = width
+        self.height = height
+        self.fps = fps
+        self.fourcc = fourcc
+        self.buffer_size = buffer_size
+        self.exposure = exposure
+        self.drain = drain
+        self.driver_timestamps = driver_timestamps
+
+    def apply(self, capture):
+        "Sets profile on `capture`. Returns {setting: value camera reports}"
+        if self.fourcc:
+            # Format first, V4L2 checks size and rate against it
+            capture.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*self.fourcc))
+        capture.set(cv2.CAP_PROP_FRAME_WIDTH, self.width)
+        capture.set(cv2.CAP_PROP_FRAME_HEIGHT, self.height)
+        capture.set(cv2.CAP_PROP_FPS, float(self.fps))
+        if self.buffer_size:
+            capture.set(cv2.CAP_PROP_BUFFERSIZE, self.buffer_size)
+        if self.exposure is not None:
+            capture.set(cv2.CAP_PROP_AUTO_EXPOSURE, MANUAL_EXPOSURE)
+            capture.set(cv2.CAP_PROP_EXPOSURE, self.exposure)
+        fourcc = int(capture.get(cv2.CAP_PROP_FOURCC))
+        return {
+            'width': int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)),
+            'height': int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+            'fps': capture.get(cv2.CAP_PROP_FPS),
+            'fourcc': ''.join(chr((fourcc >> (8 * n)) & 0xff) for n in range(4)).strip('\x00 ') or None,
+            'buffer_size': int(capture.get(cv2.CAP_PROP_BUFFERSIZE)),
+            'exposure': capture.get(cv2.CAP_PROP_EXPOSURE),
+        }
+
+    def with_exposure(self, exposure):
+        "Same profile with manual `exposure`"
+        profile = copy.copy(self)
+        profile.exposure = exposure
+        return profile
+
+    def __repr__(self):
+        return "CaptureProfile({!r}, {}x{}@{}, {}, buffer {}, {})".format(
+            self.name, self.width, self.height, self.fps, self.fourcc or 'default format',
+            self.buffer_size or 'default', 'drain' if self.drain else 'read')
+
+
+PROFILES = dict((p.name, p) for p in (
+    # What the stream always did: 640x480 at 60 FPS, everything else up to the driver
+    CaptureProfile('default'),
+    # Newest frame as soon as possible: compressed for full rate, one buffer, leftovers drained
+    CaptureProfile('low-latency', fourcc='MJPG', buffer_size=1, drain=True, driver_timestamps=True),
+    # No decoding on our side, for slow CPUs. Most USB 2 cameras only make 30 FPS of that
+    CaptureProfile('yuyv', fps=30, fourcc='YUYV', buffer_size=1, drain=True, driver_timestamps=True),
+    # Quarter of the pixels at twice the rate, ball moves less between frames
+    CaptureProfile('fast', width=320, height=240, fps=120, fourcc='MJPG', buffer_size=1, drain=True,
+                   driver_timestamps=True),
+))
+
+
+def get_profile(profile):
+    "Profile by name (see `PROFILES`), or the profile itself"
+    if profile is None:
+        return PROFILES['default']
+    if hasattr(profile, 'apply'):
+        return profile
+    return PROFILES[profile]
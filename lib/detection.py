@@ -0,0 +1,154 @@
+import cv2
+import numpy
+from .metrics import LatencyHistogram, clock
+from .buffers import Workspace
+
+
+class Engine(object):
+    """Foreground detection: frame preparation plus background subtraction, behind one `apply()`.
+
+    Preparation is optional grayscale conversion, `pyramid` halvings of resolution and Gaussian blur.
+    Mask always comes back in the size of the frame that was passed in, so nothing downstream has
+    to know about the pyramid. Every call is timed: `timings` has last frame's 'prepare' and
+    'subtraction' seconds, `cost` is a histogram of both together.
+    Every step writes into the engine's own `workspace`, so the returned mask is overwritten by the next call.
+
+        engine = create('gmg', training_frames=20, grayscale=True, pyramid=1)
+        while(frame):
+            mask = engine.apply(frame)
+        print(engine.cost.summary())
+    """
+
+    name = None
+
+    def __init__(self, training_frames=20, grayscale=False, pyramid=0, blur=11):
+        self.training_frames = training_frames
+        self.grayscale = grayscale
+        self.pyramid = pyramid
+        self.blur = blur
+        self.timings = {}
+        self.cost = LatencyHistogram()
+        self.workspace = Workspace()
+
+    def prepare(self, frame):
+        if self.grayscale and frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.workspace.get('gray', frame.shape[:2]))
+        for n in range(self.pyramid):
+            shape = ((frame.shape[0] + 1) // 2, (frame.shape[1] + 1) // 2) + frame.shape[2:]
+            frame = cv2.pyrDown(frame, dst=self.workspace.get('pyramid{}'.format(n), shape))
+        if self.blur:
+            frame = cv2.GaussianBlur(frame, (self.blur, self.blur), 0, dst=self.workspace.get('blur', frame.shape))
+        return frame
+
+    def apply(self, frame):
+        start = clock()
+        prepared = self.prepare(frame)
+        t = clock()
+        mask = self.subtract(prepared)
+        if mask.shape[:2] != frame.shape[:2]:
+            mask = cv2.resize(mask, (frame.shape[1], frame.shape[0]), dst=self.workspace.get('resized', frame.shape[:2]),
+                              interpolation=cv2.INTER_NEAREST)
+        end = clock()
+        self.timings = {'prepare': t - start, 'subtraction': end - t}
+        self.cost.record(end - start)
+        return mask
+
+    def subtract(self, frame):
+        raise NotImplementedError()
+
+    def mask_buffer(self, frame):
+        "Where subtraction writes the mask of prepared `frame`"
+        return self.workspace.get('mask', frame.shape[:2])
+
+
+class GMGEngine(Engine):
+    "Statistical per pixel model. Reliable, but the slowest"
+    name = 'gmg'
+
+    def __init__(self, training_frames=20, grayscale=False, pyramid=0, blur=11, decision_threshold=0.6):
+        super(GMGEngine, self).__init__(training_frames, grayscale, pyramid, blur)
+        self.subtractor = cv2.bgsegm.createBackgroundSubtractorGMG(training_frames, decision_threshold)
+
+    def subtract(self, frame):
+        return self.subtractor.apply(frame, self.mask_buffer(frame))
+
+
+class MOGEngine(Engine):
+    "Gaussian mixture from contrib module. Picks up moving flippers well, used for training"
+    name = 'mog'
+
+    def __init__(self, training_frames=20, grayscale=False, pyramid=0, blur=0):
+        super(MOGEngine, self).__init__(training_frames, grayscale, pyramid, blur)
+        self.subtractor = cv2.bgsegm.createBackgroundSubtractorMOG()
+
+    def subtract(self, frame):
+        return self.subtractor.apply(frame, self.mask_buffer(frame))
+
+
+class MOG2Engine(Engine):
+    "Adaptive Gaussian mixture from OpenCV core, without shadow detection"
+    name = 'mog2'
+
+    def __init__(self, training_frames=20, grayscale=False, pyramid=0, blur=11, var_threshold=16):
+        super(MOG2Engine, self).__init__(training_frames, grayscale, pyramid, blur)
+        self.subtractor = cv2.createBackgroundSubtractorMOG2(max(training_frames, 1) * 10, var_threshold, False)
+
+    def subtract(self, frame):
+        return self.subtractor.apply(frame, self.mask_buffer(frame))
+
+
+class KNNEngine(Engine):
+    "K nearest neighbours model from OpenCV core, without shadow detection"
+    name = 'knn'
+
+    def __init__(self, training_frames=20, grayscale=False, pyramid=0, blur=11, distance_threshold=400.0):
+        super(KNNEngine, self).__init__(training_frames, grayscale, pyramid, blur)
+        self.subtractor = cv2.createBackgroundSubtractorKNN(max(training_frames, 1) * 10, distance_threshold, False)
+
+    def subtract(self, frame):
+        return self.subtractor.apply(frame, self.mask_buffer(frame))
+
+
+class AbsDiffEngine(Engine):
+    """Difference against a static background: mean of the first `training_frames` frames.
+
+    By far the cheapest, but doesn't adapt, so lighting has to stay the same through the game.
+    """
+    name = 'absdiff'
+
+    def __init__(self, training_frames=20, grayscale=False, pyramid=0, blur=11, threshold=25):
+        super(AbsDiffEngine, self).__init__(training_frames, grayscale, pyramid, blur)
+        self.threshold = threshold
+        self.sum = None
+        self.count = 0
+        self.background = None
+
+    def subtract(self, frame):
+        if self.background is None:
+            if self.sum is None:
+                self.sum = numpy.zeros(frame.shape, dtype=numpy.float64)
+            cv2.accumulate(frame, self.sum)
+            self.count += 1
+            if self.count >= self.training_frames:
+                self.background = numpy.clip(numpy.round(self.sum / self.count), 0, 255).astype(frame.dtype)
+                self.sum = None
+            mask = self.mask_buffer(frame)
+            mask.fill(0)
+            return mask
+        diff = cv2.absdiff(frame, self.background, dst=self.workspace.get('diff', frame.shape))
+        if diff.ndim == 3:
+            # Largest difference of any channel. Several times faster than numpy max(axis=2)
+            largest = cv2.extractChannel(diff, 0, dst=self.workspace.get('largest', frame.shape[:2]))
+            channel = self.workspace.get('channel', frame.shape[:2])
+            for c in range(1, diff.shape[2]):
+                cv2.max(largest, cv2.extractChannel(diff, c, dst=channel), dst=largest)
+            diff = largest
+        return cv2.threshold(diff, self.threshold, 255, cv2.THRESH_BINARY, dst=self.mask_buffer(frame))[1]
+
+
+ENGINES = dict((e.name, e) for e in (GMGEngine, MOGEngine, MOG2Engine, KNNEngine, AbsDiffEngine))
+
+
+def create(name, training_frames=20, grayscale=False, pyramid=0, **kwargs):
+    "Engine by name, see `ENGINES`. Anything else is passed to engine constructor, e.g. `blur`"
+    return ENGINES[name](training_frames, grayscale, pyramid, **kwargs)
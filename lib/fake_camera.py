@@ -0,0 +1,109 @@
+import cv2
+from collections import deque
+from time import sleep
+from .metrics import clock
+
+# `WebcamVideoStream` source prefix, e.g. 'fake:tmp/benchmark/synthetic-30-1.avi'
+FAKE_PREFIX = 'fake:'
+
+
+class FakeCamera(object):
+    """Live camera behind `cv2.VideoCapture` interface, fed from a video file, to try capture profiles without one.
+
+    Frames arrive every 1/fps seconds whether anyone reads them or not. Like V4L2, up to `buffer_size` of them wait
+    in the driver queue, and new ones are lost while it's full, so a slow reader gets old frames first.
+    grab() takes the oldest queued frame (waiting for one if there is none), retrieve() decodes it, scaled
+    to the size that was set. Frame position (CAP_PROP_POS_MSEC) is arrival time on `lib.metrics.clock`, in
+    milliseconds, same as V4L2 buffer timestamps. Format and exposure are only remembered. Video loops.
+
+        camera = FakeCamera('tmp/benchmark/synthetic-30-1.avi')
+        camera.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        (grabbed, frame) = camera.read()
+    """
+
+    def __init__(self, path, buffer_size=4):
+        self.video = cv2.VideoCapture(path)
+        self.frame_count = int(self.video.get(cv2.CAP_PROP_FRAME_COUNT))
+        self.properties = {
+            cv2.CAP_PROP_FRAME_WIDTH: self.video.get(cv2.CAP_PROP_FRAME_WIDTH),
+            cv2.CAP_PROP_FRAME_HEIGHT: self.video.get(cv2.CAP_PROP_FRAME_HEIGHT),
+            cv2.CAP_PROP_FPS: self.video.get(cv2.CAP_PROP_FPS) or 30.0,
+            cv2.CAP_PROP_BUFFERSIZE: buffer_size,
+            cv2.CAP_PROP_FOURCC: 0,
+            cv2.CAP_PROP_AUTO_EXPOSURE: 3,
+            cv2.CAP_PROP_EXPOSURE: 0,
+        }
+        # (frame index, arrival time) of frames waiting to be grabbed
+        self.queue = deque()
+        self.started = clock()
+        self.arrived = 0  # frames that arrived so far, queued or lost
+        self.lost = 0  # arrived while the queue was full
+        self.grabbed = None
+        self.position = 0  # next frame index the video reader will decode
+
+    def isOpened(self):
+        return self.video.isOpened()
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_POS_MSEC:
+            return self.grabbed[1] * 1000.0 if self.grabbed is not None else 0.0
+        return self.properties.get(prop, 0)
+
+    def set(self, prop, value):
+        if prop == cv2.CAP_PROP_FPS:
+            if value <= 0:
+                return False
+            # New rate starts from now
+            self.__arrive(clock())
+            self.started = clock() - self.arrived / float(value)
+        self.properties[prop] = value
+        return True
+
+    def __arrive(self, now):
+        fps = float(self.properties[cv2.CAP_PROP_FPS])
+        while self.started + (self.arrived + 1) / fps <= now:
+            self.arrived += 1
+            if len(self.queue) < max(int(self.properties[cv2.CAP_PROP_BUFFERSIZE]), 1):
+                self.queue.append((self.arrived - 1, self.started + self.arrived / fps))
+            else:
+                self.lost += 1
+
+    def grab(self):
+        while True:
+            self.__arrive(clock())
+            if self.queue:
+                self.grabbed = self.queue.popleft()
+                return True
+            next_arrival = self.started + (self.arrived + 1) / float(self.properties[cv2.CAP_PROP_FPS])
+            sleep(max(next_arrival - clock(), 0))
+
+    def retrieve(self, image=None, flag=None):
+        if self.grabbed is None or not(self.frame_count):
+            return (False, None)
+        index = self.grabbed[0] % self.frame_count
+        if index < self.position:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            self.position = 0
+        # Frames lost in the queue are only demuxed, not decoded
+        while self.position < index:
+            self.video.grab()
+            self.position += 1
+        (grabbed, frame) = self.video.read()
+        self.position += 1
+        if not(grabbed):
+            return (False, None)
+        size = (int(self.properties[cv2.CAP_PROP_FRAME_WIDTH]), int(self.properties[cv2.CAP_PROP_FRAME_HEIGHT]))
+        if (frame.shape[1], frame.shape[0]) != size:
+            return (True, cv2.resize(frame, size, dst=image))
+        if image is not None and image.shape == frame.shape:
+            image[...] = frame
+            return (True, image)
+        return (True, frame)
+
+    def read(self, image=None):
+        if not(self.grab()):
+            return (False, None)
+        return self.retrieve(image)
+
+    def release(self):
+        self.video.release()
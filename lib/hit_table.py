@@ -0,0 +1,245 @@
+import hashlib
+import math
+import threading
+import cv2
+import numpy
+
+# Distances are stored in whole pixels, this one means "not within reach"
+NEVER = 255
+
+
+class HitTable(object):
+    """Precomputed flipper hit test: array lookups per predicted segment instead of polygon geometry.
+
+    Trained hulls are convex and don't change during the game, so for every start point (quantized to
+    `step` pixels) and direction (one of `directions`) the table keeps how far along that ray the first
+    point within `thickness`/2 of each flipper hull is. Segment from `Predictor.get_lines()['future']`
+    hits when that distance is not longer than the segment, which is the same question
+    `Flipper.check_lines` answers. Keying by segment rather than by time window means nothing has to be
+    rebuilt when prediction horizon changes (see `lib.latency`), only when hulls do.
+
+    Real segment starts up to `step`/sqrt(2) from its grid point, in a direction up to half a bin off, so
+    along `max_length` pixels it strays from the ray in the table by `margin`. Every cell keeps two distances:
+    to the hull grown by that margin (nearer than that can't be a hit) and to the hull shrunk by it (from there
+    on it surely is). Only segments ending in between, close to the hull edge, are checked exactly, so answers
+    are always the same as `Flipper.check_lines` gives. That is not rare: with synthetic benchmark hulls, 7% of
+    game lookups and 30% of `verify()` segments (which start near hulls half of the time) fall back. Most of them
+    start or end within a few pixels of the edge, so a finer grid or more directions hardly help: step 2 with
+    128 directions still falls back on 27%, for 8 times the size (40MB) and build time.
+
+        table = HitTable.load(calibration, [('A', flipper_a), ('B', flipper_b)], 640, 480) or \\
+            HitTable([('A', flipper_a), ('B', flipper_b)], 640, 480).build()
+        hits = table.check(lines['future'])  # (N, 2) booleans, column per flipper
+        table.save(calibration)
+
+    Segments longer than `max_length` pixels or starting outside the frame, and all of them while hulls
+    changed and the table is being rebuilt in the background, are checked exactly too.
+    """
+
+    def __init__(self, flippers, width, height, step=4, directions=64, thickness=6, max_length=64):
+        self.flippers = flippers  # [(name, Flipper)]
+        self.width = int(width)
+        self.height = int(height)
+        self.step = step
+        self.directions = directions
+        self.thickness = thickness
+        self.max_length = min(max_length, NEVER - 1)
+        self.margin = step / math.sqrt(2) + 2 * self.max_length * math.sin(math.pi / directions / 2) + 0.01
+        # Nearest (grown hull) and surest (shrunk hull) distances
+        self.shape = (2, len(flippers), (self.height + step - 1) // step + 1, (self.width + step - 1) // step + 1,
+                      directions)
+        self.distances = None  # uint8 array of `shape`
+        self.hulls = None  # flipper hull lists the table was built from
+        self.building = None
+        # Segments looked up in the table, and how many of those had to be checked exactly anyway
+        self.lookups = 0
+        self.exact = 0
+
+    def fingerprint(self):
+        "Identifies hulls and table layout, so a stored table is only used for what it was built from"
+        digest = hashlib.sha1()
+        digest.update(repr((self.width, self.height, self.step, self.directions, self.thickness,
+                            self.max_length)).encode('utf-8'))
+        for (name, flipper) in self.flippers:
+            digest.update(name.encode('utf-8'))
+            for (polygon, _) in flipper.hulls:
+                digest.update(numpy.ascontiguousarray(polygon, dtype=numpy.float64).tobytes())
+        return digest.hexdigest()
+
+    def is_current(self):
+        # Retraining replaces hull lists rather than changing them, so identity is enough
+        return self.hulls is not None and all(h is f.hulls for (h, (_, f)) in zip(self.hulls, self.flippers))
+
+    def build(self):
+        "Computes the table for current hulls, in the calling thread (about a second for two flippers)"
+        hulls = [f.hulls for (_, f) in self.flippers]
+        distances = numpy.full(self.shape, NEVER, dtype=numpy.uint8)
+        (ys, xs) = numpy.mgrid[0:self.shape[2], 0:self.shape[3]] * self.step
+        points = numpy.stack((xs.ravel(), ys.ravel()), axis=1).astype(numpy.float64)
+        radius = self.thickness / 2.0
+        for (n, flipper_hulls) in enumerate(hulls):
+            for (polygon, _) in flipper_hulls:
+                # Grown hull rounds distances down, shrunk one up, so neither bound is ever on the wrong side
+                for (bound, (corners, normals, shift), rounding) in (
+                        (0, self.__grow(polygon, radius + self.margin), numpy.floor),
+                        (1, self.__shrink(polygon, radius - self.margin), numpy.ceil)):
+                    # Inside of every edge is normal . (x - corner) <= shift * |normal|, along a ray that's
+                    # offset + s * slope <= 0
+                    offsets = (points.dot(normals.T) - (corners * normals).sum(axis=1) -
+                               shift * numpy.sqrt((normals ** 2).sum(axis=1)))
+                    for d in range(self.directions):
+                        angle = 2 * math.pi * d / self.directions
+                        reach = _ray_entry(offsets, normals.dot((math.cos(angle), math.sin(angle))))
+                        reach = numpy.minimum(rounding(reach), NEVER).astype(numpy.uint8)
+                        view = distances[bound, n, :, :, d]
+                        numpy.minimum(view, reach.reshape(view.shape), out=view)
+        (self.distances, self.hulls) = (distances, hulls)
+        return self
+
+    def build_async(self):
+        "Rebuilds the table on a background thread, unless it's already being rebuilt"
+        if self.building is not None and self.building.is_alive():
+            return
+        self.building = threading.Thread(target=self.build, args=())
+        self.building.daemon = True
+        self.building.start()
+
+    def __grow(self, polygon, radius):
+        """Area within `radius` of convex polygon, or a bit more, as (points, outward normals, shift) of its edges:
+        every edge moved out by `radius`
+        """
+        (corners, normals) = _edges(polygon)
+        return (corners, normals, radius)
+
+    def __shrink(self, polygon, radius):
+        """Area within `radius` of convex polygon, or a bit less, as (points, outward normals, shift) of its edges.
+
+        Negative `radius` moves every edge in, positive one rounds corners with a polygon inside the circle.
+        """
+        if radius <= 0:
+            (corners, normals) = _edges(polygon)
+            return (corners, normals, radius)
+        circle = [(radius * math.cos(a), radius * math.sin(a)) for a in numpy.linspace(0, 2 * math.pi, 16, False)]
+        grown = (polygon[:, numpy.newaxis, :] + numpy.array(circle)[numpy.newaxis, :, :]).reshape(-1, 2)
+        (corners, normals) = _edges(cv2.convexHull(grown.astype(numpy.float32)).reshape(-1, 2).astype(numpy.float64))
+        return (corners, normals, 0.0)
+
+    def check(self, segments):
+        """Which flipper every segment hits: (N, flippers) boolean array.
+
+        `segments` is anything that reshapes into (N, 4) rows of x0, y0, x1, y1, e.g. `lines['future']`.
+        """
+        segments = numpy.asarray(segments, dtype=numpy.float64).reshape(-1, 4)
+        if len(segments) == 0:
+            return numpy.zeros((0, len(self.flippers)), dtype=bool)
+        if not(self.is_current()):
+            self.build_async()
+            return self.__check_exact(segments)
+        move = segments[:, 2:4] - segments[:, 0:2]
+        length = numpy.sqrt((move ** 2).sum(axis=1))
+        ix = numpy.rint(segments[:, 0] / self.step).astype(numpy.intp)
+        iy = numpy.rint(segments[:, 1] / self.step).astype(numpy.intp)
+        d = numpy.rint(numpy.arctan2(move[:, 1], move[:, 0]) * (self.directions / (2 * math.pi))).astype(numpy.intp)
+        d %= self.directions
+        inside = ((ix >= 0) & (ix < self.shape[3]) & (iy >= 0) & (iy < self.shape[2]) & (length <= self.max_length))
+        if inside.all():
+            (nearest, surest) = self.distances[:, :, iy, ix, d] <= length
+        else:
+            (ix, iy, d) = (numpy.where(inside, ix, 0), numpy.where(inside, iy, 0), numpy.where(inside, d, 0))
+            (nearest, surest) = (self.distances[:, :, iy, ix, d] <= length) | ~inside
+            surest &= inside
+        # Rows per flipper: sure hit, or can't tell without checking
+        hits = surest.T.copy()
+        unsure = (nearest & ~surest).T
+        self.lookups += int(inside.sum())
+        for (n, (_, flipper)) in enumerate(self.flippers):
+            idx = numpy.flatnonzero(unsure[:, n])
+            if len(idx):
+                self.exact += len(idx)
+                hits[idx, n] = flipper.check_lines(segments[idx], self.thickness)
+        return hits
+
+    def __check_exact(self, segments):
+        return numpy.stack([f.check_lines(segments, self.thickness) for (_, f) in self.flippers], axis=1) \
+            if len(self.flippers) else numpy.zeros((len(segments), 0), dtype=bool)
+
+    def verify(self, count=20000, seed=0):
+        """Compares the table with exact hit test on `count` random segments up to `max_length` long,
+        half of them starting near flipper hulls. Returns {'segments', 'hits', 'mismatches', 'exact'},
+        `exact` being how many of them the table could not answer by itself.
+        """
+        if not(self.is_current()):
+            self.build()
+        random = numpy.random.RandomState(seed)
+        starts = random.uniform((0, 0), (self.width, self.height), (count, 2))
+        bounds = [b for (_, f) in self.flippers for (_, b) in f.hulls]
+        if bounds:
+            # Most segments in the frame are nowhere near flippers, these are the ones that matter
+            near = random.randint(0, len(bounds), count // 2)
+            box = numpy.array(bounds)[near]
+            starts[:count // 2] = random.uniform(box[:, 0:2] - self.max_length, box[:, 2:4] + self.max_length)
+        angles = random.uniform(0, 2 * math.pi, count)
+        lengths = random.uniform(0, self.max_length, count)
+        segments = numpy.concatenate((starts, starts + lengths[:, numpy.newaxis] *
+                                      numpy.stack((numpy.cos(angles), numpy.sin(angles)), axis=1)), axis=1)
+        exact = self.__check_exact(segments)
+        # Game counters stay as they were
+        (lookups, checked) = (self.lookups, self.exact)
+        table = self.check(segments)
+        (unsure, self.lookups, self.exact) = (self.exact - checked, lookups, checked)
+        return {'segments': count, 'hits': int(exact.any(axis=1).sum()),
+                'mismatches': int((table != exact).any(axis=1).sum()), 'exact': unsure}
+
+    def save(self, calibration):
+        "Stores the table in `lib.calibration.Calibration`, raw, so loading it is a memory map"
+        if not(self.is_current()):
+            return
+        calibration.set_array('hit_table', self.distances)
+        calibration.meta['hit_table'] = {'fingerprint': self.fingerprint(), 'step': self.step,
+                                         'directions': self.directions, 'thickness': self.thickness,
+                                         'max_length': self.max_length}
+
+    @classmethod
+    def load(cls, calibration, flippers, width, height):
+        "Table stored in calibration, or None if there is none, or it was built for different hulls"
+        if calibration is None or not(calibration.has_array('hit_table')):
+            return None
+        stored = calibration.meta.get('hit_table', {})
+        table = cls(flippers, width, height, stored.get('step', 4), stored.get('directions', 64),
+                    stored.get('thickness', 6), stored.get('max_length', 64))
+        distances = calibration.get_array('hit_table')
+        if stored.get('fingerprint') != table.fingerprint() or distances.shape != table.shape:
+            return None
+        (table.distances, table.hulls) = (distances, [f.hulls for (_, f) in flippers])
+        return table
+
+
+def _edges(polygon):
+    "Convex polygon as (points, outward normals) of its edges"
+    edge = numpy.roll(polygon, -1, axis=0) - polygon
+    normals = numpy.stack((edge[:, 1], -edge[:, 0]), axis=1)
+    # Orientation of convexHull output depends on the axes, make normals point away from the centre
+    if ((polygon.mean(axis=0) - polygon) * normals).sum(axis=1).mean() > 0:
+        normals = -normals
+    return (polygon, normals)
+
+
+def _ray_entry(offsets, slopes):
+    """Distance along rays to where they enter a convex polygon: 0 for rays starting inside, infinity if they never do.
+
+    `offsets` are (points, edges) signed distances (scaled by edge length) from every edge, positive outside,
+    `slopes` is how fast (edges,) those change along the ray direction.
+    """
+    enter = numpy.zeros(len(offsets))
+    leave = numpy.full(len(offsets), numpy.inf)
+    entering = slopes < -1e-12
+    if entering.any():
+        numpy.maximum(enter, (offsets[:, entering] / -slopes[entering]).max(axis=1), out=enter)
+    leaving = slopes > 1e-12
+    if leaving.any():
+        numpy.minimum(leave, (offsets[:, leaving] / -slopes[leaving]).min(axis=1), out=leave)
+    # Parallel to an edge, either always on its inner side or never
+    parallel = ~(entering | leaving)
+    if parallel.any():
+        leave[(offsets[:, parallel] > 0).any(axis=1)] = -numpy.inf
+    return numpy.where(enter <= leave, enter, numpy.inf)
@@ -0,0 +1,163 @@
+import numpy
+from .metrics import LatencyHistogram
+
+
+class LatencyEstimator(object):
+    """Running estimate of end-to-end latency: from capture of the frame a press was decided on, to the first
+    frame where that flipper is seen moving in its trained area.
+
+    Movement is foreground (from the same background subtraction the game runs) covering more than
+    `threshold` of flipper hull. It happened somewhere between the last still frame and the first moving one,
+    so the middle of that interval is taken, which keeps frame rate from biasing the estimate.
+    Estimate and jitter are smoothed the way TCP smooths round trip time (RFC 6298), so they follow
+    drift (CPU load, USB, coil temperature) without jumping on a single odd sample.
+
+        latency = LatencyEstimator({'A': flipper_a, 'B': flipper_b})
+        while(frame):
+            latency.observe(mask, frame_time)
+            lines = predictor.get_lines(future=latency.horizon(60), timing_error=latency.timing_error(0.25))
+            if hit:
+                arduino.pressA(100)
+                latency.pressed('A', frame_time)
+    """
+
+    def __init__(self, flippers, estimate=None, jitter=None, samples=0, threshold=0.25, timeout=0.5,
+                 alpha=0.125, beta=0.25, min_samples=3):
+        self.flippers = flippers
+        self.estimate = estimate  # seconds
+        self.jitter = jitter  # seconds, smoothed mean deviation
+        self.samples = samples
+        self.threshold = threshold
+        self.timeout = timeout
+        self.alpha = alpha
+        self.beta = beta
+        self.min_samples = min_samples
+        self.histogram = LatencyHistogram()
+        # From capture to solenoid firing, as reported by firmware that fires on schedule (part of the above)
+        self.fired_histogram = LatencyHistogram()
+        self.last_sample = None
+        # Presses with no movement seen within `timeout` (e.g. broken coil), and ones on already moving flippers
+        self.missed = 0
+        self.busy = 0
+        # flipper name -> share of its hull that was foreground in the last observed mask
+        self.activity = {}
+        # flipper name -> [decision frame time, last still frame time]
+        self.pending = {}
+        # flipper name -> (hull mask the region was made from, (x0, y0, x1, y1), hull crop, hull pixel count)
+        self.regions = {}
+
+    def pressed(self, name, time):
+        """Press of flipper `name` was decided on a frame captured at `time` (datetime), the last one observed.
+
+        Flipper that was already moving on that frame can't tell when our press got to it, so it's not measured.
+        """
+        if self.activity.get(name, 0.0) > self.threshold:
+            self.busy += 1
+            return
+        self.pending[name] = [time, time]
+
+    def is_pending(self):
+        return bool(self.pending)
+
+    def fired(self, seconds):
+        "Firmware reported solenoid fired `seconds` after capture of the frame the press was decided on"
+        self.fired_histogram.record(seconds)
+
+    def observe(self, mask, time, offset=(0, 0)):
+        """Checks foreground `mask` of a frame captured at `time` for pressed flippers moving.
+
+        Mask can be a crop (e.g. region of interest), `offset` being its top left corner in the frame.
+        Returns list of new samples (seconds).
+        """
+        samples = []
+        for name in self.flippers:
+            self.activity[name] = self.moving(name, mask, offset)
+        for (name, pending) in list(self.pending.items()):
+            if self.activity[name] > self.threshold:
+                moved = pending[1] + (time - pending[1]) / 2
+                samples.append(self.add_sample((moved - pending[0]).total_seconds()))
+                del self.pending[name]
+            elif (time - pending[0]).total_seconds() > self.timeout:
+                self.missed += 1
+                del self.pending[name]
+            else:
+                pending[1] = time
+        return samples
+
+    def moving(self, name, mask, offset=(0, 0)):
+        "Share of flipper hull that is foreground in `mask`"
+        region = self.__get_region(name)
+        if region is None:
+            return 0.0
+        (_, (x0, y0, x1, y1), hull, area) = region
+        (ox, oy) = offset
+        # Part of the hull bounding box that the mask covers
+        (cx0, cy0) = (max(x0, ox), max(y0, oy))
+        (cx1, cy1) = (min(x1, ox + mask.shape[1]), min(y1, oy + mask.shape[0]))
+        if cx0 >= cx1 or cy0 >= cy1:
+            return 0.0
+        seen = mask[cy0 - oy:cy1 - oy, cx0 - ox:cx1 - ox] & hull[cy0 - y0:cy1 - y0, cx0 - x0:cx1 - x0]
+        return numpy.count_nonzero(seen) / float(area)
+
+    def __get_region(self, name):
+        hull_mask = self.flippers[name].hull_mask
+        region = self.regions.get(name)
+        # Hulls are replaced (not changed in place) by retraining, so identity tells if they're still the same
+        if region is not None and region[0] is hull_mask:
+            return region
+        self.regions[name] = None
+        if hull_mask is None:
+            return None
+        (ys, xs) = numpy.nonzero(hull_mask)
+        if len(xs) == 0:
+            return None
+        (x0, y0, x1, y1) = (int(xs.min()), int(ys.min()), int(xs.max()) + 1, int(ys.max()) + 1)
+        hull = numpy.ascontiguousarray(hull_mask[y0:y1, x0:x1])
+        self.regions[name] = (hull_mask, (x0, y0, x1, y1), hull, len(xs))
+        return self.regions[name]
+
+    def add_sample(self, seconds):
+        if self.estimate is None:
+            (self.estimate, self.jitter) = (seconds, seconds / 2)
+        else:
+            self.jitter = (1 - self.beta) * self.jitter + self.beta * abs(self.estimate - seconds)
+            self.estimate = (1 - self.alpha) * self.estimate + self.alpha * seconds
+        self.samples += 1
+        self.last_sample = seconds
+        self.histogram.record(seconds)
+        return seconds
+
+    def is_calibrated(self):
+        return self.estimate is not None and self.samples >= self.min_samples
+
+    def horizon(self, default):
+        "How far ahead (milliseconds) to predict the ball: measured latency, or `default` until there is enough samples"
+        if not(self.is_calibrated()):
+            return default
+        return self.estimate * 1000
+
+    def timing_error(self, default, low=0.05, high=0.5):
+        "Relative +/- window around horizon, wide enough for two jitters either way"
+        if not(self.is_calibrated()) or self.estimate <= 0:
+            return default
+        return min(max(2 * self.jitter / self.estimate, low), high)
+
+    def summary(self):
+        fired = ""
+        if self.fired_histogram.count:
+            fired = ", fired {:.0f}ms after capture".format(self.fired_histogram.percentile(50) / 1000.0)
+        if self.estimate is None:
+            return "latency unknown" + fired
+        return "latency {:.0f}ms +/-{:.0f}ms ({} samples, {} missed, {} busy){}".format(
+            self.estimate * 1000, self.jitter * 1000, self.samples, self.missed, self.busy, fired)
+
+    def save(self, calibration):
+        "Adds estimate to `lib.calibration.Calibration`, so the next start does not begin from scratch"
+        if self.estimate is not None:
+            calibration.meta['latency'] = {'estimate': self.estimate, 'jitter': self.jitter, 'samples': self.samples}
+
+    @classmethod
+    def load(cls, calibration, flippers, **kwargs):
+        "Estimator starting from estimate stored in calibration, if there is one"
+        stored = calibration.meta.get('latency', {}) if calibration is not None else {}
+        return cls(flippers, stored.get('estimate'), stored.get('jitter'), stored.get('samples', 0), **kwargs)
@@ -0,0 +1,155 @@
+import json
+import os
+import threading
+from datetime import datetime
+import time
+
+# Monotonic, high resolution clock for measuring durations (seconds). Not related to wall time.
+clock = getattr(time, 'perf_counter', time.time)
+
+
+class LatencyHistogram(object):
+    """Log-linear (HDR style) histogram of durations, with microsecond resolution.
+
+    Every power of two is split into `SUB_BUCKETS` linear buckets, so percentiles are within ~3%
+    of the real value, while recording stays a couple of integer operations and a list increment.
+    """
+
+    SUB_BITS = 5
+    SUB_BUCKETS = 1 << SUB_BITS
+    # Up to 2^26 us (~67s), anything above goes into the last bucket
+    MAX_EXPONENT = 26
+
+    def __init__(self):
+        self.counts = [0] * ((self.MAX_EXPONENT - self.SUB_BITS + 2) * self.SUB_BUCKETS)
+        self.reset()
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, seconds):
+        micros = int(seconds * 1000000)
+        if micros < 0:
+            micros = 0
+        self.counts[self.__index(micros)] += 1
+        self.count += 1
+        self.total += micros
+        if micros > self.max:
+            self.max = micros
+
+    def __index(self, micros):
+        if micros < self.SUB_BUCKETS:
+            return micros
+        shift = micros.bit_length() - self.SUB_BITS - 1
+        return min((shift + 1) * self.SUB_BUCKETS + (micros >> shift) - self.SUB_BUCKETS, len(self.counts) - 1)
+
+    def __value(self, index):
+        "Highest value (us) that falls into bucket"
+        if index < self.SUB_BUCKETS:
+            return index
+        shift = index // self.SUB_BUCKETS - 1
+        return (((index % self.SUB_BUCKETS) + self.SUB_BUCKETS + 1) << shift) - 1
+
+    def percentile(self, p):
+        "Value (microseconds) below which `p` percent of recorded durations fall"
+        if self.count == 0:
+            return 0
+        target = max(1, int(round(self.count * p / 100.0)))
+        seen = 0
+        for (index, n) in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return min(self.__value(index), self.max)
+        return self.max
+
+    def summary(self):
+        "Milliseconds, as that's what our latency budget is in"
+        return {
+            'count': self.count,
+            'mean': round(self.total / 1000.0 / self.count, 3) if self.count else 0,
+            'p50': self.percentile(50) / 1000.0,
+            'p99': self.percentile(99) / 1000.0,
+            'max': self.max / 1000.0,
+        }
+
+
+class Metrics(object):
+    """Per-stage latency histograms, flushed as JSON lines every `interval` seconds.
+
+    Intended flow is:
+
+        metrics = Metrics('./log')
+        while(frame):
+            t = clock()
+            blurred = cv2.GaussianBlur(...)
+            t = metrics.mark('blur', t)
+            mask = subtractor.apply(blurred)
+            t = metrics.mark('subtraction', t)
+            ...
+            metrics.tick()
+
+    Histograms are reset after each flush, so every line describes one interval. Other threads
+    (e.g. `communication.actuator.Actuator` reader) may record too.
+    """
+
+    def __init__(self, directory='./log', interval=10.0, name=None):
+        self.interval = interval
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.path = None
+        self.file = None
+        if interval > 0:
+            if name is None:
+                name = "metrics-{}.jsonl".format(datetime.now().strftime('%Y%m%d-%H%M%S'))
+            self.path = os.path.join(directory, name)
+        self.last_flush = clock()
+
+    def record(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def mark(self, stage, start):
+        "Records time since `start` for the stage, and returns current time, so it can start the next one"
+        now = clock()
+        self.record(stage, now - start)
+        return now
+
+    def tick(self):
+        "Call once per frame. Flushes when the interval is over"
+        self.frames += 1
+        if self.path is not None and clock() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        now = clock()
+        with self.lock:
+            stages = dict((stage, h.summary()) for (stage, h) in self.histograms.items() if h.count)
+            for h in self.histograms.values():
+                h.reset()
+        line = {
+            'time': datetime.now().isoformat(),
+            'interval': round(now - self.last_flush, 3),
+            'frames': self.frames,
+            'stages': stages,
+        }
+        if self.file is None:
+            self.file = open(self.path, 'a')
+        self.file.write(json.dumps(line, sort_keys=True) + "\n")
+        self.file.flush()
+        self.frames = 0
+        self.last_flush = now
+
+    def close(self):
+        if self.path is not None and self.frames:
+            self.flush()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,235 @@
+import cv2
+import multiprocessing
+import numpy
+import signal
+import threading
+from .metrics import clock
+from .blobs import extract
+from .buffers import Workspace
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+# Track script is not import safe, so workers have to be forked rather than spawned
+if hasattr(multiprocessing, 'get_context'):
+    _context = multiprocessing.get_context('fork')
+else:  # Python 2 only forks anyway
+    _context = multiprocessing
+
+
+class FrameRing(object):
+    """Fixed set of frame and mask slots in shared memory, visible to every pipeline process.
+
+    Only slot numbers and small metadata travel through the queues, so pixel data is never pickled.
+    """
+
+    def __init__(self, slots, width, height, channels=3):
+        self.slots = slots
+        self.frame_shape = (height, width, channels)
+        self.mask_shape = (height, width)
+        self.frame_buffer = _context.RawArray('B', slots * height * width * channels)
+        self.mask_buffer = _context.RawArray('B', slots * height * width)
+        self.views = None
+
+    def __getstate__(self):
+        # numpy views are per process, recreated on first use
+        state = self.__dict__.copy()
+        state['views'] = None
+        return state
+
+    def frame(self, slot):
+        return self.__get_views()[0][slot]
+
+    def mask(self, slot):
+        return self.__get_views()[1][slot]
+
+    def __get_views(self):
+        if self.views is None:
+            frames = numpy.frombuffer(self.frame_buffer, dtype=numpy.uint8).reshape((self.slots,) + self.frame_shape)
+            masks = numpy.frombuffer(self.mask_buffer, dtype=numpy.uint8).reshape((self.slots,) + self.mask_shape)
+            self.views = (frames, masks)
+        return self.views
+
+
+class SubtractStage(object):
+    """Background subtraction with `engine` (`lib.detection.Engine`). Writes foreground mask into the slot.
+
+    With `background` (`lib.background.BackgroundModel`) engine is trained from it before the first frame.
+    """
+
+    def __init__(self, roi, engine, background=None):
+        self.roi = roi
+        self.engine = engine
+        self.background = background
+
+    def setup(self):
+        if self.background is not None:
+            self.background.prime(self.engine, self.engine.training_frames, self.roi.crop)
+
+    def process(self, frame, mask, item):
+        numpy.copyto(self.roi.crop(mask), self.engine.apply(self.roi.crop(frame)))
+        item['timings'].update(self.engine.timings)
+
+
+class ExtractStage(object):
+    """Morphology and blob extraction. Adds frame space `blobs` (`lib.blobs.BLOB_DTYPE` array) to the item.
+
+    Cleaned mask goes back into the slot, so whatever looks at the mask after detection (flipper latency, online
+    training, flight recorder) sees the same one the blobs came from, wherever the stages run.
+    """
+
+    def __init__(self, roi):
+        self.roi = roi
+        self.workspace = Workspace()
+
+    def setup(self):
+        pass
+
+    def process(self, frame, mask, item):
+        t = clock()
+        mask = self.roi.crop(mask)
+        cleaned = cv2.erode(mask, None, dst=self.workspace.get('eroded', mask.shape), iterations=3)
+        cleaned = cv2.dilate(cleaned, None, dst=self.workspace.get('cleaned', mask.shape), iterations=1)
+        numpy.copyto(mask, cleaned)
+        item['timings']['morphology'] = clock() - t
+        t = clock()
+        item['blobs'] = extract(cleaned, self.roi.offset, workspace=self.workspace)
+        item['timings']['blobs'] = clock() - t
+
+
+def _get(inbox, stopping, timeout=0.1):
+    "Next item from `inbox`, or None once `stopping` (event) is set, so a dead neighbour can't hang us"
+    while not(stopping.is_set()):
+        try:
+            return inbox.get(timeout=timeout)
+        except queue.Empty:
+            continue
+    return None
+
+
+def _put(outbox, item, stopping, timeout=0.1):
+    while not(stopping.is_set()):
+        try:
+            return outbox.put(item, timeout=timeout)
+        except queue.Full:
+            continue
+
+
+def _work(stage, ring, inbox, outbox, stopping):
+    # Ctrl+C is handled by the main process, which shuts us down through `stopping` or the queues
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    stage.setup()
+    while True:
+        item = _get(inbox, stopping)
+        if item is None:
+            _put(outbox, None, stopping)
+            if stopping.is_set():
+                # Nobody may read what's left in the queue, don't wait for it to be flushed on exit
+                outbox.cancel_join_thread()
+            return
+        stage.process(ring.frame(item['slot']), ring.mask(item['slot']), item)
+        _put(outbox, item, stopping)
+
+
+class Pipeline(object):
+    """Runs frame processing stages in separate processes, connected by bounded queues.
+
+    Intended flow is:
+
+        pipeline = Pipeline([SubtractStage(...), ExtractStage(...)], width, height)
+        pipeline.start(stream)
+        for item in pipeline.results():
+            frame = pipeline.ring.frame(item['slot'])
+            ...  # decide, using item['blobs']
+            pipeline.release(item)
+        pipeline.stop()
+
+    Every stage is a single process and queues are FIFO, so items come out in capture order,
+    carrying their original frame number and timestamp. Stages report their own durations in `item['timings']`.
+    """
+
+    def __init__(self, stages, width, height, queue_size=2, lossless=False):
+        self.lossless = lossless
+        # Enough slots for every queue to be full, every stage busy, plus one being fed and one being consumed
+        slots = (len(stages) + 1) * queue_size + len(stages) + 2
+        self.ring = FrameRing(slots, width, height)
+        self.free = queue.Queue()
+        for slot in range(slots):
+            self.free.put(slot)
+        self.queues = [_context.Queue(queue_size) for _ in range(len(stages) + 1)]
+        # Set on stop(), workers check it while waiting on their queues
+        self.stopping = _context.Event()
+        self.workers = [_context.Process(target=_work, args=(stage, self.ring, self.queues[n], self.queues[n+1],
+                                                             self.stopping))
+                        for (n, stage) in enumerate(stages)]
+        for w in self.workers:
+            w.daemon = True
+        # Frames we skipped because all slots were busy (only when not lossless)
+        self.frames_dropped = 0
+        self.stopRequest = False
+
+    def start(self, stream):
+        for w in self.workers:
+            w.start()
+        self.feeder = threading.Thread(target=self.feed, args=(stream,))
+        self.feeder.daemon = True
+        self.feeder.start()
+        return self
+
+    def feed(self, stream):
+        while not(self.stopRequest):
+            data = stream.read_next(timeout=0.1)
+            if data is None:
+                continue
+            if data['stopped']:
+                break
+            slot = self.__get_free_slot()
+            if slot is None:
+                self.frames_dropped += 1
+                continue
+            numpy.copyto(self.ring.frame(slot), data['frame'])
+            _put(self.queues[0], {'slot': slot, 'number': data['number'], 'timestamp': data['timestamp'],
+                                  'captured': data['captured'], 'timings': {}}, self.stopping)
+        _put(self.queues[0], None, self.stopping)
+
+    def __get_free_slot(self):
+        if not(self.lossless):
+            try:
+                return self.free.get(block=False)
+            except queue.Empty:
+                return None
+        while not(self.stopRequest):
+            try:
+                return self.free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def results(self, should_stop=None):
+        "Yields processed items in capture order until the stream ends, a stage dies, or `should_stop()` is true"
+        while not(self.stopRequest or (should_stop is not None and should_stop())):
+            try:
+                item = self.queues[-1].get(timeout=0.1)
+            except queue.Empty:
+                # Stages that saw the end of stream exit with 0, one that crashed or was killed does not
+                if all(w.exitcode in (None, 0) for w in self.workers):
+                    continue
+                print("Pipeline stage died, stopping")
+                return
+            if item is None:
+                return
+            yield item
+
+    def release(self, item):
+        "Returns item's slot to the pool. Frame and mask views must not be used after that"
+        self.free.put(item['slot'])
+
+    def stop(self):
+        self.stopRequest = True
+        self.stopping.set()
+        for w in self.workers:
+            w.join(1)
+            if w.is_alive():
+                w.terminate()
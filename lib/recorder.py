@@ -0,0 +1,163 @@
+import json
+import os
+import struct
+import numpy
+from time import sleep
+
+MAGIC = b'PINBOTR\x00'
+VERSION = 1
+# magic, format version, length of JSON header that follows
+PREAMBLE = struct.Struct('<8sHI')
+# Control words and slots start on page boundaries
+ALIGN = 4096
+# Bits of slot 'fired'
+FIRED = {'A': 1, 'B': 2}
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def slot_dtype(width, height, max_lines):
+    return numpy.dtype([
+        ('number', '<i8'),  # frame number, -1 while the slot is being written or was never used
+        ('time_ms', '<f8'),  # frame time, milliseconds since start of the game
+        ('captured', '<f8'),  # lib.metrics.clock() when the frame was captured
+        ('fired', 'u1'),  # FIRED bits of flippers pressed on this frame
+        ('line_count', '<u2'),
+        ('mask_roi', '<i4', (4,)),  # x, y, w, h of the part of `mask` written for this frame
+        ('lines', '<i4', (max_lines, 4)),  # predicted segments, x0, y0, x1, y1
+        ('frame', 'u1', (height, width, 3)),
+        ('mask', 'u1', (height, width)),
+    ])
+
+
+class FlightRecorder(object):
+    """Last `slots` frames of the game, with their subtraction masks, predicted lines and presses,
+    in a memory mapped ring file.
+
+    File is preallocated once, every frame costs a copy of the frame and mask into the map, nothing is
+    encoded. Writing is left to the OS page cache, so keep the file on tmpfs to spare the disk.
+    Two control words shared through the file (frozen flag and write counter) let another process
+    freeze a running recorder and copy the window out, see `blackbox.py`.
+
+        recorder = FlightRecorder('./tmp/flight.rec', 640, 480, slots=300)
+        while(frame):
+            recorder.record(number, time_ms, captured, frame, mask, roi.offset, lines['future'], FIRED['A'])
+        recorder.dump('./tmp/flight-miss.rec')  # freezes, copies the window in capture order, resumes
+
+    A dump is a recording file itself, `FlightRecorder.open()` reads both.
+    """
+
+    def __init__(self, path, width, height, slots=300, max_lines=32, create=True):
+        self.path = path
+        self.width = int(width)
+        self.height = int(height)
+        self.slot_count = int(slots)
+        self.max_lines = int(max_lines)
+        self.dtype = slot_dtype(self.width, self.height, self.max_lines)
+        header = json.dumps({'width': self.width, 'height': self.height, 'slots': self.slot_count,
+                             'max_lines': self.max_lines}, sort_keys=True).encode('utf-8')
+        control = _align(PREAMBLE.size + len(header))
+        start = control + ALIGN
+        if create:
+            with open(path, 'wb') as f:
+                f.write(PREAMBLE.pack(MAGIC, VERSION, len(header)))
+                f.write(header)
+                f.truncate(start + self.slot_count * self.dtype.itemsize)
+                if hasattr(os, 'posix_fallocate'):
+                    # Reserve the space now, rather than finding out the disk is full in the middle of a game
+                    os.posix_fallocate(f.fileno(), 0, start + self.slot_count * self.dtype.itemsize)
+        # frozen flag, number of records written so far
+        self.control = numpy.memmap(path, dtype='<u8', mode='r+', offset=control, shape=(2,))
+        self.slots = numpy.memmap(path, dtype=self.dtype, mode='r+', offset=start, shape=(self.slot_count,))
+        if create:
+            self.slots['number'] = -1
+        # Frames not recorded because recorder was frozen
+        self.frames_skipped = 0
+
+    @classmethod
+    def open(cls, path):
+        "Existing recording, a running recorder's ring or a dump"
+        with open(path, 'rb') as f:
+            preamble = f.read(PREAMBLE.size)
+            if len(preamble) < PREAMBLE.size:
+                raise ValueError("{} is not a flight recording".format(path))
+            (magic, version, length) = PREAMBLE.unpack(preamble)
+            if magic != MAGIC:
+                raise ValueError("{} is not a flight recording".format(path))
+            if version > VERSION:
+                raise ValueError("{} is recording version {}, only up to {} is supported".format(path, version, VERSION))
+            header = json.loads(f.read(length).decode('utf-8'))
+        return cls(path, header['width'], header['height'], header['slots'], header['max_lines'], create=False)
+
+    def record(self, number, time_ms, captured, frame, mask=None, mask_offset=(0, 0), lines=(), fired=0):
+        """Writes a frame into the oldest slot. Returns False if recorder is frozen.
+
+        `mask` can be a crop (e.g. region of interest) at `mask_offset`, `lines` anything that reshapes into
+        rows of x0, y0, x1, y1 (e.g. `lines['future']`), only first `max_lines` of them are kept.
+        """
+        if self.control[0]:
+            self.frames_skipped += 1
+            return False
+        written = int(self.control[1])
+        slot = written % self.slot_count
+        # Invalid until fully written, in case someone copies it meanwhile
+        self.slots['number'][slot] = -1
+        numpy.copyto(self.slots['frame'][slot], frame)
+        if mask is not None:
+            (x, y) = mask_offset
+            (h, w) = mask.shape[:2]
+            numpy.copyto(self.slots['mask'][slot][y:y + h, x:x + w], mask)
+            self.slots['mask_roi'][slot] = (x, y, w, h)
+        else:
+            self.slots['mask_roi'][slot] = (0, 0, 0, 0)
+        segments = numpy.asarray(lines, dtype=numpy.int32).reshape(-1, 4)[:self.max_lines]
+        self.slots['lines'][slot][:len(segments)] = segments
+        self.slots['line_count'][slot] = len(segments)
+        self.slots['time_ms'][slot] = time_ms
+        self.slots['captured'][slot] = captured
+        self.slots['fired'][slot] = fired
+        self.slots['number'][slot] = number
+        self.control[1] = written + 1
+        return True
+
+    def freeze(self):
+        self.control[0] = 1
+
+    def resume(self):
+        self.control[0] = 0
+
+    def is_frozen(self):
+        return bool(self.control[0])
+
+    def order(self):
+        "Indexes of recorded slots, oldest frame first"
+        numbers = numpy.array(self.slots['number'])
+        used = numpy.flatnonzero(numbers >= 0)
+        return used[numpy.argsort(numbers[used], kind='stable')]
+
+    def dump(self, path, settle=0.1):
+        """Copies recorded window to a new recording at `path`, oldest frame first. Returns number of frames.
+
+        Recorder is frozen meanwhile, `settle` seconds are given to a write that might be in progress
+        in another thread or process. It's resumed afterwards, unless it was frozen already.
+        """
+        frozen = self.is_frozen()
+        self.freeze()
+        sleep(settle)
+        order = self.order()
+        copy = FlightRecorder(path, self.width, self.height, max(len(order), 1), self.max_lines)
+        # One slot at a time, the whole window may not fit in memory
+        for (n, slot) in enumerate(order):
+            copy.slots[n] = self.slots[slot]
+        copy.control[1] = len(order)
+        copy.close()
+        if not(frozen):
+            self.resume()
+        return len(order)
+
+    def close(self):
+        self.slots.flush()
+        self.control.flush()
+        self.slots = self.control = None
@@ -0,0 +1,112 @@
+import cv2
+import os
+from threading import Thread, Lock
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+
+def point(p):
+    # OpenCV drawing functions want plain int tuples
+    return (int(p[0]), int(p[1]))
+
+
+def draw(frame, blobs, lines, frame_text, areas=()):
+    "Burns debugging annotations into the frame"
+    # Draw contours that define target area from flippers
+    if len(areas) > 0:
+        cv2.drawContours(frame, areas, -1, (255, 0, 0), 3)
+    # Draw all blobs currently found in the frame, unless they are too small
+    for (x, y, w, h) in blobs['box'][blobs['area'] >= 80]:
+        cv2.rectangle(frame, point((x, y)), point((x + w, y + h)), (0, 255, 0), 2)
+    for l in lines:
+        cv2.line(frame, point(l['past']), point(l['present']), (0, 0, 255))
+        cv2.line(frame, point(l['future'][0]), point(l['future'][1]), (255, 255, 0), 2)
+        # # This can be used to troubleshoot filter by areas
+        # cv2.putText(frame, "{0}".format(l['present_area']), point(l['present']), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+    for i, line in enumerate(frame_text):
+        y = 21 + i*20
+        cv2.putText(frame, line, (1, y), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2, cv2.LINE_AA)
+
+
+class RenderSink(object):
+    """Annotates and records frames on its own thread, away from the control loop.
+
+    Snapshots go through a small bounded queue. When drawing or encoding falls behind, new
+    snapshots are dropped (and counted) instead of making the caller wait. HighGUI only works
+    from the main thread (macOS), so finished frames are shown by `display()`, called from there.
+    """
+
+    def __init__(self, show=False, out=None, size=(640, 480), fps=10.0, queue_size=4):
+        self.show = show
+        self.queue = queue.Queue(queue_size)
+        self.writer = None
+        if out:
+            if (os.path.isfile(out)):
+                os.remove(out)
+            fourcc = cv2.VideoWriter_fourcc(*'avc1')
+            self.writer = cv2.VideoWriter(out, fourcc, fps, size)
+        self.frames_rendered = 0
+        self.frames_dropped = 0
+        # Set when 'q' is pressed in the preview window
+        self.quit_requested = False
+        # Newest drawn frame, waiting for display()
+        self.finished = None
+        self.lock = Lock()
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.run, args=())
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def submit(self, frame, blobs, lines, frame_text, areas=(), copy=True):
+        """Queues a snapshot for rendering. Returns False if it was dropped.
+
+        Frame is copied only when accepted, pass `copy=False` if caller won't touch it any more.
+        """
+        if self.queue.full():
+            self.frames_dropped += 1
+            return False
+        try:
+            self.queue.put_nowait((frame.copy() if copy else frame, blobs, lines, frame_text, areas))
+        except queue.Full:
+            self.frames_dropped += 1
+            return False
+        return True
+
+    def run(self):
+        while True:
+            snapshot = self.queue.get()
+            if snapshot is None:
+                return
+            (frame, blobs, lines, frame_text, areas) = snapshot
+            draw(frame, blobs, lines, frame_text, areas)
+            if self.writer is not None:
+                self.writer.write(frame)
+            if self.show:
+                with self.lock:
+                    self.finished = frame
+            self.frames_rendered += 1
+
+    def display(self):
+        "Shows the newest finished frame, if there is one. Has to be called from the main thread"
+        with self.lock:
+            (frame, self.finished) = (self.finished, None)
+        if frame is None:
+            return
+        cv2.imshow("Original", frame)
+        if (cv2.waitKey(1) & 0xFF) == ord("q"):
+            self.quit_requested = True
+
+    def stop(self):
+        "Renders whatever is queued already, then releases the window and video file"
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+        if self.writer is not None:
+            self.writer.release()
+        if self.show:
+            cv2.destroyAllWindows()
@@ -0,0 +1,74 @@
+import numpy
+
+
+class RegionOfInterest(object):
+    """Rectangular part of the frame detection runs on.
+
+    Cropping is a numpy slice, so it does not copy the frame. Anything found in the crop
+    has to be shifted by `offset` to get back to frame coordinates (e.g. `cv2.findContours(..., offset=roi.offset)`).
+    """
+
+    def __init__(self, x, y, w, h):
+        self.x = int(x)
+        self.y = int(y)
+        self.w = int(w)
+        self.h = int(h)
+
+    @property
+    def offset(self):
+        return (self.x, self.y)
+
+    @property
+    def size(self):
+        return (self.w, self.h)
+
+    def crop(self, frame):
+        return frame[self.y:self.y + self.h, self.x:self.x + self.w]
+
+    def clip(self, width, height):
+        "Returns the same region limited to (width, height) frame"
+        x0 = min(max(self.x, 0), width)
+        y0 = min(max(self.y, 0), height)
+        x1 = min(max(self.x + self.w, 0), width)
+        y1 = min(max(self.y + self.h, 0), height)
+        return RegionOfInterest(x0, y0, x1 - x0, y1 - y0)
+
+    def is_empty(self):
+        return self.w <= 0 or self.h <= 0
+
+    def __repr__(self):
+        return "RegionOfInterest({}, {}, {}, {})".format(self.x, self.y, self.w, self.h)
+
+    @classmethod
+    def full(cls, width, height):
+        return cls(0, 0, width, height)
+
+    @classmethod
+    def parse(cls, text, width=None, height=None):
+        "Parses 'x,y,w,h' string, clipped to (width, height) frame if it's given. Raises ValueError if it's not that"
+        try:
+            (x, y, w, h) = [int(v) for v in text.split(',')]
+        except ValueError:
+            raise ValueError("expected x,y,w,h in pixels, got {!r}".format(text))
+        if w <= 0 or h <= 0:
+            raise ValueError("width and height have to be positive, got {!r}".format(text))
+        roi = cls(x, y, w, h)
+        return roi.clip(width, height) if width is not None else roi
+
+    @classmethod
+    def from_flippers(cls, flippers, margin, width, height):
+        """Bounding box of all trained flipper hulls, grown by `margin` pixels in every direction.
+
+        Margin should cover how far the ball can travel within prediction window, so it is seen
+        at least couple of frames before it reaches the flipper. Hulls are read as `Flipper.hulls`, which
+        retraining swaps as a whole, so they can be compared by identity to find out the region is stale.
+        """
+        bounds = [b for f in flippers for (_, b) in f.hulls]
+        if not bounds:
+            return cls.full(width, height)
+        bounds = numpy.array(bounds)
+        x0 = int(numpy.floor(bounds[:, 0].min() - margin))
+        y0 = int(numpy.floor(bounds[:, 1].min() - margin))
+        x1 = int(numpy.ceil(bounds[:, 2].max() + margin)) + 1
+        y1 = int(numpy.ceil(bounds[:, 3].max() + margin)) + 1
+        return cls(x0, y0, x1 - x0, y1 - y0).clip(width, height)
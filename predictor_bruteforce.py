@@ -1,10 +1,25 @@
 import cv2
 from datetime import datetime
 import math
+import numpy
+from lib.blobs import from_contours, filter_area
+
+# One candidate trajectory per row. `future` holds [future_min, future_max] points, so
+# `lines['future']` can be passed straight into `Flipper.check_lines`.
+LINE_DTYPE = numpy.dtype([
+    ('past', numpy.int32, (2,)),
+    ('present', numpy.int32, (2,)),
+    ('present_area', numpy.float64),
+    ('speed', numpy.float64),
+    ('future', numpy.int32, (2, 2)),
+])
 
 
 class Bruteforce(object):
 
+    # Below this many possible pairs it's cheaper to just compare everything with everything
+    grid_min_pairs = 64
+
     # min_area: minimum contour area to be considered a plausible ball
     # max_area: maximum -----------||----------------
     # max_speed: maximum speed (pixels per millisecond) to be considered plausible travel
@@ -16,16 +31,13 @@ class Bruteforce(object):
         self.contour_sets = []
 
     def add_contours(self, contours, time):
-        filtered_contours = []
-        for c in contours:
-            if (cv2.contourArea(c) < self.min_area or cv2.contourArea(c) > self.max_area):
-                continue
-            filtered_contours.append({
-                "contour": c,
-                "center": self.get_center_of_mass(c),
-                "area": cv2.contourArea(c)
-            })
-        self.contour_sets.insert(0, {"time": time, "contours": filtered_contours})
+        self.add_blobs(from_contours(contours), time)
+
+    def add_blobs(self, blobs, time):
+        "Takes `lib.blobs.BLOB_DTYPE` array, as from `lib.blobs.extract`"
+        blobs = filter_area(blobs, self.min_area, self.max_area)
+        centers = blobs['center'].astype(numpy.int32)
+        self.contour_sets.insert(0, {"time": time, "centers": centers, "areas": blobs['area']})
         if (len(self.contour_sets) > 2):
             # Remove oldest element and discard it, as we're only tracking 2 latest sets
             self.contour_sets.pop()
@@ -34,49 +46,68 @@ class Bruteforce(object):
     # timing_error defines +/- range to apply for future prediction. E.g. 0.1 means +/- 10%, so 60 becomes 54-66ms
     def get_lines(self, future=60, timing_error=0.25):
         if (len(self.contour_sets) < 2):
-            return iter(())
+            return numpy.zeros(0, dtype=LINE_DTYPE)
         # time difference between lines
-        delta = (self.contour_sets[0]["time"] - self.contour_sets[1]["time"]).microseconds
-        lines = []
-        for i in self.contour_sets[0]['contours']:
-            for j in self.contour_sets[1]['contours']:
-                speed = self.get_speed(past=j['center'], present=i['center'], millis=delta/1000.0)
-                if (speed>self.max_speed):
-                    # print("Speed is too high: %.06f (limit: %.06f)" % (speed, self.max_speed))
-                    continue
-                future_x_min = self.get_future(
-                    past=j['center'][0],
-                    present=i['center'][0],
-                    delta_micros=delta,
-                    future_ms=future*(1.0-timing_error)
-                )
-                future_y_min = self.get_future(
-                    past=j['center'][1],
-                    present=i['center'][1],
-                    delta_micros=delta,
-                    future_ms=future*(1.0-timing_error)
-                )
-                future_x_max = self.get_future(
-                    past=j['center'][0],
-                    present=i['center'][0],
-                    delta_micros=delta,
-                    future_ms=future*(1.0+timing_error)
-                )
-                future_y_max = self.get_future(
-                    past=j['center'][1],
-                    present=i['center'][1],
-                    delta_micros=delta,
-                    future_ms=future*(1.0+timing_error)
-                )
-                lines.append({
-                    'past': i['center'],
-                    'present': j['center'],
-                    'present_area': j['area'],
-                    'future_min': (future_x_min, future_y_min),
-                    'future_max': (future_x_max, future_y_max)
-                })
+        diff = self.contour_sets[0]["time"] - self.contour_sets[1]["time"]
+        delta = diff.seconds * 1000000 + diff.microseconds
+        if delta <= 0:
+            return numpy.zeros(0, dtype=LINE_DTYPE)
+        present = self.contour_sets[0]["centers"]
+        past = self.contour_sets[1]["centers"]
+
+        (i, j) = self.get_pairs(present, past, self.max_speed * delta / 1000.0)
+        move = (present[i] - past[j]).astype(numpy.float64)
+        speed = numpy.sqrt((move ** 2).sum(axis=1)) / (delta / 1000.0)
+        plausible = speed <= self.max_speed
+        (i, j, move) = (i[plausible], j[plausible], move[plausible])
+
+        lines = numpy.zeros(len(i), dtype=LINE_DTYPE)
+        lines['past'] = present[i]
+        lines['present'] = past[j]
+        lines['present_area'] = self.contour_sets[1]["areas"][j]
+        lines['speed'] = speed[plausible]
+        # Same as get_future(), for both ends of the window at once
+        velocity = move / float(delta)
+        for (n, future_ms) in enumerate((future*(1.0-timing_error), future*(1.0+timing_error))):
+            lines['future'][:, n] = (present[i] + velocity * future_ms * 1000).astype(numpy.int32)
         return lines
 
+    def get_pairs(self, present, past, max_distance):
+        """Returns (present index, past index) arrays of pairs that could be within `max_distance`.
+
+        Bins past centers into a grid with `max_distance` cells, so every present center only
+        needs to look at 3x3 neighbouring cells. Pairs are a superset; exact distance check is up to caller.
+        """
+        (n, m) = (len(present), len(past))
+        if n * m <= self.grid_min_pairs or max_distance <= 0:
+            return (numpy.repeat(numpy.arange(n), m), numpy.tile(numpy.arange(m), n))
+
+        stride = 1 << 20
+        cell_present = numpy.floor_divide(present, max_distance).astype(numpy.int64)
+        cell_past = numpy.floor_divide(past, max_distance).astype(numpy.int64)
+        keys_past = cell_past[:, 0] * stride + cell_past[:, 1]
+        order = numpy.argsort(keys_past, kind='mergesort')
+        keys_sorted = keys_past[order]
+
+        pairs_i = []
+        pairs_j = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                keys = (cell_present[:, 0] + dx) * stride + cell_present[:, 1] + dy
+                lo = numpy.searchsorted(keys_sorted, keys, side='left')
+                hi = numpy.searchsorted(keys_sorted, keys, side='right')
+                counts = hi - lo
+                total = counts.sum()
+                if total == 0:
+                    continue
+                starts = numpy.cumsum(counts) - counts
+                offsets = numpy.arange(total) - numpy.repeat(starts, counts)
+                pairs_i.append(numpy.repeat(numpy.arange(n), counts))
+                pairs_j.append(order[numpy.repeat(lo, counts) + offsets])
+        if not pairs_i:
+            return (numpy.zeros(0, dtype=numpy.intp), numpy.zeros(0, dtype=numpy.intp))
+        return (numpy.concatenate(pairs_i), numpy.concatenate(pairs_j))
+
     def get_center_of_mass(self, contour):
         m = cv2.moments(contour)
         return (int(m['m10']/m['m00']), int(m['m01']/m['m00']))
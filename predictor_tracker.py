@@ -0,0 +1,167 @@
+import itertools
+import numpy
+from predictor_bruteforce import LINE_DTYPE
+from lib.blobs import from_contours, filter_area
+
+# Same as predictor_bruteforce.LINE_DTYPE, plus id of the track the line came from
+TRACK_LINE_DTYPE = numpy.dtype(LINE_DTYPE.descr + [('track_id', numpy.int32)])
+
+
+class Track(object):
+    """Single ball candidate with constant velocity (alpha-beta filtered) state."""
+
+    def __init__(self, track_id, position, area, time):
+        self.id = track_id
+        self.position = numpy.array(position, dtype=numpy.float64)
+        self.origin = self.position.copy()
+        self.previous = self.position.copy()
+        self.velocity = numpy.zeros(2)  # pixels per millisecond
+        self.area = area
+        self.time = time
+        self.hits = 1
+        self.misses = 0
+
+    def predict(self, millis):
+        return self.position + self.velocity * millis
+
+    def update(self, position, area, millis, alpha, beta):
+        self.previous = self.position.copy()
+        if self.hits == 1:
+            # Second sighting: nothing to filter yet, velocity comes straight from displacement
+            self.velocity = (position - self.position) / millis
+            self.position = numpy.array(position, dtype=numpy.float64)
+        else:
+            predicted = self.predict(millis)
+            residual = position - predicted
+            self.position = predicted + alpha * residual
+            self.velocity = self.velocity + (beta / millis) * residual
+        self.area = area
+        self.hits += 1
+        self.misses = 0
+
+    def coast(self, millis):
+        self.previous = self.position.copy()
+        self.position = self.predict(millis)
+        self.misses += 1
+
+    def is_parked(self, distance):
+        "True if it never got further than `distance` pixels from where it appeared"
+        return ((self.position - self.origin) ** 2).sum() <= distance ** 2
+
+
+class Tracker(object):
+    """Drop-in replacement for `Bruteforce` that keeps persistent tracks between frames.
+
+    Every frame detections are associated to the nearest predicted track position inside a gate,
+    so cost grows with number of live tracks rather than with all possible pairings.
+    Only confirmed tracks (seen `min_hits` times) produce lines.
+    """
+
+    # min_area: minimum contour area to be considered a plausible ball
+    # max_area: maximum -----------||----------------
+    # max_speed: maximum speed (pixels per millisecond) to be considered plausible travel
+    # min_gate: association radius (pixels) around predicted position for tracks with known velocity
+    # max_tracks: hard limit on live tracks, so clutter can't blow up per-frame cost. Parked and stale tracks
+    #   make room for new ones, see evictable()
+    def __init__(self, min_area, max_area, max_speed, min_gate=10, min_hits=3, max_misses=2, max_tracks=8,
+                 alpha=0.85, beta=0.5):
+        self.min_area = min_area
+        self.max_area = max_area
+        self.max_speed = max_speed
+        self.min_gate = min_gate
+        self.min_hits = min_hits
+        self.max_misses = max_misses
+        self.max_tracks = max_tracks
+        self.alpha = alpha
+        self.beta = beta
+        print("Setup tracker: %d %d %.06f" % (min_area, max_area, max_speed))
+        self.tracks = []
+        self.time = None
+        self.ids = itertools.count(1)
+
+    def add_contours(self, contours, time):
+        self.add_blobs(from_contours(contours), time)
+
+    def add_blobs(self, blobs, time):
+        "Takes `lib.blobs.BLOB_DTYPE` array, as from `lib.blobs.extract`"
+        blobs = filter_area(blobs, self.min_area, self.max_area)
+        self.add_detections(blobs['center'], blobs['area'], time)
+
+    def add_detections(self, centers, areas, time):
+        if self.time is None:
+            # First frame: just seed tracks
+            self.time = time
+            self.spawn(centers, areas, numpy.ones(len(centers), dtype=bool), time)
+            return
+        diff = time - self.time
+        millis = (diff.days * 86400000000 + diff.seconds * 1000000 + diff.microseconds) / 1000.0
+        if millis <= 0:
+            # Clock did not move (duplicate frame): nothing to update velocities with, keep tracks as they are
+            return
+        self.time = time
+
+        matched = self.associate(centers, millis)
+        used = numpy.ones(len(centers), dtype=bool)
+        for (track, det) in zip(self.tracks, matched):
+            if det < 0:
+                track.coast(millis)
+            else:
+                track.update(centers[det], areas[det], millis, self.alpha, self.beta)
+                used[det] = False
+        self.tracks = [t for t in self.tracks if t.misses <= self.max_misses]
+        self.spawn(centers, areas, used, time)
+
+    def associate(self, centers, millis):
+        """Greedy gated nearest neighbour. Returns detection index per track, -1 for no match."""
+        matched = numpy.full(len(self.tracks), -1, dtype=numpy.intp)
+        if len(self.tracks) == 0 or len(centers) == 0:
+            return matched
+        predicted = numpy.array([t.predict(millis) for t in self.tracks])
+        distance = numpy.sqrt(((predicted[:, numpy.newaxis, :] - centers[numpy.newaxis, :, :]) ** 2).sum(axis=2))
+        # Tracks without velocity yet can go anywhere within physically plausible travel
+        gates = numpy.array([self.min_gate + (self.max_speed * millis if t.hits == 1 else 0.5 * self.max_speed * millis)
+                             for t in self.tracks])
+        distance[distance > gates[:, numpy.newaxis]] = numpy.inf
+        for flat in numpy.argsort(distance, axis=None):
+            (ti, di) = numpy.unravel_index(flat, distance.shape)
+            if not numpy.isfinite(distance[ti, di]):
+                break
+            if matched[ti] >= 0 or di in matched:
+                continue
+            matched[ti] = di
+        return matched
+
+    def spawn(self, centers, areas, available, time):
+        for idx in numpy.flatnonzero(available):
+            if len(self.tracks) >= self.max_tracks:
+                victim = self.evictable()
+                if victim is None:
+                    break
+                self.tracks.remove(victim)
+            self.tracks.append(Track(next(self.ids), centers[idx], areas[idx], time))
+
+    def evictable(self):
+        """Track to make room for a new one, so clutter (reflections, lights) can't take all of them: the stalest
+        unconfirmed track (most misses, then fewest hits), or a confirmed one that never moved away from where it
+        appeared. None if all of them are worth keeping.
+        """
+        candidates = [t for t in self.tracks if (t.misses > 0 and t.hits < self.min_hits) or
+                      (t.hits >= self.min_hits and t.is_parked(self.min_gate))]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda t: (-t.misses, t.hits))
+
+    # future defines how many milliseconds in the future we want to find the object
+    # timing_error defines +/- range to apply for future prediction. E.g. 0.1 means +/- 10%, so 60 becomes 54-66ms
+    def get_lines(self, future=60, timing_error=0.25):
+        confirmed = [t for t in self.tracks if t.hits >= self.min_hits and t.misses == 0]
+        lines = numpy.zeros(len(confirmed), dtype=TRACK_LINE_DTYPE)
+        for (n, t) in enumerate(confirmed):
+            lines['past'][n] = t.previous
+            lines['present'][n] = t.position
+            lines['present_area'][n] = t.area
+            lines['speed'][n] = numpy.sqrt((t.velocity ** 2).sum())
+            lines['future'][n, 0] = t.predict(future*(1.0-timing_error))
+            lines['future'][n, 1] = t.predict(future*(1.0+timing_error))
+            lines['track_id'][n] = t.id
+        return lines
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""Replays recorded games through track-ball.py, as fast as the CPU allows, several at a time.
+
+Every recording gets its own process and its own decision log (<log-dir>/<recording>.decisions.jsonl).
+Calibration is only saved if --save-calibration is passed on, and then into <log-dir>/<recording>.calibration.bin.
+Any arguments not known here are passed on to track-ball.py, e.g.:
+
+    python replay.py tmp/games --jobs 4 -- --calibration tmp/calibration.bin
+"""
+
+from __future__ import print_function
+import argparse
+import multiprocessing
+import os
+import subprocess
+import sys
+from multiprocessing.pool import ThreadPool
+
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mov', '.mkv', '.m4v')
+
+
+def find_recordings(paths):
+    recordings = []
+    for path in paths:
+        if os.path.isdir(path):
+            recordings.extend(sorted(os.path.join(path, f) for f in os.listdir(path)
+                                     if f.lower().endswith(VIDEO_EXTENSIONS)))
+        else:
+            recordings.append(path)
+    return recordings
+
+
+def replay(recording, log_dir, extra):
+    name = os.path.splitext(os.path.basename(recording))[0]
+    decisions = os.path.join(log_dir, name + '.decisions.jsonl')
+    if os.path.isfile(decisions):
+        os.remove(decisions)
+    if '--save-calibration' in extra[:-1]:
+        # One file per recording, replays running side by side would overwrite each other's
+        extra = list(extra)
+        extra[extra.index('--save-calibration') + 1] = os.path.join(log_dir, name + '.calibration.bin')
+    with open(os.path.join(log_dir, name + '.out.log'), 'w') as output:
+        # Each recording runs in its own interpreter, so they run on all cores and one crash does not take others
+        code = subprocess.call([sys.executable, 'track-ball.py', '--src', recording, '--replay',
+                                '--decision-log', decisions, '--metrics-interval', '0'] + extra,
+                               stdout=output, stderr=subprocess.STDOUT,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    return (recording, code, decisions)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recordings', nargs='+', help='Video files, or directories with them')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='How many recordings to replay at the same time (all cores by default)')
+    parser.add_argument('--log-dir', default='./log/replay', help='Where to put decision logs and output')
+    (args, extra) = parser.parse_known_args()
+    if extra and extra[0] == '--':
+        extra = extra[1:]
+
+    recordings = [os.path.abspath(r) for r in find_recordings(args.recordings)]
+    log_dir = os.path.abspath(args.log_dir)
+    if not(os.path.isdir(log_dir)):
+        os.makedirs(log_dir)
+    # Threads only wait for the child processes, actual work happens in those
+    pool = ThreadPool(max(1, args.jobs))
+    failed = 0
+    for (recording, code, decisions) in pool.imap_unordered(lambda r: replay(r, log_dir, extra), recordings):
+        if code != 0:
+            failed += 1
+            print("{}: failed with exit code {}".format(recording, code))
+            continue
+        count = 0
+        if os.path.isfile(decisions):
+            with open(decisions) as f:
+                count = sum(1 for _ in f)
+        print("{}: {} decisions in {}".format(recording, count, decisions))
+    pool.close()
+    pool.join()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+"""Plays several tables from one process: every table has its own camera, flippers, predictor and Arduino
+(`table.TableController`), detection for all of them runs on a shared pool of worker processes.
+
+Tables are described in a JSON file, a list of `TableController` arguments:
+
+    [{"name": "left", "src": "0", "port": "/dev/ttyACM0", "calibration": "tmp/left.bin"},
+     {"name": "right", "src": "1", "port": "/dev/ttyACM1", "calibration": "tmp/right.bin", "engine": "absdiff",
+      "capture_profile": "low-latency"}]
+
+    python supervisor.py tables.json --workers 4
+
+Detection stages are forked into the workers at start, so an automatic region of interest ("roi": "auto") stays
+where it was then, even if "online_training" moves flipper areas later.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing
+import numpy
+import signal
+import threading
+from time import sleep
+from table import TableController
+from lib.WebcamVideoStream import DROP_NONE
+from lib.pipeline import FrameRing
+from lib.metrics import clock
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+# Subtractors inside detection stages can't be pickled, so workers have to be forked to get them
+if hasattr(multiprocessing, 'get_context'):
+    _context = multiprocessing.get_context('fork')
+else:  # Python 2 only forks anyway
+    _context = multiprocessing
+
+
+def _serve(tables, inbox):
+    """Worker process: detection for the tables placed on it, in the order frames arrive.
+
+    `tables` maps table index to (stages, ring, outbox, max_age). Background subtraction keeps state between
+    frames, so a table never moves to another worker.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for (stages, _, _, _) in tables.values():
+        for stage in stages:
+            stage.setup()
+    running = len(tables)
+    while running:
+        item = inbox.get()
+        (stages, ring, outbox, max_age) = tables[item['table']]
+        if item['slot'] is None:
+            # That table's stream ended
+            outbox.put(item)
+            running -= 1
+            continue
+        start = clock()
+        item['timings']['queue'] = start - item['fed']
+        # Frame waited too long behind other tables, deciding on it would be too late anyway
+        if max_age and start - item['captured'] > max_age:
+            item['skipped'] = True
+        else:
+            for stage in stages:
+                stage.process(ring.frame(item['slot']), ring.mask(item['slot']), item)
+        outbox.put(item)
+
+
+class Supervisor(object):
+    """Schedules `TableController`s over a shared pool of detection worker processes.
+
+    Tables are placed on workers up front, most expensive engine first, each onto the least loaded one.
+    Latency of one table is kept from spreading to the others: every table has its own few frame slots
+    (when they're all busy, that table's newest frames are dropped, nobody else's), own result queue, and
+    own decision thread. Frames that waited longer than `max_age` seconds for a worker are skipped.
+    Video files (lossless streams) are never dropped or skipped, they wait for a free slot instead.
+
+        supervisor = Supervisor([TableController(...), TableController(...)]).start()
+        supervisor.wait()
+        supervisor.stop()
+    """
+
+    # Relative detection cost of engines, for placement (see benchmark.run --engine)
+    COST = {'absdiff': 1, 'mog2': 2, 'knn': 3, 'mog': 3, 'gmg': 8}
+
+    def __init__(self, tables, workers=None, queue_size=2, max_age=0.1):
+        self.tables = tables
+        self.queue_size = queue_size
+        self.max_age = max_age
+        workers = min(workers or multiprocessing.cpu_count(), len(tables))
+        # One slot being fed, queue_size waiting or in detection, one being decided on
+        slots = queue_size + 2
+        self.rings = [FrameRing(slots, t.width, t.height) for t in tables]
+        self.free = [queue.Queue() for _ in tables]
+        for free in self.free:
+            for slot in range(slots):
+                free.put(slot)
+        self.outboxes = [_context.Queue() for _ in tables]
+        self.inboxes = [_context.Queue() for _ in range(workers)]
+        self.placement = self.place(workers)
+        # Per table counters
+        self.frames_dropped = [0] * len(tables)
+        self.frames_skipped = [0] * len(tables)
+        self.workers = []
+        self.threads = []
+        self.stopRequest = False
+
+    def place(self, workers):
+        "Worker index for every table"
+        load = [0] * workers
+        placement = [None] * len(self.tables)
+        for index in sorted(range(len(self.tables)), key=lambda i: -self.COST.get(self.tables[i].engine.name, 1)):
+            worker = load.index(min(load))
+            placement[index] = worker
+            load[worker] += self.COST.get(self.tables[index].engine.name, 1)
+        return placement
+
+    def start(self):
+        """Starts cameras and Arduinos, checks background, trains flippers of tables that need it (one table at a time,
+        on this thread), and forks the workers with detection state in them
+        """
+        for table in self.tables:
+            table.start()
+        for table in self.tables:
+            table.warm_start()
+        for table in self.tables:
+            if not(table.is_trained() or table.train()):
+                raise ValueError("Table {}: stream ended before flippers were trained".format(table.name))
+        for (worker, inbox) in enumerate(self.inboxes):
+            served = dict((index, (table.stages(), self.rings[index], self.outboxes[index],
+                                   None if table.stream.drop_policy == DROP_NONE else self.max_age))
+                          for (index, table) in enumerate(self.tables) if self.placement[index] == worker)
+            process = _context.Process(target=_serve, args=(served, inbox))
+            process.daemon = True
+            process.start()
+            self.workers.append(process)
+        for index in range(len(self.tables)):
+            for target in (self.feed, self.decide):
+                t = threading.Thread(target=target, args=(index,))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+        return self
+
+    def feed(self, index):
+        table = self.tables[index]
+        lossless = table.stream.drop_policy == DROP_NONE
+        inbox = self.inboxes[self.placement[index]]
+        while not(self.stopRequest):
+            data = table.stream.read_next(timeout=0.1)
+            if data is None:
+                continue
+            if data['stopped']:
+                break
+            slot = self.__get_free_slot(index, lossless)
+            if slot is None:
+                if self.stopRequest:
+                    break
+                self.frames_dropped[index] += 1
+                continue
+            numpy.copyto(self.rings[index].frame(slot), data['frame'])
+            inbox.put({'table': index, 'slot': slot, 'number': data['number'], 'timestamp': data['timestamp'],
+                       'captured': data['captured'], 'fed': clock(), 'timings': {}})
+        inbox.put({'table': index, 'slot': None})
+
+    def __get_free_slot(self, index, lossless):
+        if not(lossless):
+            try:
+                return self.free[index].get(block=False)
+            except queue.Empty:
+                return None
+        while not(self.stopRequest):
+            try:
+                return self.free[index].get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return None
+
+    def decide(self, index):
+        table = self.tables[index]
+        outbox = self.outboxes[index]
+        while True:
+            item = outbox.get()
+            if item['slot'] is None:
+                return
+            if item.get('skipped'):
+                self.frames_skipped[index] += 1
+                table.metrics.record('queue', item['timings']['queue'])
+            else:
+                # Everything from capture up to here is queueing and worker time
+                table.metrics.mark('pipeline_transit', item['captured'])
+                table.handle(item, self.rings[index].frame(item['slot']), self.rings[index].mask(item['slot']))
+            self.free[index].put(item['slot'])
+
+    def is_running(self):
+        "True while any table is still playing"
+        return any(t.is_alive() for t in self.threads)
+
+    def wait(self, status_interval=10.0):
+        "Blocks until all streams end or stop() is called, printing status of every table now and then"
+        last_status = clock()
+        while self.is_running() and not(self.stopRequest):
+            sleep(0.1)
+            if status_interval and clock() - last_status >= status_interval:
+                last_status = clock()
+                for line in self.status():
+                    print(line)
+
+    def status(self):
+        return ["{} (worker {}, {} dropped, {} skipped)".format(
+            table.status(), self.placement[index], self.frames_dropped[index], self.frames_skipped[index])
+            for (index, table) in enumerate(self.tables)]
+
+    def stop(self):
+        self.stopRequest = True
+        for table in self.tables:
+            table.stop()
+        for t in self.threads:
+            t.join(1)
+        for w in self.workers:
+            w.join(1)
+            if w.is_alive():
+                w.terminate()
+        for table in self.tables:
+            table.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('tables', help='JSON file with a list of tables, see above')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(),
+                        help='Detection worker processes, shared by all tables (all cores by default)')
+    parser.add_argument('--max-age', type=float, default=0.1,
+                        help='''Skip frames that waited longer than this (seconds) for a worker. Keeps one slow table
+                            from making decisions late on the others. 0 disables it''')
+    parser.add_argument('--replay', const=True, action='store_const',
+                        help='Tables play video files as fast as possible, with video timestamps for game logic')
+    parser.add_argument('--status-interval', type=float, default=10.0,
+                        help='How often (seconds) to print status of every table')
+    args = parser.parse_args()
+
+    with open(args.tables) as f:
+        config = json.load(f)
+    tables = []
+    for options in config:
+        if args.replay:
+            options['replay'] = True
+        tables.append(TableController(**options))
+    supervisor = Supervisor(tables, workers=args.workers, max_age=args.max_age).start()
+    print("{} tables on {} workers".format(len(tables), len(supervisor.workers)))
+
+    def stop(signum, frame):
+        print('You pressed Ctrl+C!')
+        supervisor.stopRequest = True
+    signal.signal(signal.SIGINT, stop)
+    supervisor.wait(args.status_interval)
+    supervisor.stop()
+    for line in supervisor.status():
+        print(line)
+    print("exiting")
+
+
+if __name__ == '__main__':
+    main()
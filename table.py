@@ -0,0 +1,613 @@
+from __future__ import print_function
+import cv2
+import json
+import numpy
+import os
+from datetime import datetime, timedelta
+from threading import Thread
+from time import sleep
+from communication.arduino import Arduino
+from communication.actuator import Actuator
+from flipper import Flipper
+from predictor_bruteforce import Bruteforce
+from predictor_tracker import Tracker
+from lib.WebcamVideoStream import WebcamVideoStream, DROP_NONE
+from lib.roi import RegionOfInterest
+from lib.pipeline import Pipeline, SubtractStage, ExtractStage
+from lib.metrics import Metrics, clock
+from lib.calibration import Calibration
+from lib.background import BackgroundModel
+from lib.blobs import extract as extract_blobs
+from lib.buffers import Workspace
+from lib.latency import LatencyEstimator
+from lib.hit_table import HitTable
+from lib.recorder import FlightRecorder, FIRED
+from lib import detection
+
+FLIPPERS = ('A', 'B')
+
+
+class TableController(object):
+    """Everything one table needs to play: camera stream, flipper pair, predictor, Arduino and metrics.
+
+    Flippers come from calibration, or are trained here, by pressing them (or going by `press_frames`, frame numbers
+    where they move in a recorded video). After that, detection (`stages()`) and decision (`handle()`) are split, so
+    detection can run right here (`run()`), in processes of its own (`run_pipeline()`) or on a pool shared with other
+    tables (see `supervisor.py`), while decisions and serial commands always stay with the controller:
+
+        table = TableController('left', '0', '/dev/ttyACM0', 'tmp/left.bin').start()
+        table.warm_start()
+        table.run()  # or hand it to Supervisor together with other tables
+        table.close()
+
+    `on_frame(frame, blobs, lines, frame_text)`, if set, is called at the end of every frame, e.g. to show it.
+    """
+
+    def __init__(self, name, src, port, calibration, engine='gmg', training_frames=20, grayscale=False, pyramid=0,
+                 predictor='bruteforce', latency=100, cooldown=300, ball_prediction_time=60, roi=None,
+                 replay=False, metrics_dir='./log', metrics_interval=10.0, decision_log=None, capture_profile=None,
+                 training_engine='mog', fixed_prediction_time=False, exact_hit_test=False, latency_probes=3,
+                 save_calibration=None, calibration_masks='bits', warm_frames=5, online_training=False,
+                 flight_recorder=None, flight_seconds=5.0, press_frames=None, load_masks=None, arduino=None,
+                 fire_delay=40):
+        self.name = name
+        self.latency = latency
+        # With firmware that can fire on schedule, how long after capture (milliseconds). 0 fires on arrival
+        self.fire_delay = fire_delay
+        self.cooldown = cooldown
+        self.ball_prediction_time = ball_prediction_time
+        self.fixed_prediction_time = fixed_prediction_time
+        self.exact_hit_test = exact_hit_test
+        self.training_frames = training_frames
+        self.replay = replay
+        self.roi_setting = roi
+        self.online_training = online_training
+        self.warm_frames = warm_frames
+        # Training by frame numbers of a recorded video ({'A': set(...), 'B': ...}), nothing gets pressed then
+        self.press_frames = dict((f, frames) for (f, frames) in (press_frames or {}).items() if frames)
+        self.calibration_masks = calibration_masks
+        # Replays (often several at once, see replay.py) don't write back to the calibration they started from
+        self.save_path = save_calibration or (None if replay else calibration)
+        # Profile (`lib.capture.PROFILES` name, or the profile) only matters for cameras
+        self.stream = WebcamVideoStream(src, virtual_clock=replay, profile=capture_profile)
+        if self.stream.profile is not None:
+            self.__say("Capture profile {}: camera reports {}".format(self.stream.profile.name, self.stream.settings))
+        # Stream can't tell frame size once it's stopped, and calibration can be saved after that
+        (self.width, self.height) = (int(self.stream.getParam(3)), int(self.stream.getParam(4)))
+        # Kept to start over when detection region moves, see follow_flippers()
+        self.engine_settings = (engine, training_frames, grayscale, pyramid)
+        self.engine = detection.create(*self.engine_settings)
+        # Training looks for whole flipper movement, so no blur there
+        self.training_engine = detection.create(training_engine, training_frames, grayscale, pyramid, blur=0)
+
+        self.flippers = {'A': Flipper(name='right'), 'B': Flipper(name='left')}
+        self.trained = dict((f, False) for f in FLIPPERS)
+        for (f, path) in (load_masks or {}).items():
+            if path:
+                self.flippers[f].load_hull_mask(path)
+                self.trained[f] = self.flippers[f].is_good_mask()
+        self.calibration = None
+        if calibration:
+            self.calibration = Calibration.load(calibration)
+            if self.calibration.fits(self.width, self.height):
+                for f in FLIPPERS:
+                    self.trained[f] = self.trained[f] or self.calibration.apply(self.flippers[f], f)
+                self.__say("Calibration loaded for flippers: {}".format(", ".join(self.calibration.flippers())))
+            else:
+                self.__say("Calibration is for {}x{} frames, ignoring it".format(self.calibration.width,
+                                                                                self.calibration.height))
+                self.calibration = None
+
+        self.predictor = (Tracker if predictor == 'tracker' else Bruteforce)(
+            min_area=int(self.width*self.height/4000),
+            max_area=int(self.width*self.height/20),  # Looks like max area does not make sense to define
+            max_speed=max(self.width, self.height)/500.0  # Limit speed to 10% of the frame in 50 ms
+        )
+        if self.calibration is not None:
+            for (setting, value) in self.calibration.predictor.items():
+                setattr(self.predictor, setting, value)
+        flippers = [(f, self.flippers[f]) for f in FLIPPERS]
+        # Built for trained hulls (in the background if they change), stored with calibration
+        self.hit_table = (HitTable.load(self.calibration, flippers, self.width, self.height) or
+                          HitTable(flippers, self.width, self.height))
+        # Prediction horizon follows measured latency, starting from the one stored in calibration
+        self.latency_estimator = LatencyEstimator.load(self.calibration, self.flippers)
+
+        started = datetime.now().strftime('%Y%m%d-%H%M%S')
+        self.metrics = Metrics(metrics_dir, interval=metrics_interval,
+                               name="metrics-{}-{}.jsonl".format(name, started) if name else None)
+        # Commands are sent from a separate thread, so a slow or stuck port can't hold up the frame loop
+        self.arduino = arduino if arduino is not None else Actuator(Arduino(port), metrics=self.metrics)
+        self.arduino.on_fired = self.fired
+        self.decision_log = open(decision_log, 'a') if decision_log else None
+        self.recorder = None
+        if flight_recorder:
+            self.recorder = FlightRecorder(flight_recorder, self.width, self.height,
+                                           slots=max(int(flight_seconds * (self.stream.getParam(5) or 60)), 1))
+
+        self.time_start = self.stream.epoch if replay else datetime.now()
+        # When command to press the flipper was last sent. Needed to find flipper movement for training,
+        # and not to react to own movement
+        self.time_press = dict((f, self.time_start) for f in FLIPPERS)
+        # Capture time of the current frame, and when we got to it
+        self.time_captured = self.time_frame_read = self.time_start
+        # Monotonic clock (lib.metrics.clock) reading of when current frame was captured, for latency metrics
+        self.captured = 0
+        self.frame_number = 0
+        self.frames_processed = 0
+        self.decisions = 0
+        # Set after a frame with flipper movement went to training, cleared when the flipper is pressed again
+        self.flipper_countour_sent = False
+        # Set when flipper was pressed in the game, until its movement is fed to online training
+        self.refine = dict((f, False) for f in FLIPPERS)
+        # Until subtraction is trained, there's nothing to decide on
+        self.game_start_frame = training_frames + 2
+        # Reference background learned from first frames, to save with calibration
+        self.reference = BackgroundModel()
+        # Set by warm_start() when table matches background from calibration, subtraction is primed from it
+        self.background = None
+        # Flipper presses left to measure latency with, before the game starts
+        self.probes = 0 if (replay or self.press_frames) else 2 * latency_probes
+        # Known once flippers are trained, when in auto mode. Then also flipper hulls and margin it was computed for
+        self.roi = None
+        self.roi_hulls = None
+        self.roi_margin = None
+        # Detection stages and the mask they write, when run() does detection on its own thread
+        self.detection = None
+        self.mask = None
+        # Morphology and labeling outputs of training
+        self.workspace = Workspace()
+        self.pipeline = None
+        self.on_frame = None
+        self.started = False
+        self.stopRequest = False
+
+    def __say(self, message):
+        print("{}: {}".format(self.name, message) if self.name else message)
+
+    def start(self):
+        self.stream.start()
+        self.arduino.start()
+        self.__say("Arduino: {}".format(self.arduino.protocol()))
+        self.started = True
+        return self
+
+    def is_trained(self):
+        return self.trained['A'] and self.trained['B']
+
+    def now(self):
+        "Current time for game logic: wall clock when live, video time of the frame when replaying"
+        return self.time_captured if self.replay else datetime.now()
+
+    def warm_start(self):
+        """Compares first live frames with background stored in calibration. If table still looks the same,
+        subtraction is primed from it (in `stages()`) and the game starts with the first frame. Otherwise everything,
+        flippers too, is trained from scratch. Returns True if it did start warm.
+        """
+        background = BackgroundModel.load(self.calibration) if self.calibration is not None else None
+        if background is None or not(self.is_trained()):
+            return False
+        seen = []
+        while len(seen) < self.warm_frames:
+            data = self.stream.read_next(timeout=1.0)
+            if data is None or data['stopped']:
+                break
+            # Stream reuses the buffer for the next frame
+            seen.append(data['frame'].copy())
+        if not(background.matches(seen)):
+            self.__say("Table does not match calibration background, training from scratch")
+            self.trained = dict((f, False) for f in FLIPPERS)
+            return False
+        self.__say("Table matches calibration background, skipping training")
+        self.reference = self.background = background
+        self.game_start_frame = 0
+        return True
+
+    def get_roi(self):
+        if not(self.roi_setting):
+            return RegionOfInterest.full(self.width, self.height)
+        if self.roi_setting == 'auto':
+            self.roi_hulls = [self.flippers[f].hulls for f in FLIPPERS]
+            self.roi_margin = self.roi_margin_needed()
+            return RegionOfInterest.from_flippers([self.flippers[f] for f in FLIPPERS], self.roi_margin,
+                                                  self.width, self.height)
+        return RegionOfInterest.parse(self.roi_setting, self.width, self.height)
+
+    def roi_margin_needed(self):
+        "How far (pixels) the ball can travel within the far end of prediction window"
+        (future, timing_error) = self.prediction_window()
+        return self.predictor.max_speed * future * (1.0 + timing_error)
+
+    def prediction_window(self):
+        "(milliseconds, relative timing error): how far ahead ball is predicted, and +/- how much around that"
+        if self.fixed_prediction_time:
+            return (self.ball_prediction_time, 0.25)
+        return (self.latency_estimator.horizon(self.ball_prediction_time), self.latency_estimator.timing_error(0.25))
+
+    def stages(self):
+        "Game detection stages, as for `lib.pipeline.Pipeline`. Call setup() on them where they are going to run"
+        if self.roi is None:
+            self.roi = self.get_roi()
+            self.__say("Detection region: {}".format(self.roi))
+        return [SubtractStage(self.roi, self.engine, self.background), ExtractStage(self.roi)]
+
+    def follow_flippers(self):
+        """Moves auto detection region after flipper areas, once online training changed them, and grows it when
+        measured latency pushed prediction window more than 10% further. Subtractor model is for the old crop, so
+        a new one starts, primed from reference background if there is one (it's trained on next frames otherwise).
+        Only for detection run by `run()`: stages elsewhere keep their region.
+        """
+        if (all(self.flippers[f].hulls is hulls for (f, hulls) in zip(FLIPPERS, self.roi_hulls)) and
+                self.roi_margin_needed() <= self.roi_margin * 1.1):
+            return
+        roi = self.get_roi()
+        if (roi.offset, roi.size) == (self.roi.offset, self.roi.size):
+            return
+        self.__say("Detection region: {}, following flipper areas and latency".format(roi))
+        self.roi = roi
+        self.engine = detection.create(*self.engine_settings)
+        self.detection = [SubtractStage(roi, self.engine, self.reference if self.reference.is_ready() else None),
+                          ExtractStage(roi)]
+        for stage in self.detection:
+            stage.setup()
+
+    def save_calibration(self):
+        "Writes trained flippers, predictor settings, background, latency and hit table to `save_calibration`"
+        if not(self.save_path):
+            return
+        calibration = Calibration(self.width, self.height, predictor={
+            'min_area': self.predictor.min_area, 'max_area': self.predictor.max_area,
+            'max_speed': self.predictor.max_speed})
+        mask_format = None if self.calibration_masks == 'none' else self.calibration_masks
+        for f in FLIPPERS:
+            if self.trained[f]:
+                calibration.add_flipper(f, self.flippers[f].get_trained_mask_contours(),
+                                        self.flippers[f].combined_mask, mask_format)
+        if self.reference.is_ready():
+            self.reference.save(calibration)
+        self.latency_estimator.save(calibration)
+        if self.is_trained():
+            if not(self.hit_table.is_current()):
+                self.hit_table.build()
+            self.hit_table.save(calibration)
+        calibration.save(self.save_path)
+        self.__say("Calibration saved to {}".format(self.save_path))
+
+    def step(self, data):
+        "Everything for a frame from the stream: training, or detection and decision. Returns predicted lines"
+        self.metrics.mark('capture_to_read', data['captured'])
+        if not(self.is_trained()):
+            return self.__train(data)
+        if self.detection is None:
+            self.detection = self.stages()
+            for stage in self.detection:
+                stage.setup()
+            self.mask = numpy.zeros((self.height, self.width), dtype=numpy.uint8)
+        elif self.roi_hulls is not None:
+            self.follow_flippers()
+        item = {'number': data['number'], 'timestamp': data['timestamp'], 'captured': data['captured'],
+                'timings': {}}
+        for stage in self.detection:
+            stage.process(data['frame'], self.mask, item)
+        return self.handle(item, data['frame'], self.mask)
+
+    def __begin(self, data):
+        self.time_captured = data['timestamp']
+        self.time_frame_read = datetime.now()
+        self.captured = data['captured']
+        self.frame_number = data['number']
+        self.frames_processed += 1
+
+    def __train(self, data):
+        "Flipper training: presses flippers in turn, and feeds movement that follows to the one pressed"
+        self.__begin(data)
+        frame = data['frame']
+        presses = dict(self.time_press)
+        frame_text = []
+        # Might need to skip a frame or two for flipper to react and background subtractor to find affected areas.
+        # Not when going by frame numbers though, video goes on without us
+        if (not(self.press_frames) and not(self.flipper_countour_sent) and
+                (self.now() - max(self.time_press.values())) < timedelta(milliseconds=self.latency)):
+            return ()
+        # For training, MOG subtractor works better
+        detected = self.training_engine.apply(frame)
+        for (stage, seconds) in self.training_engine.timings.items():
+            self.metrics.record(stage, seconds)
+        t = clock()
+        mask = cv2.dilate(detected, None, dst=self.workspace.get('training', detected.shape), iterations=3)
+        t = self.metrics.mark('morphology', t)
+        self.__learn_background(frame)
+        # It takes a while to train background subtraction
+        if self.frame_number < self.game_start_frame:
+            return ()
+        blobs = extract_blobs(mask, workspace=self.workspace)
+        self.metrics.mark('blobs', t)
+        for f in FLIPPERS:
+            if not(self.trained[f]):
+                self.trained[f] = self.__train_flipper(f, mask, frame_text)
+                break
+        self.record_flight(frame, detected, (0, 0), (), presses)
+        self.__end(frame, blobs, (), frame_text)
+        return ()
+
+    def __train_flipper(self, flipper, mask, frame_text):
+        "One training frame for `flipper`. Returns True once it's trained"
+        frame_text.append("Training " + flipper)
+        frames = self.press_frames.get(flipper)
+        if not(self.flipper_countour_sent):
+            self.flippers[flipper].add_mask(mask)
+            self.flipper_countour_sent = True
+            if self.flippers[flipper].train_masks():
+                self.trained[flipper] = True
+                if self.is_trained() and not(self.hit_table.is_current()):
+                    # Game starts right after, table should be there for it
+                    self.hit_table.build()
+                self.save_calibration()
+                return True
+        # for training, we can go by actually pressing the buttons, or by frame numbers from recorded video
+        elif ((not(frames) and self.now() - self.time_press[flipper] > timedelta(milliseconds=self.cooldown)) or
+              (frames and self.frame_number in frames)):
+            if not(frames):
+                self.arduino.press(flipper, self.latency)
+            self.time_press[flipper] = self.now()
+            self.flipper_countour_sent = False
+            frame_text.append("Press " + flipper)
+        return False
+
+    def __learn_background(self, frame):
+        # Learn reference background from the same frames subtractors train on
+        if self.reference.is_ready():
+            return
+        if self.frame_number < self.training_frames:
+            self.reference.add(frame)
+        # No frames before that when they were skipped (--replay with few --training-frames), nothing to save then
+        elif self.reference.finish() is not None and self.is_trained():
+            # Flippers came from calibration without background, so nothing else would save it
+            self.save_calibration()
+
+    def handle(self, item, frame=None, mask=None):
+        """Game decision for a frame that went through detection `stages()`. Returns predicted lines.
+
+        `item` is a pipeline item: frame 'number', 'timestamp', 'captured', 'blobs' and stage 'timings'.
+        With the `frame` and its foreground `mask` (whole frame size, as stages write it), latency of earlier
+        presses and online training go by the mask, and both go to the reference background and flight recorder.
+        """
+        self.__begin(item)
+        for (stage, seconds) in item['timings'].items():
+            self.metrics.record(stage, seconds)
+        presses = dict(self.time_press)
+        frame_text = ["Game"]
+        if mask is not None:
+            mask = self.roi.crop(mask)
+        if frame is not None:
+            self.__learn_background(frame)
+        lines = ()
+        # It takes a while to train background subtraction
+        if self.frame_number >= self.game_start_frame:
+            if mask is not None:
+                self.measure_latency(mask, self.roi.offset)
+            if not(self.probe(frame_text)):
+                lines = self.play(item['blobs'], frame_text)
+            if self.online_training and mask is not None:
+                for (f, other) in (('A', 'B'), ('B', 'A')):
+                    if self.refine[f]:
+                        self.refine[f] = not(self.__refine(f, other, mask, self.roi.offset))
+        if frame is not None and mask is not None:
+            self.record_flight(frame, mask, self.roi.offset, lines, presses)
+        self.__end(frame, item['blobs'], lines, frame_text)
+        return lines
+
+    def __end(self, frame, blobs, lines, frame_text):
+        if self.on_frame is not None:
+            self.on_frame(frame, blobs, lines, frame_text)
+        self.metrics.mark('frame_total', self.captured)
+        self.metrics.tick()
+
+    def play(self, blobs, frame_text):
+        """Game decision: predict ball movement and press flippers. Returns predicted lines.
+
+        Kept free of any drawing, so it stays on the shortest path from frame to solenoid.
+        """
+        t = clock()
+        self.predictor.add_blobs(blobs, self.time_captured)
+        (future, timing_error) = self.prediction_window()
+        lines = self.predictor.get_lines(future=future, timing_error=timing_error)
+        t = self.metrics.mark('prediction', t)
+        # Hit test all predicted segments in one go
+        segments = lines['future']
+        if self.exact_hit_test:
+            hits = [self.flippers[f].check_lines(segments, 6).any() for f in FLIPPERS]
+        else:
+            hits = self.hit_table.check(segments).any(axis=0)
+        t = self.metrics.mark('hit_test', t)
+        for (f, hit) in zip(FLIPPERS, hits):
+            if hit and (self.now() - self.time_press[f]) > timedelta(milliseconds=self.cooldown):
+                self.fire(f)
+                t = self.metrics.mark('serial_write', t)
+                self.time_press[f] = self.now()
+                self.refine[f] = True
+                self.track_latency(f)
+                self.log_decision(f)
+                frame_text.append("Press " + f)
+        if any(hits):
+            # From capture to decision (and command sent, if there was one)
+            self.metrics.record('capture_to_fire', t - self.captured)
+        return lines
+
+    def fire(self, flipper):
+        """Game press. Firmware that keeps time fires it `fire_delay` after capture, so flipper always moves the
+        same time after the frame its prediction came from (serial and processing jitter don't add to latency).
+        Legacy firmware fires when the command arrives.
+        """
+        if self.fire_delay:
+            self.arduino.schedule_press(flipper, self.captured + self.fire_delay / 1000.0, self.latency)
+        else:
+            self.arduino.press(flipper, self.latency)
+
+    def fired(self, flipper, at, fired):
+        "Firmware fired a scheduled press at host clock time `fired` (called from serial reader thread)"
+        seconds = fired - (at - self.fire_delay / 1000.0)
+        self.metrics.record('capture_to_solenoid', seconds)
+        self.latency_estimator.fired(seconds)
+
+    def track_latency(self, flipper):
+        "Starts measuring latency of a press. Recorded video does not react to our presses, so only when live"
+        if not(self.replay):
+            self.latency_estimator.pressed(flipper, self.time_captured)
+
+    def measure_latency(self, mask, offset=(0, 0)):
+        "Looks for pressed flippers moving in game mask"
+        for seconds in self.latency_estimator.observe(mask, self.time_captured, offset):
+            self.metrics.record('flipper_latency', seconds)
+
+    def probe(self, frame_text):
+        """Startup latency measurement: fires flippers in turn, each once the previous press was seen
+        (or given up on). Returns True until all probes are fired, game waits for that.
+        """
+        if self.probes <= 0:
+            return False
+        frame_text.append("Measuring latency")
+        if (not(self.latency_estimator.is_pending()) and
+                (self.now() - max(self.time_press.values())) > timedelta(milliseconds=self.cooldown)):
+            flipper = 'A' if self.probes % 2 == 0 else 'B'
+            # Same way as in the game, so latency measured is the one game presses will have
+            self.fire(flipper)
+            self.track_latency(flipper)
+            self.time_press[flipper] = self.now()
+            self.probes -= 1
+            frame_text.append("Press " + flipper)
+        return True
+
+    def __refine(self, flipper, other, mask, offset):
+        """Online training: once flipper had time to move after our press, feeds game mask to its accumulator.
+
+        Returns True when this press is dealt with (used or skipped).
+        """
+        if (self.now() - self.time_press[flipper]) < timedelta(milliseconds=self.latency):
+            return False
+        # Other flipper moving at the same time would end up in this one's area
+        if (self.now() - self.time_press[other]) < timedelta(milliseconds=self.cooldown):
+            return True
+        # Game mask is eroded for the ball, grow it back to match masks flippers were trained on
+        self.flippers[flipper].add_mask(cv2.dilate(mask, None, iterations=5), offset, (self.height, self.width))
+        self.flippers[flipper].retrain_async()
+        return True
+
+    def log_decision(self, flipper):
+        self.decisions += 1
+        if self.decision_log is None:
+            return
+        decision = {
+            'frame': self.frame_number,
+            'time_ms': round((self.time_captured - self.time_start).total_seconds() * 1000, 3),
+            'flipper': flipper,
+            'milliseconds': self.latency,
+        }
+        if self.name:
+            decision['table'] = self.name
+        self.decision_log.write(json.dumps(decision) + "\n")
+
+    def record_flight(self, frame, mask, offset, lines, presses):
+        "Adds frame to flight recorder, with flippers pressed since `presses` was `time_press`"
+        if self.recorder is None:
+            return
+        t = clock()
+        fired = 0
+        for f in FLIPPERS:
+            if self.time_press[f] != presses[f]:
+                fired |= FIRED[f]
+        self.recorder.record(self.frame_number, (self.time_captured - self.time_start).total_seconds() * 1000,
+                             self.captured, frame, mask, offset, lines['future'] if len(lines) else (), fired)
+        self.metrics.mark('flight_recorder', t)
+
+    def dump_flight(self):
+        "Copies flight recorder window next to its ring file, on a separate thread so the game goes on"
+        if self.recorder is None:
+            return
+        path = os.path.join(os.path.dirname(self.recorder.path) or '.',
+                            'flight-{}.rec'.format(datetime.now().strftime('%Y%m%d-%H%M%S')))
+        Thread(target=lambda: print("Flight recorder: {} frames copied to {}".format(
+            self.recorder.dump(path), path))).start()
+
+    def __frames(self, until=None):
+        "Frames from the stream until it ends, stop() is called or `until()` says so"
+        while not(self.stopRequest or (until is not None and until())):
+            data = self.stream.read_next(timeout=1.0)
+            if data is None:
+                # Camera stalled, keep waiting unless we're asked to stop
+                continue
+            # if we are viewing a video and we did not grab a frame, then we have reached the end of the video
+            if data['stopped']:
+                return
+            yield data
+
+    def train(self):
+        "Trains flippers on the calling thread, so detection can go elsewhere after that. Returns True once trained"
+        for data in self.__frames(self.is_trained):
+            self.step(data)
+        return self.is_trained()
+
+    def run(self):
+        "Plays on the calling thread: training if needed, then detection and decision one frame after another"
+        for data in self.__frames():
+            self.step(data)
+
+    def run_pipeline(self):
+        """Game only, with detection stages in their own processes, so frame rate is limited by the slowest
+        stage instead of all of them together. Decision runs first thing when blobs arrive.
+        """
+        if not(self.is_trained()):
+            raise ValueError("Pipeline needs trained flippers")
+        self.pipeline = Pipeline(self.stages(), self.width, self.height,
+                                 lossless=(self.stream.drop_policy == DROP_NONE))
+        self.pipeline.start(self.stream)
+        for item in self.pipeline.results(lambda: self.stopRequest):
+            # Everything from capture up to here is queueing and worker time
+            self.metrics.mark('pipeline_transit', item['captured'])
+            self.handle(item, self.pipeline.ring.frame(item['slot']), self.pipeline.ring.mask(item['slot']))
+            # Anything that keeps the frame (render sink) takes its own copy, so slot can go back to the pool
+            self.pipeline.release(item)
+        self.pipeline.stop()
+
+    def status(self):
+        "One line summary for the console"
+        if self.arduino.is_stalled():
+            serial = "serial port STALLED ({})".format(self.arduino.error or "no echo")
+        elif self.arduino.latency() is None:
+            serial = "serial round trip unknown"
+        else:
+            serial = "serial round trip {:.1f}ms".format(self.arduino.latency())
+        dropped = "{} dropped, {} stale, {} drained".format(self.stream.frames_dropped, self.stream.frames_stale,
+                                                           self.stream.frames_drained)
+        if self.pipeline is not None:
+            dropped += ", {} dropped in pipeline".format(self.pipeline.frames_dropped)
+        status = "frame {}, {} decisions ({}), frame age {:.1f}ms, ".format(
+            self.frame_number, self.decisions, dropped, self.stream.age.percentile(50) / 1000.0)
+        # Detection that runs in other processes is timed there
+        if self.engine.cost.count:
+            status += "{} detection {:.1f}ms, ".format(self.engine.name, self.engine.cost.percentile(50) / 1000.0)
+        status += "{}, {}".format(self.latency_estimator.summary(), serial)
+        return "{}: {}".format(self.name, status) if self.name else status
+
+    def stop(self):
+        self.stopRequest = True
+        self.stream.stop()
+
+    def close(self):
+        "Stops everything, keeping what was refined and measured during the game for the next start"
+        self.stop()
+        while self.started and not(self.stream.stopped):
+            sleep(0.1)
+        if self.stream.pool is not None:
+            # In use should be no more than the newest frame and the one we last got, anything above is a leak
+            self.__say("Frame buffers: {}".format(self.stream.pool.summary()))
+        if (self.online_training or self.latency_estimator.histogram.count) and self.is_trained():
+            self.save_calibration()
+        self.arduino.close()
+        self.metrics.close()
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+        if self.decision_log is not None:
+            self.decision_log.close()
+            self.decision_log = None
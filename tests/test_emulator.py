@@ -0,0 +1,127 @@
+from communication import protocol
+from communication.emulator import FirmwareEmulator, EmulatedArduino
+from lib.metrics import clock
+
+SAMPLES = {
+    protocol.HELLO: (),
+    protocol.SYNC: (7,),
+    protocol.FIRE: (ord('A'), 4000000000, 300, 255),
+    protocol.HELLO_REPLY: (protocol.VERSION,),
+    protocol.SYNC_REPLY: (7, 123456789),
+    protocol.FIRE_ACK: (3, protocol.ACK_LATE),
+    protocol.FIRED: (3, protocol.WRAP - 1),
+}
+
+
+def replies(emulator, now):
+    return protocol.Parser().feed(emulator.read(now))
+
+
+def test_parser_round_trips_every_frame_type():
+    assert sorted(SAMPLES) == sorted(protocol.FORMATS)
+    for (kind, values) in SAMPLES.items():
+        assert protocol.Parser().feed(protocol.encode(kind, *values)) == [('frame', kind, values)]
+
+
+def test_parser_splits_frames_from_echo_bytes_arriving_one_by_one():
+    data = b'A' + protocol.encode(protocol.FIRE_ACK, 1, protocol.ACK_OK) + b'B'
+    parser = protocol.Parser()
+    events = []
+    for i in range(len(data)):
+        events.extend(parser.feed(data[i:i + 1]))
+    assert events == [('echo', ord('A')), ('frame', protocol.FIRE_ACK, (1, protocol.ACK_OK)), ('echo', ord('B'))]
+    assert parser.errors == 0
+
+
+def test_parser_drops_corrupt_frames():
+    parser = protocol.Parser()
+    frame = bytearray(protocol.encode(protocol.SYNC_REPLY, 1, 2))
+    frame[-1] ^= 0xFF
+    assert parser.feed(bytes(frame)) == []
+    assert parser.feed(bytes(bytearray([protocol.START, protocol.SYNC, protocol.MAX_PAYLOAD + 1]))) == []
+    assert parser.errors == 2
+    assert parser.feed(b'A') == [('echo', ord('A'))]
+
+
+def test_legacy_press_is_echoed_and_held():
+    emulator = FirmwareEmulator()
+    emulator.receive(b'B\x05', 0.0)
+    assert emulator.read(0.01) == b'B'
+    assert emulator.is_engaged('B', 0.01)
+    assert not(emulator.is_engaged('A', 0.01))
+    assert not(emulator.is_engaged('B', 0.06))
+    assert [(f, engaged) for (_, f, engaged) in emulator.events] == [('B', True), ('B', False)]
+
+
+def test_unknown_legacy_command_is_echoed_only():
+    emulator = FirmwareEmulator()
+    emulator.receive(b'x\x05', 0.0)
+    assert emulator.read(0.01) == b'x'
+    assert emulator.events == []
+
+
+def test_press_restarts_hold():
+    emulator = FirmwareEmulator()
+    emulator.receive(b'A\x05', 0.0)
+    emulator.receive(b'A\x05', 0.04)
+    assert emulator.is_engaged('A', 0.08)
+    assert not(emulator.is_engaged('A', 0.1))
+    assert [engaged for (_, _, engaged) in emulator.events] == [True, False]
+
+
+def test_handshake_and_sync_replies():
+    emulator = FirmwareEmulator(mcu_offset=10.0)
+    emulator.receive(protocol.encode(protocol.HELLO) + protocol.encode(protocol.SYNC, 9), 0.0)
+    events = replies(emulator, 0.01)
+    assert events[0] == ('frame', protocol.HELLO_REPLY, (protocol.VERSION,))
+    (_, kind, (seq, micros)) = events[1]
+    assert (kind, seq) == (protocol.SYNC_REPLY, 9)
+    assert abs(micros - 10000000) < 10000
+
+
+def test_scheduled_press_fires_on_mcu_time():
+    emulator = FirmwareEmulator(mcu_offset=100.0)
+    emulator.receive(protocol.encode(protocol.FIRE, ord('A'), emulator.mcu_micros(0.05), 30, 4), 0.0)
+    assert replies(emulator, 0.01) == [('frame', protocol.FIRE_ACK, (4, protocol.ACK_OK))]
+    assert not(emulator.is_engaged('A', 0.049))
+    assert emulator.is_engaged('A', 0.051)
+    [(_, kind, (fire_id, micros))] = replies(emulator, 0.06)
+    assert (kind, fire_id) == (protocol.FIRED, 4)
+    assert abs(micros - emulator.mcu_micros(0.05)) <= 1
+    assert not(emulator.is_engaged('A', 0.081))
+
+
+def test_scheduled_press_in_the_past_fires_right_away():
+    emulator = FirmwareEmulator()
+    emulator.receive(protocol.encode(protocol.FIRE, ord('B'), emulator.mcu_micros(0.0), 30, 1), 0.01)
+    assert replies(emulator, 0.02)[0] == ('frame', protocol.FIRE_ACK, (1, protocol.ACK_LATE))
+    assert emulator.is_engaged('B', 0.02)
+
+
+def test_scheduled_press_of_unknown_flipper_is_rejected():
+    emulator = FirmwareEmulator()
+    emulator.receive(protocol.encode(protocol.FIRE, ord('C'), emulator.mcu_micros(0.01), 30, 2), 0.0)
+    assert replies(emulator, 0.05) == [('frame', protocol.FIRE_ACK, (2, protocol.ACK_INVALID))]
+    assert emulator.events == []
+
+
+def test_arduino_syncs_clock_with_drifting_mcu():
+    arduino = EmulatedArduino(FirmwareEmulator(mcu_offset=1000.0, mcu_rate=1.0001))
+    assert arduino.handshake() == protocol.VERSION
+    assert arduino.sync() is not None
+    now = clock()
+    assert abs(arduino.clock.to_mcu(now) - arduino.serial.emulator.mcu_micros(now)) < 1000
+    assert abs(arduino.clock.to_host(arduino.clock.to_mcu(now)) - now) < 0.00001
+
+
+def test_arduino_scheduled_press_is_acked_and_fired_on_time():
+    arduino = EmulatedArduino()
+    arduino.handshake()
+    arduino.sync()
+    at = clock() + 0.02
+    fire_id = arduino.schedule_press('A', at, 30)
+    assert arduino.wait(lambda: arduino.scheduled[fire_id]['fired'] is not None, 1.0)
+    entry = arduino.scheduled[fire_id]
+    assert entry['status'] == protocol.ACK_OK
+    assert entry['sent'] <= entry['acked'] <= at
+    assert abs(entry['fired'] - at) < 0.002
@@ -0,0 +1,111 @@
+import os
+import cv2
+import numpy
+import pytest
+from time import sleep
+from benchmark import synthetic
+from benchmark.synthetic import Scenario, swept_area
+from communication import protocol
+from communication.fake_device import FakeDevice
+from lib.calibration import Calibration
+from lib.capture import PROFILES
+from lib.fake_camera import FakeCamera, FAKE_PREFIX
+from lib.metrics import clock
+from lib.WebcamVideoStream import WebcamVideoStream
+from table import TableController
+
+
+@pytest.fixture(scope='module')
+def video(tmp_path_factory):
+    """Short synthetic game: a little static table, then balls heading to flipper A, flipper B and away.
+    Slow enough for the predictor at twice the video rate, and big enough at quarter of the pixels
+    ('fast' profile plays it at 320x240@120)"""
+    path = str(tmp_path_factory.mktemp('video').joinpath('game.avi'))
+    radius = synthetic.BALL_RADIUS
+    synthetic.BALL_RADIUS = 10
+    try:
+        return (path, Scenario(balls=3, seed=1, warmup=20, presses=0, ball_frames=(60, 80)).write(path))
+    finally:
+        synthetic.BALL_RADIUS = radius
+
+
+def calibration(path, width, height):
+    "Flipper areas straight from the scenario, so nothing has to be trained"
+    scale = numpy.array([width / 640.0, height / 480.0])
+    stored = Calibration(width, height)
+    for f in ('A', 'B'):
+        stored.add_flipper(f, [numpy.round(swept_area(f) * scale)])
+    stored.save(path)
+    return path
+
+
+def on_arrival_grid(camera, captured):
+    "Whether `captured` is arrival time of one of camera's frames"
+    position = (captured - camera.started) * camera.get(cv2.CAP_PROP_FPS)
+    return abs(position - round(position)) < 1e-6
+
+
+def test_fake_camera_queues_frames_like_a_driver(video):
+    camera = FakeCamera(video[0], buffer_size=2)
+    camera.set(cv2.CAP_PROP_FPS, 100.0)
+    sleep(0.1)
+    (grabbed, frame) = camera.read()
+    assert grabbed and frame.shape == (480, 640, 3)
+    # Slow reader gets the oldest frame, newer ones are lost while the queue is full
+    assert camera.grabbed[0] == 0
+    assert camera.lost >= camera.arrived - 2 > 0
+    assert camera.get(cv2.CAP_PROP_POS_MSEC) == camera.grabbed[1] * 1000.0
+    assert on_arrival_grid(camera, camera.grabbed[1])
+    camera.release()
+
+
+@pytest.mark.parametrize('name', sorted(PROFILES))
+def test_stream_applies_capture_profile(video, name):
+    profile = PROFILES[name]
+    stream = WebcamVideoStream(FAKE_PREFIX + video[0], profile=name)
+    assert (stream.settings['width'], stream.settings['height']) == (profile.width, profile.height)
+    # Frames pile up in the driver queue while nobody reads
+    sleep(0.2)
+    stream.start()
+    try:
+        item = stream.read_next(1.0)
+        assert item['frame'].shape == (profile.height, profile.width, 3)
+        if profile.drain:
+            assert stream.frames_drained > 0
+        else:
+            assert stream.frames_drained == 0
+        # Driver timestamp (CAP_PROP_POS_MSEC) counts time frame spent queued, read time does not
+        assert on_arrival_grid(stream.stream, item['captured']) == profile.driver_timestamps
+    finally:
+        stream.stop()
+
+
+@pytest.mark.parametrize('name', sorted(PROFILES))
+def test_table_fires_on_fake_camera_and_device(video, tmp_path, name):
+    profile = PROFILES[name]
+    device = FakeDevice().start()
+    table = TableController(None, FAKE_PREFIX + video[0], device.port,
+                            calibration(str(tmp_path / 'calibration.bin'), profile.width, profile.height),
+                            engine='absdiff', capture_profile=name, latency_probes=0, metrics_dir=str(tmp_path),
+                            metrics_interval=0)
+
+    def stop_after_fire(frame, blobs, lines, frame_text):
+        if table.metrics.histograms.get('capture_to_solenoid') or table.frame_number > 600:
+            table.stopRequest = True
+
+    table.on_frame = stop_after_fire
+    try:
+        table.start()
+        assert table.arduino.arduino.version == protocol.VERSION
+        table.warm_start()
+        table.run()
+        # Game press went out scheduled, was acknowledged, and firmware fired the first ball's flipper
+        first = video[1]['balls'][0]['target']
+        assert [f for (_, f, engaged) in device.emulator.events if engaged][:1] == [first]
+        assert table.arduino.round_trip.count > 0
+        assert not(table.arduino.is_stalled())
+        assert table.metrics.histograms['capture_to_solenoid'].count > 0
+        assert [s['status'] for s in table.arduino.arduino.scheduled.values()][:1] == [protocol.ACK_OK]
+    finally:
+        table.close()
+        device.stop()
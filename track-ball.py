@@ -1,30 +1,38 @@
 #!/usr/bin/env python
 
 from __future__ import print_function
-from collections import deque
-import numpy as np
 import argparse
-import imutils
-import cv2
-import sys
-import os
-from datetime import datetime, timedelta
-from communication.arduino import Arduino
-from time import sleep
-from flipper import Flipper
-from predictor_bruteforce import Bruteforce
-from lib.WebcamVideoStream import WebcamVideoStream
 import signal
+from datetime import datetime
+from table import TableController
+from lib.capture import PROFILES
+from lib.render import RenderSink
+from lib.roi import RegionOfInterest
+
+
+def region(text):
+    "--roi value, checked before anything is started"
+    if text != 'auto':
+        try:
+            RegionOfInterest.parse(text)
+        except ValueError as e:
+            raise argparse.ArgumentTypeError(str(e))
+    return text
 
-globalExitFlag = False
-def signal_handler(signal, frame):
-    print('You pressed Ctrl+C!')
-    global globalExitFlag
-    globalExitFlag = True
-    # stream.stop()
 
 parser = argparse.ArgumentParser()
-parser.add_argument('--src', help='Input video, either a path to a file, or camera number', required=True)
+parser.add_argument('--src', help='''Input video, either a path to a file, or camera number. "fake:<file>" plays the file
+                        the way a live camera would, to try --capture-profile without one''', required=True)
+parser.add_argument('--capture-profile',
+                    help='''Camera settings: "default" is 640x480@60 with driver buffering, "low-latency" MJPEG with one
+                        buffer and frames queued in the driver skipped, "yuyv" uncompressed at 30 FPS, "fast" 320x240@120.
+                        See lib/capture.py''',
+                    choices=sorted(PROFILES.keys()), default='default',
+                    required=False)
+parser.add_argument('--exposure',
+                    help='Manual camera exposure (driver units), instead of automatic. Shorter blurs the ball less',
+                    type=float,
+                    required=False)
 parser.add_argument('--out', help='Output video', required=False)
 parser.add_argument('--show', help='Show live video (with annotations) on the screen in real time',
                     required=False, const=True, action='store_const')
@@ -48,11 +56,33 @@ parser.add_argument('--latency',
                     default=100, type=int,
                     required=False)
 parser.add_argument('--ball-prediction-time',
-                    help='''how much in the future to predict ball movement, to evaluate where it will be''',
+                    help='''how much in the future to predict ball movement, to evaluate where it will be.
+                        Replaced by measured latency (capture to flipper movement) once there is enough of it''',
                     default=60, type=int,
                     required=False)
+parser.add_argument('--fixed-prediction-time',
+                    help='''Always predict --ball-prediction-time ahead with +/-25%% window, even when latency
+                        was measured''',
+                    required=False, const=True, action='store_const')
+parser.add_argument('--exact-hit-test',
+                    help='''Hit test predicted lines against flipper hull polygons, instead of lookup table precomputed
+                        from them (stored with calibration)''',
+                    required=False, const=True, action='store_const')
+parser.add_argument('--fire-delay',
+                    help='''With firmware that keeps time (protocol v2), fire flippers this long (milliseconds) after the
+                        frame was captured instead of when the command arrives, so they move at the time prediction
+                        was for, no matter how long processing took. Commands that arrive later fire right away.
+                        0 fires on arrival''',
+                    default=40, type=int,
+                    required=False)
+parser.add_argument('--latency-probes',
+                    help='''Once flippers are trained, fire each of them this many times before the game, to measure
+                        latency from capture to flipper movement. Skipped with --replay''',
+                    default=3, type=int,
+                    required=False)
 parser.add_argument('--debug-right',
-                    help='Frame numbers of right flipper detection contours for training on video (comma separated)',
+                    help='''Frame numbers of right flipper detection contours for training on video (comma separated).
+                         calibrate.py finds them by itself''',
                     required=False)
 parser.add_argument('--debug-left',
                     help='Frame numbers of left flipper detection contours for training on video (comma separated)',
@@ -63,253 +93,178 @@ parser.add_argument('--load-a',
 parser.add_argument('--load-b',
                     help='Load effective area 8-bit mask from CSV file, for manual tweaking',
                     required=False)
+parser.add_argument('--calibration',
+                    help='''Calibration file to start with (flipper areas and predictor settings), as written by
+                        --save-calibration. Flippers found there don't need training''',
+                    required=False)
+parser.add_argument('--save-calibration',
+                    help='''Where to write calibration once flippers are trained (./tmp/calibration.bin by default).
+                        With --replay only if given''',
+                    required=False)
+parser.add_argument('--calibration-masks',
+                    help='''How to keep combined training masks in calibration file: packed "bits", "png", "raw"
+                        bytes (memory mapped on load), or "none" for hulls only''',
+                    choices=['bits', 'png', 'raw', 'none'], default='bits',
+                    required=False)
+parser.add_argument('--warm-frames',
+                    help='''With --calibration that has background in it, how many live frames to compare against it.
+                        If they match, background training is skipped and game starts right away''',
+                    default=5, type=int,
+                    required=False)
+parser.add_argument('--engine',
+                    help='''Background subtraction for the game: "gmg", "mog2", "knn", or "absdiff" against background
+                        learned from first --training-frames frames (cheapest, but doesn't adapt to lighting)''',
+                    choices=['gmg', 'mog2', 'knn', 'absdiff'], default='gmg',
+                    required=False)
+parser.add_argument('--training-engine',
+                    help='Background subtraction for flipper training',
+                    choices=['mog', 'gmg', 'mog2', 'knn', 'absdiff'], default='mog',
+                    required=False)
+parser.add_argument('--grayscale',
+                    help='Detect on grayscale frames, which is about 3 times less data',
+                    required=False, const=True, action='store_const')
+parser.add_argument('--pyramid',
+                    help='Halve resolution this many times before detection. Masks are scaled back to frame size',
+                    default=0, type=int,
+                    required=False)
+parser.add_argument('--predictor',
+                    help='''Ball predictor: "bruteforce" pairs every contour of two last frames,
+                        "tracker" keeps persistent tracks and only predicts confirmed ones''',
+                    choices=['bruteforce', 'tracker'], default='bruteforce',
+                    required=False)
+parser.add_argument('--roi',
+                    help='''Region of interest for game detection: "x,y,w,h" in pixels, or "auto" to use trained
+                        flipper areas plus distance the ball can travel within prediction window, measured latency
+                        included (follows --online-training and latency changes, but not with --pipeline).
+                        Whole frame by default''',
+                    type=region,
+                    required=False)
+parser.add_argument('--pipeline',
+                    help='''Run detection stages in separate processes, so frame rate is limited by the slowest stage
+                        instead of all of them together. Needs trained flippers (--load-a and --load-b)''',
+                    required=False, const=True, action='store_const')
+parser.add_argument('--metrics-interval',
+                    help='''How often (seconds) to write per stage latency percentiles into log/metrics-*.jsonl.
+                        0 disables it''',
+                    default=10.0, type=float,
+                    required=False)
+parser.add_argument('--replay',
+                    help='''Replay video file as fast as possible, using frame timestamps from the video for all game
+                        logic, so results are reproducible and don't depend on host speed''',
+                    required=False, const=True, action='store_const')
+parser.add_argument('--decision-log',
+                    help='File to append flipper decisions to, one JSON object per line',
+                    required=False)
+parser.add_argument('--online-training',
+                    help='''Keep refining flipper areas during the game, from frames where flipper moved after being
+                        pressed. Retraining runs in the background''',
+                    required=False, const=True, action='store_const')
+parser.add_argument('--flight-recorder',
+                    help='''Keep last --flight-seconds of frames, masks, predicted lines and presses in this memory mapped
+                        ring file (./tmp/flight.rec if no path is given). SIGUSR1 copies the window out, see blackbox.py''',
+                    nargs='?', const='./tmp/flight.rec',
+                    required=False)
+parser.add_argument('--flight-seconds',
+                    help='How much of the game --flight-recorder keeps (seconds)',
+                    default=5.0, type=float,
+                    required=False)
 args = parser.parse_args()
+if args.save_calibration is None and not(args.replay):
+    args.save_calibration = './tmp/calibration.bin'
+
+
+def frame_numbers(text):
+    "Frame numbers to train on, parsed once rather than on every frame"
+    return set(int(n) for n in text.split(',') if n.strip()) if text else set()
 
 
 def getSecondsString(timedelta):
-    return "{}.{:03d}".format(timedelta.seconds, timedelta.microseconds/1000)
+    return "{}.{:03d}".format(timedelta.seconds, timedelta.microseconds//1000)
 
 
-class State:
-    # timestamp of program start
-    time_start = 0
-    # Timestamp of when we finished processing the frame
-    time_processing_ended = 0
-    # Timestamp of when we finished capturing a frame
-    time_captured = 0
-    # timestamp of when we actually read the frame (as we're multithreaded)
-    time_frame_read = 0
-    # Timestamp of when command to press button was last sent
-    # Needed to track flipper location for training and to prevent feedback loops from own movement
-    time_press_a = datetime.now()
-    time_press_b = datetime.now()
+capture_profile = PROFILES[args.capture_profile]
+if args.exposure is not None:
+    capture_profile = capture_profile.with_exposure(args.exposure)
+table = TableController(None, args.src, args.port, args.calibration, engine=args.engine,
+                        training_frames=args.training_frames, grayscale=args.grayscale, pyramid=args.pyramid,
+                        predictor=args.predictor, latency=args.latency, cooldown=args.cooldown,
+                        ball_prediction_time=args.ball_prediction_time, roi=args.roi, replay=args.replay,
+                        metrics_interval=args.metrics_interval, decision_log=args.decision_log,
+                        capture_profile=capture_profile, training_engine=args.training_engine,
+                        fixed_prediction_time=args.fixed_prediction_time, exact_hit_test=args.exact_hit_test,
+                        latency_probes=args.latency_probes, save_calibration=args.save_calibration,
+                        calibration_masks=args.calibration_masks, warm_frames=args.warm_frames,
+                        online_training=args.online_training, flight_recorder=args.flight_recorder,
+                        flight_seconds=args.flight_seconds, fire_delay=args.fire_delay,
+                        press_frames={'A': frame_numbers(args.debug_right), 'B': frame_numbers(args.debug_left)},
+                        load_masks={'A': args.load_a, 'B': args.load_b})
 
-    flipper_a_trained = False
-    flipper_b_trained = False
-    # Set this to True after a frame with flipper contour was sent. Reverse to False when we press flipper button.
-    flipper_countour_sent = False
 
-    # Tracking frame numbers, possibly useful in training on video...
-    frame_number = 0
-    # Counter for actuall processed frames
-    frames_processed = 0
+def signal_handler(signal, frame):
+    print('You pressed Ctrl+C!')
+    table.stopRequest = True
 
 
-stream = WebcamVideoStream(args.src)
-stream.start()
 # Set up signal handler to make sure we kill all threads
 signal.signal(signal.SIGINT, signal_handler)
+if table.recorder is not None and hasattr(signal, 'SIGUSR1'):
+    signal.signal(signal.SIGUSR1, lambda signum, frame: table.dump_flight())
 
-subtractorGMG = cv2.bgsegm.createBackgroundSubtractorGMG(args.training_frames, 0.6)
-subtractorMOG = cv2.bgsegm.createBackgroundSubtractorMOG()
-
-# Saving output for further analysis, if output is specified
-if (args.out):
-    if (os.path.isfile(args.out)):
-        os.remove(args.out)
-    fourcc = cv2.VideoWriter_fourcc(*'avc1')
-    out = cv2.VideoWriter(args.out, fourcc, 10.0, (int(stream.getParam(3)), int(stream.getParam(4))))
-
-# Keep track of current state in this object
-state = State()
-arduino = Arduino(args.port)
-# Gving some time for serial port to stabilize
-# sleep(3)
-state.time_start = state.time_processing_ended = datetime.now()
-currentStage = -1
-
-flipper_a = Flipper(name='rigth')
-if args.load_a:
-    flipper_a.load_hull_mask(args.load_a)
-    state.flipper_a_trained = flipper_a.is_good_mask()
-flipper_b = Flipper(name='left')
-if args.load_b:
-    flipper_b.load_hull_mask(args.load_b)
-    state.flipper_b_trained = flipper_b.is_good_mask()
-predictor = Bruteforce(
-    min_area=int(stream.getParam(3)*stream.getParam(4)/4000),
-    max_area=int(stream.getParam(3)*stream.getParam(4)/20),  # Looks like max area does not make sense to define
-    max_speed=max(stream.getParam(3), stream.getParam(4))/500.0  # Limit speed to 10% of the frame in 50 ms
-)
+# Showing and saving output for further analysis happens on its own thread, and only if asked for
+sink = None
+if (args.show or args.out):
+    sink = RenderSink(show=args.show, out=args.out, size=(table.width, table.height)).start()
+# Timestamp of when we finished processing the previous frame
+time_processing_ended = datetime.now()
 fps_frames = 50
 fps_time = datetime.now()
-while True:
-    frame_text = []
-    # grab the next frame, making sure it is not the same frame we already processed
-    while True:
-        frame_data = stream.read()
-        if state.frame_number == frame_data['number']:
-            # This is the same frame we already looked at, so keep trying
-            # print("Waiting for new frame")
-            sleep(0.001)
-            continue
-        frame = frame_data['frame']
-        state.time_captured = frame_data['timestamp']
-        state.time_frame_read = datetime.now()
-        # New frame, so we can update frame number and exit the loop
-        state.frame_number = frame_data['number']
-        state.frames_processed += 1
-        break
-    if (state.frames_processed % fps_frames == 0):
-        diff = datetime.now() - fps_time
-        fps = fps_frames / (diff.seconds + diff.microseconds/1E6)
-        print("{:.01f} FPS".format(fps))
-        fps_time = datetime.now()
-    # if we are viewing a video and we did not grab a frame,
-    # then we have reached the end of the video
-    if frame_data['stopped']:
-        break
-    # If we're in training mode, might need to skip a frame or two for flipper to react and background subtractor to
-    # find affected areas
-    # And we should not do it in debug mode, as it's skipping a lot of frames...
-    if (not(args.debug_right or args.debug_left) and
-        not(state.flipper_a_trained and state.flipper_b_trained) and
-        not(state.flipper_countour_sent) and
-       (datetime.now() - max(state.time_press_a, state.time_press_b)) < timedelta(milliseconds=args.latency)):
-        continue
 
-    # For training, MOG subtractor works better. For game, GMG.
-    if (not(state.flipper_a_trained and state.flipper_b_trained)):
-        mask = subtractorMOG.apply(frame)
-        mask = cv2.dilate(mask, None, iterations=3)
-    else:
-        # Detection works better on a blurred frame
-        blurred = cv2.GaussianBlur(frame, (11, 11), 0)
-        mask = subtractorGMG.apply(blurred)
-        mask = cv2.erode(mask, None, iterations=3)
-        mask = cv2.dilate(mask, None, iterations=1)
-    # It takes 120 frames to train background subtraction
-    if (state.frame_number < args.training_frames+2):
-        continue
-    (_, contours, _) = cv2.findContours(mask.copy(),
-                                        cv2.RETR_EXTERNAL,
-                                        cv2.CHAIN_APPROX_SIMPLE)
 
-    if not(state.flipper_a_trained):
-        frame_text.append("Training A")
-        # print("\rTraining A                 ", end="")
-        # Check if flipper was pressed to add contours
-        delta = datetime.now() - state.time_press_a
-        if (not(state.flipper_countour_sent)):
-            flipper_a.add_mask(mask)
-            state.flipper_countour_sent = True
-            state.flipper_a_trained = flipper_a.train_masks()
-            if state.flipper_a_trained:
-                np.savetxt('./tmp/a-area.csv', flipper_a.get_hull_mask(), fmt='%d', delimiter=',')
-        # for training, we can go by actually pressing the buttons, or by frame numbers from recorded video
-        elif ((not(args.debug_right) and delta > timedelta(milliseconds=args.cooldown)) or  # < this is based on action
-              (args.debug_right and str(state.frame_number) in args.debug_right.split(","))):  # < this on video
-            if (not(args.debug_right)):
-                arduino.pressA(args.latency)
-            state.time_press_a = datetime.now()
-            state.flipper_countour_sent = False
-            frame_text.append("Press A")
-    elif not(state.flipper_b_trained):
-        frame_text.append("Training B")
-        # print("\rTraining B                 ", end="")
-        # Check if flipper was pressed to add contours
-        delta = datetime.now() - state.time_press_b
-        if (not(state.flipper_countour_sent)):
-            flipper_b.add_mask(mask)
-            state.flipper_countour_sent = True
-            state.flipper_b_trained = flipper_b.train_masks()
-            if state.flipper_b_trained:
-                np.savetxt('./tmp/b-area.csv', flipper_b.get_hull_mask(), fmt='%d', delimiter=',')
-        # for training, we can go by actually pressing the buttons, or by frame numbers from recorded video
-        elif ((not(args.debug_left) and delta > timedelta(milliseconds=args.cooldown)) or  # < this is based on action
-              (args.debug_left and str(state.frame_number) in args.debug_left.split(","))):  # < this on video
-            if (not(args.debug_left)):
-                arduino.pressB(args.latency)
-            state.time_press_b = datetime.now()
-            state.flipper_countour_sent = False
-            frame_text.append("Press B")
-    else:
+def annotate(frame, blobs, lines, frame_text):
+    "Adds timing info to the frame text, and hands everything over to the render sink, if there is one"
+    global time_processing_ended, fps_time
+    if table.is_trained():
         print("\rGame in progress                 ", end="")
-        frame_text.append("Game")
-        # BEGIN HACK
-        predictor.add_contours(contours, state.time_captured)
-        for l in predictor.get_lines(future=args.ball_prediction_time):
-            cv2.line(frame, l['past'], l['present'], (0, 0, 255))
-            cv2.line(frame, l['future_min'], l['future_max'], (255, 255, 0), 2)
-            # # This can be used to troubleshoot filter by areas
-            # cv2.putText(frame, "{0}".format(l['present_area']), l['present'], cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
-            if (flipper_a.check_line(l['future_min'], l['future_max'], 6) and ((datetime.now() - state.time_press_a) > timedelta(milliseconds=args.cooldown))):
-                if (not(args.debug_right)):
-                    arduino.pressA(args.latency)
-                state.time_press_a = datetime.now()
-                frame_text.append("Press A")
-            if (flipper_b.check_line(l['future_min'], l['future_max'], 6) and ((datetime.now() - state.time_press_b) > timedelta(milliseconds=args.cooldown))):
-                if (not(args.debug_right)):
-                    arduino.pressB(args.latency)
-                state.time_press_b = datetime.now()
-                frame_text.append("Press B")
-        # END HACK
-        # for c in contours:
-        #     # Check if object intersects with flipper A, and fire flipper, if necessary
-        #     # Make sure to wait for cooldown, if it was fired recently
-        #     if (flipper_a.check(c) and ((datetime.now() - state.time_press_a) > timedelta(milliseconds=args.cooldown))):
-        #         if (not(args.debug_right)):
-        #             arduino.pressA(args.latency)
-        #         state.time_press_a = datetime.now()
-        #         frame_text.append("Press A")
-        #     if (flipper_b.check(c) and ((datetime.now() - state.time_press_b) > timedelta(milliseconds=args.cooldown))):
-        #         if (not(args.debug_right)):
-        #             arduino.pressB(args.latency)
-        #         state.time_press_b = datetime.now()
-        #         frame_text.append("Press B")
-    # Draw contours we find on the original frame, for debugging
-    if (args.show or args.out):
-        # Draw contours that define target area from flippers
-        if (state.flipper_a_trained):
-            cv2.drawContours(frame, flipper_a.get_trained_mask_contours(), -1, (255, 0, 0), 3)
-        if (state.flipper_b_trained):
-            cv2.drawContours(frame, flipper_b.get_trained_mask_contours(), -1, (255, 0, 0), 3)
-        # Draw all countours currently found in the frame.
-        for c in contours:
-            # if the contour is too small, ignore it
-            if cv2.contourArea(c) < 80:
-                continue
-            # compute the bounding box for the contour, draw it on the frame
-            cv2.drawContours(frame, [c], -1, (0, 255, 0), 2)
-            # print('%d, %d; size: %d' % (x+w/2, y+h/2, cv2.contourArea(c)))
-
-    #HACK begin
-    # for c in contours:
-    #     # if the contour is too small, ignore it
-    #     if cv2.contourArea(c) < 8:
-    #         continue
-    #     print("%d %s: found contour (%d)" % (state.frame_number, getSecondsString(datetime.now() - state.time_start), cv2.contourArea(c)))
-    #HACK end
     # Processing END timeframe
-    frame_text.insert(0, "{:06d} {}".format(state.frame_number, getSecondsString(state.time_captured-state.time_start)))
-    frame_text.insert(1, "Capture: {}s".format(getSecondsString(state.time_frame_read-state.time_processing_ended)))
+    frame_text.insert(0, "{:06d} {}".format(table.frame_number,
+                                           getSecondsString(table.time_captured-table.time_start)))
+    frame_text.insert(1, "Capture: {}s".format(getSecondsString(table.time_frame_read-time_processing_ended)))
     # This needs to be assigned after ^ capture time calculation, so we can use the same timer.
-    state.time_processing_ended = datetime.now()
-    frame_text.insert(2, "Processing: {}s".format(getSecondsString(state.time_processing_ended-state.time_frame_read)))
-    if (args.show or args.out):
-        for i, line in enumerate(frame_text):
-            y = 21 + i*20
-            cv2.putText(frame, line, (1, y), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2, cv2.LINE_AA)
-    # Show original on the screen
-    if (args.show):
-        cv2.imshow("Original", frame)
-        # show the frame to our screen
-        # cv2.imshow("Frame", mask)
-    if (args.out):
-        out.write(frame)
-    key = cv2.waitKey(1) & 0xFF
-
+    time_processing_ended = datetime.now()
+    frame_text.insert(2, "Processing: {}s".format(getSecondsString(time_processing_ended-table.time_frame_read)))
+    if (table.frames_processed % fps_frames == 0):
+        diff = datetime.now() - fps_time
+        fps = fps_frames / (diff.seconds + diff.microseconds/1E6)
+        print("{:.01f} FPS, {}".format(fps, table.status()))
+        fps_time = datetime.now()
+    if sink is None:
+        return
+    areas = []
+    for f in ('A', 'B'):
+        if table.trained[f]:
+            areas.extend(table.flippers[f].get_trained_mask_contours())
+    sink.submit(frame, blobs, lines, frame_text, areas)
+    sink.display()
     # if the 'q' key is pressed, stop the loop
-    if globalExitFlag or key == ord("q"):
-        break
+    if sink.quit_requested:
+        table.stopRequest = True
+
+
+table.on_frame = annotate
+table.start()
+table.warm_start()
+if args.pipeline:
+    if not(table.is_trained()):
+        table.close()
+        parser.error("--pipeline needs flippers trained and table matching --calibration, see --load-a and --load-b")
+    table.run_pipeline()
+else:
+    table.run()
 
 # cleanup the camera and close any open windows
-stream.stop()
 print("stopping stream")
-while not(stream.stopped):
-    print("Waiting for stream to stop...")
-    sleep(0.1)
+table.close()
+if sink is not None:
+    sink.stop()
+    print("Rendered {} frames, dropped {}".format(sink.frames_rendered, sink.frames_dropped))
 print("exiting")
-if (args.out):
-    out.release()
-cv2.destroyAllWindows()